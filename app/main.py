@@ -1,8 +1,8 @@
 import asyncio
+from datetime import timedelta
 import logging
 from multiprocessing import Process
 import os
-import redis.asyncio
 from sanic import Sanic
 from sanic_cors import CORS
 from sanic.log import LOGGING_CONFIG_DEFAULTS
@@ -15,12 +15,21 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 # project imports
 from app.models_db import Account, Signal, WebSource
-from models_mem import OurGenericList
+from models_mem import OurGenericList, OurWindowedList, Order
 from app.process_db import db_process
 from app.process_exch import exch_process
 from app.routes import setup_routes
-from app.task_worker import worker_background_task_to_process_messages
+from app.services.signal_stats import SignalStats
+from app.supervisor import ProcessSupervisor
+from app.task_worker import apply_snapshot, worker_background_task_to_process_messages
+from app.utils.admission import AdmissionController
+from app.utils.dedup import SignalDeduplicator
 from app.utils.logger import create_loggers
+from app.utils.local_transport import local_hub_process
+from app.utils.redis_config import close_redis, get_redis, get_sync_redis
+from app.utils.snapshot import read_snapshot_file
+from app.utils.transport import close_channels, get_channels, get_publisher
+import config
 
 create_loggers()
 logger = logging.getLogger("sanic.root")
@@ -38,11 +47,26 @@ async def setup_main(app, loop):
 
     logger.debug("Setting up main process")
 
-    # Start background processes
-    app.ctx.db_proc = Process(target=db_process)
-    app.ctx.db_proc.start()
-    app.ctx.exch_proc = Process(target=exch_process)
-    app.ctx.exch_proc.start()
+    # Start background processes (one per shard, restarted by the supervisor if they crash)
+    app.ctx.supervisor = ProcessSupervisor(redis_conn=get_sync_redis())
+    if config.TRANSPORT['kind'] == "local":
+        # single host: the channels go through the local hub instead of redis
+        app.ctx.supervisor.add("local_hub", local_hub_process)
+    db_shards = config.PROCESSES['db_shards']
+    for shard_index in range(db_shards):
+        app.ctx.supervisor.add(f"db_proc.{shard_index}", db_process, args=(shard_index, db_shards))
+    exch_shards = config.PROCESSES['exch_shards']
+    for shard_index in range(exch_shards):
+        app.ctx.supervisor.add(f"exch_proc.{shard_index}", exch_process, args=(shard_index, exch_shards))
+    app.ctx.supervisor.start()
+
+@app.listener('main_process_stop')
+async def stop_main(app, loop):
+
+    # stop supervising before the children go down with the server
+    if hasattr(app.ctx, "supervisor"):
+        logger.warning(f"MAIN: Stopping background processes")
+        app.ctx.supervisor.stop()
 
 @app.listener('before_server_start')
 async def setup_worker(app, loop):
@@ -50,10 +74,30 @@ async def setup_worker(app, loop):
     logprefix = f"Worker[{os.getpid()}]: "
 
     # setup lists app.ctx.TABLENAME for our db classes
-    for db_class in [Account, Signal, WebSource]:
+    for db_class in [Account, WebSource]:
         setattr(app.ctx, db_class.get_tablename(), OurGenericList(force_item_class=db_class))
-
-    app.ctx.redis_conn = None   # workers must only publish (and not receive) messages
+    # signals only within a sliding window (older ones are read from the database on demand)
+    setattr(app.ctx, Signal.get_tablename(), OurWindowedList(force_item_class=Signal,
+        max_rows=config.SIGNALS['cache_max_rows'], max_age=timedelta(hours=config.SIGNALS['cache_max_age_hours'])))
+    # orders are not stored in the database, the exchange process publishes their changes
+    setattr(app.ctx, Order.get_tablename(), OurGenericList(force_item_class=Order))
+
+    app.ctx.signal_stats = SignalStats()
+
+    # warm start from the local snapshot file, the DB process sends the current state later
+    # (requests are answered with 503 until the tables have been loaded one way or the other)
+    app.ctx.tables_ready = False
+    app.ctx.snapshot_version = None
+    snapshot_version, tables = read_snapshot_file(config.SNAPSHOT['path'])
+    if snapshot_version is not None:
+        apply_snapshot(app, snapshot_version, tables, logprefix)
+
+    # workers only publish, the background task below receives the messages for them
+    app.ctx.redis_conn = get_redis()
+    app.ctx.channels = get_channels()
+    app.ctx.publisher = get_publisher()
+    app.ctx.signal_dedup = SignalDeduplicator()
+    app.ctx.admission = AdmissionController()
 
     # lunch a subtask to listen for redis messages
     # the worker itself does not listen for messages!
@@ -65,9 +109,6 @@ async def shutdown_worker(app, loop):
 
     logger.info(f"Worker[{os.getpid()}]: Shutting down worker")
 
-    # if app.ctx.redis_conn is not None:
-    #     app.ctx.redis_conn.close()
-    #     await app.ctx.redis_conn.wait_closed()
 
 # after_server_stop because all HTTP connections have been closed
 @app.listener("after_server_stop")
@@ -79,15 +120,18 @@ async def stop_bg(app, loop):
             task.cancel()
             await task
 
+    # close the connection pool of this worker once nothing uses it anymore
+    await close_channels()
+    await close_redis()
+    app.ctx.redis_conn = None
+    app.ctx.channels = None
+
 if __name__ == "__main__":
 
     try:
         app.run(host="0.0.0.0", port=10000, workers=4)
     finally:
         # Stop background processes on shutdown
-        if hasattr(app.ctx, "db_proc"):
-            logger.warning(f"MAIN: Stopping process db_proc")
-            app.ctx.db_proc.join()
-        if hasattr(app.ctx, "exch_proc"):
-            logger.warning(f"MAIN: Stopping process exch_proc")
-            app.ctx.exch_proc.join()
\ No newline at end of file
+        if hasattr(app.ctx, "supervisor"):
+            logger.warning(f"MAIN: Stopping background processes")
+            app.ctx.supervisor.stop()
\ No newline at end of file
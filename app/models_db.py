@@ -2,11 +2,13 @@ from datetime import datetime, timezone
 from decimal import Decimal
 import logging
 import simplejson as json
-from sqlalchemy import Column, Integer, String, Numeric, TIMESTAMP, DECIMAL
+from sqlalchemy import Column, Integer, String, Numeric, TIMESTAMP, DECIMAL, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 
 # project imports
+import config
 from app.utils.serializer import datetime_serializer
 
 # project definitions and globals
@@ -23,6 +25,53 @@ class OurBaseDBModel(Base):
         field_values = {field: getattr(self, field) for field in field_names}
         return f"<{self.__class__.__name__}({', '.join(f'{key}={value}' for key, value in field_values.items())})>"
 
+    @classmethod
+    async def bulk_upsert(cls, session: AsyncSession, items, chunk_size: int = None):
+        """INSERT ... ON CONFLICT (primary key) DO UPDATE for many rows at once
+
+        items: OurGenericList (or any iterable) of instances of cls and/or dicts
+        returns the primary keys of all inserted or updated rows (in order of their first occurrence)
+
+        Items with the same primary key are written once, the last one wins. All fields of
+        an item are written, fields set to None overwrite existing values with NULL.
+        """
+        chunk_size = chunk_size or config.DATABASE['bulk_chunk_size']
+        table_pk_names = [column.name for column in cls.__table__.primary_key.columns]
+        mapper_pk_columns = inspect(cls).primary_key
+
+        rows = {}
+        for index, item in enumerate(items):
+            row = dict(item) if isinstance(item, dict) else item.to_dict()
+            # let the database assign missing (serial) keys
+            row = {key: value for key, value in row.items() if not (key in table_pk_names and value is None)}
+            # postgres refuses to update the same row twice in one statement
+            key = tuple(row.get(name) for name in table_pk_names)
+            rows[key if None not in key else ("new", index)] = row
+        rows = list(rows.values())
+
+        affected_keys = []
+        for chunk_start in range(0, len(rows), chunk_size):
+            # multi-row VALUES need identical columns in every row: one statement per run of
+            # rows with the same columns, which keeps the order of the rows
+            runs = []
+            for row in rows[chunk_start:chunk_start + chunk_size]:
+                columns = tuple(sorted(row.keys()))
+                if len(runs) == 0 or runs[-1][0] != columns:
+                    runs.append((columns, []))
+                runs[-1][1].append(row)
+            for columns, run_rows in runs:
+                stmt = pg_insert(cls.__table__).values(run_rows)
+                update_columns = {name: stmt.excluded[name] for name in columns if name not in table_pk_names}
+                if len(update_columns) == 0:
+                    # nothing to update, but DO NOTHING would not return the existing row
+                    update_columns = {name: stmt.excluded[name] for name in columns}
+                stmt = stmt.on_conflict_do_update(index_elements=table_pk_names, set_=update_columns)
+                result = await session.execute(stmt.returning(*mapper_pk_columns))
+                for row in result:
+                    affected_keys.append(row[0] if len(mapper_pk_columns) == 1 else tuple(row))
+        await session.commit()
+        return affected_keys
+
     async def delete(self, session: AsyncSession):
         async with session.begin():
             await session.delete(self)
@@ -108,15 +157,20 @@ class Account(OurBaseDBModel):
 
 class Signal(OurBaseDBModel):
     __tablename__ = "signals"
+    # partitioned by day on received_at (see app/utils/partitions.py), the partition key
+    # has to be part of the table's primary key but rows are still identified by id alone
+    __table_args__ = {"postgresql_partition_by": "RANGE (received_at)"}
 
-    id            = Column(Integer, primary_key=True, index=True)
+    id            = Column(Integer, primary_key=True, autoincrement=True, index=True)
     strategy      = Column(String(255))
     order_id      = Column(String(255))
     action        = Column(String(50))
     symbol        = Column(String(50))
     price         = Column(DECIMAL)
     quantity      = Column(DECIMAL)
-    received_at   = Column(TIMESTAMP, default=datetime.now)
+    received_at   = Column(TIMESTAMP, primary_key=True, default=datetime.now)
+
+    __mapper_args__ = {"primary_key": [id]}
 
     @property
     def pk(self):
@@ -126,6 +180,35 @@ class Signal(OurBaseDBModel):
     def pk_field_name(self):
         return next((key.name for key in self.__table__.primary_key), None)
 
+class Position(OurBaseDBModel):
+    # snapshots of the positions after executions (one row per change), written by COPY
+    # from the exchange process' fills (app/services/execution_store.py)
+    __tablename__ = "positions"
+
+    id            = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    account       = Column(String(255))
+    symbol        = Column(String(50))
+    quantity      = Column(DECIMAL)
+    average_price = Column(DECIMAL)
+    stop_loss     = Column(DECIMAL)
+    updated_at    = Column(TIMESTAMP, default=datetime.now)
+
+class Trade(OurBaseDBModel):
+    # executions of our orders, trade_key (client order id and cumulative filled amount)
+    # makes redelivered batches idempotent
+    __tablename__ = "trades"
+
+    id            = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    trade_key     = Column(String(100), unique=True)
+    account       = Column(String(255))
+    symbol        = Column(String(50))
+    action        = Column(String(50))
+    price         = Column(DECIMAL)
+    quantity      = Column(DECIMAL)
+    client_order_id = Column(String(64))
+    exchange_order_id = Column(String(255))
+    executed_at   = Column(TIMESTAMP, default=datetime.now)
+
 class WebSource(OurBaseDBModel):
     __tablename__ = "websources"
 
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from datetime import datetime, timezone
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 import inspect
 import logging
 import re
@@ -178,7 +180,85 @@ class Trade(OurBaseMemoryModel):
     pass
 
 class Order(OurBaseMemoryModel):
-    pass
+    # Lifecycle of an order sent to an exchange, the exchange process keeps these up to date
+    # (app/services/order_tracker.py) and publishes the changed ones to the workers.
+    #
+    #   new --> partially_filled --> filled
+    #    |             |
+    #    |             +----------> cancelled
+    #    +--> filled / cancelled / rejected
+
+    NEW = "new"
+    PARTIALLY_FILLED = "partially_filled"
+    FILLED = "filled"
+    CANCELLED = "cancelled"
+    REJECTED = "rejected"
+
+    TRANSITIONS = {
+        NEW:                {PARTIALLY_FILLED, FILLED, CANCELLED, REJECTED},
+        PARTIALLY_FILLED:   {PARTIALLY_FILLED, FILLED, CANCELLED},
+        FILLED:             set(),
+        CANCELLED:          set(),
+        REJECTED:           set()
+    }
+    FINAL_STATUSES = {FILLED, CANCELLED, REJECTED}
+
+    def __init__(self, client_order_id: str, account: str, symbol: str, side: str, type: str, amount,
+                 price=None, exchange_order_id: str = None, status: str = NEW, filled=0, average=None,
+                 signal_ids: list = None, created_at: datetime = None, updated_at: datetime = None):
+        if status not in self.TRANSITIONS:
+            raise ValueError(f"{self.__class__.__name__}: unknown status {status}")
+        self.client_order_id = client_order_id
+        self.exchange_order_id = exchange_order_id
+        self.account = account
+        self.symbol = symbol
+        self.side = side
+        self.type = type
+        self.amount = Decimal(str(amount))
+        self.price = Decimal(str(price)) if price is not None else None
+        self.status = status
+        self.filled = Decimal(str(filled))
+        self.average = Decimal(str(average)) if average is not None else None
+        self.signal_ids = signal_ids or []
+        # datetimes arrive as ISO strings from JSON
+        self.created_at = datetime.fromisoformat(created_at) if isinstance(created_at, str) else (created_at or datetime.now())
+        self.updated_at = datetime.fromisoformat(updated_at) if isinstance(updated_at, str) else (updated_at or self.created_at)
+
+    @classmethod
+    def get_tablename(cls):
+        # name of the list in app.ctx (orders are not stored in the database)
+        return "orders"
+
+    @property
+    def primary_key(self):
+        return self.client_order_id
+
+    @property
+    def is_final(self) -> bool:
+        return self.status in self.FINAL_STATUSES
+
+    @property
+    def remaining(self) -> Decimal:
+        return max(self.amount - self.filled, Decimal(0))
+
+    def transition(self, status: str, filled=None, average=None, exchange_order_id: str = None) -> bool:
+        """moves the order to status (with the cumulative filled amount), returns True if anything changed"""
+        filled = self.filled if filled is None else Decimal(str(filled))
+        if filled < self.filled:
+            # exchanges report cumulative fills, an older report must not undo a newer one
+            filled = self.filled
+        if status == self.status and filled == self.filled and (exchange_order_id is None or exchange_order_id == self.exchange_order_id):
+            return False
+        if status != self.status and status not in self.TRANSITIONS[self.status]:
+            raise ValueError(f"{self.__class__.__name__} {self.client_order_id}: invalid transition {self.status} -> {status}")
+        self.status = status
+        self.filled = filled
+        if average is not None:
+            self.average = Decimal(str(average))
+        if exchange_order_id is not None:
+            self.exchange_order_id = exchange_order_id
+        self.updated_at = datetime.now()
+        return True
 
 class Exchange(OurBaseMemoryModel):
     pass
@@ -210,7 +290,7 @@ class OurGenericList(List):
             if not inspect.isclass(force_item_class):
                 raise ValueError(f"{self.__class__.__name__} requires the force_item_class argument to be a class, not {type(force_item_class)}")
             self.item_class = force_item_class
-        if len(args) == 1:
+        if len(args) == 1 and len(args[0]) > 0:
             if type(args[0][0]) == dict and force_item_class is None:
                 raise ValueError(f"{self.__class__.__name__} requires the force_item_class argument if it is given a list of dict items (got None)")
             if force_item_class is None:
@@ -359,4 +439,201 @@ class OurGenericList(List):
     def pks(self):
         return [item.pk for item in self]
 
-    pass
\ No newline at end of file
+    pass
+
+
+# --------------------------------------------------------------------------------------------
+class OurWindowedList:
+    # Sliding window cache for append-mostly tables (signals), ordered by a time index on
+    # (time_field, pk):
+    #   - items are kept sorted by (time, pk), in-order appends are O(1), late arrivals
+    #     (e.g. from batched inserts) are inserted at their place
+    #   - at most max_rows items and only items not older than max_age are kept, eviction
+    #     from the old end moves a head offset (amortized O(1), storage compacted lazily)
+    #   - range(since, until) and latest(n) cost O(log n + k)
+    #   - an index pk -> (time, pk) finds items by primary key in O(log n), upsert() uses
+    #     it (positions change with every insert and eviction, never keep them around)
+    #
+    # Offers the parts of the OurGenericList interface used by the workers and routes.
+
+    def __init__(self, *args, force_item_class=None, time_field="received_at", max_rows=None, max_age=None):
+        self.item_class = force_item_class
+        self.time_field = time_field
+        self.max_rows = max_rows
+        self.max_age = max_age          # timedelta or None
+        self._keys = []                 # (time, pk), sorted
+        self._items = []                # same positions as _keys
+        self._head = 0                  # _keys[:_head] / _items[:_head] are evicted
+        self._key_by_pk = {}            # pk -> key of the items not evicted
+        if len(args) == 1:
+            self.extend(OurGenericList(*args, force_item_class=force_item_class))
+        elif len(args) > 1:
+            raise ValueError(f"{self.__class__.__name__} can only be called with a single list argument, not {len(args)}")
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __iter__(self):
+        return iter(self._items[self._head:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._items[self._head:][index]
+        return self._items[self._position(index)]
+
+    def __setitem__(self, index, item):
+        # replacing an item with a different time moves it to its new place
+        position = self._position(index)
+        key = self._key(item)
+        if key == self._keys[position]:
+            self._items[position] = item
+        else:
+            self._delete(position)
+            self._insert(key, item)
+
+    def _position(self, index: int) -> int:
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError(f"{self.__class__.__name__} index out of range")
+        return self._head + index
+
+    def get_time(self, item) -> datetime:
+        value = getattr(item, self.time_field)
+        # items received as JSON carry ISO strings
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value
+
+    def _key(self, item):
+        pk = item.pk
+        return (self.get_time(item), pk if pk is not None else 0)
+
+    def _find(self, primary_key):
+        """position of the item with primary_key or None"""
+        key = self._key_by_pk.get(primary_key)
+        if key is None:
+            return None
+        position = bisect_left(self._keys, key, lo=self._head)
+        if position < len(self._keys) and self._keys[position] == key:
+            return position
+        return None
+
+    def _unindex(self, key):
+        # a duplicate of the primary key (added twice) must not unindex the current item
+        if self._key_by_pk.get(key[1]) == key:
+            del self._key_by_pk[key[1]]
+
+    def _delete(self, position: int):
+        self._unindex(self._keys[position])
+        del self._keys[position]
+        del self._items[position]
+
+    def _insert(self, key, item):
+        if item.pk is not None:
+            self._key_by_pk[item.pk] = key
+        if len(self._keys) == self._head or key >= self._keys[-1]:
+            self._keys.append(key)
+            self._items.append(item)
+        else:
+            position = bisect_right(self._keys, key, lo=self._head)
+            self._keys.insert(position, key)
+            self._items.insert(position, item)
+
+    def _drop_head(self, count: int):
+        for key in self._keys[self._head:self._head + count]:
+            self._unindex(key)
+        self._head += count
+        # compact once the evicted part dominates
+        if self._head > 1024 and self._head * 2 > len(self._keys):
+            del self._keys[:self._head]
+            del self._items[:self._head]
+            self._head = 0
+
+    def append(self, item):
+        if self.item_class is None:
+            self.item_class = type(item)
+        if not isinstance(item, self.item_class):
+            raise TypeError(f"{self.__class__.__name__} can only contain {self.item_class.__name__} objects, not {type(item)}")
+        self._insert(self._key(item), item)
+        if self.max_rows is not None and len(self) > self.max_rows:
+            self._drop_head(len(self) - self.max_rows)
+
+    def upsert(self, item) -> bool:
+        """replaces the item with the same primary key or appends it, returns True if appended"""
+        position = self._find(item.pk) if item.pk is not None else None
+        if position is None:
+            self.append(item)
+            return True
+        if not isinstance(item, self.item_class):
+            raise TypeError(f"{self.__class__.__name__} can only contain {self.item_class.__name__} objects, not {type(item)}")
+        key = self._key(item)
+        if key == self._keys[position]:
+            self._items[position] = item
+        else:
+            self._delete(position)
+            self._insert(key, item)
+        return False
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+        self.evict()
+
+    def clear(self):
+        self._keys = []
+        self._items = []
+        self._head = 0
+        self._key_by_pk = {}
+
+    def evict(self, now: datetime = None) -> int:
+        """drop items older than max_age, returns the number of dropped items"""
+        if self.max_age is None or len(self) == 0:
+            return 0
+        cutoff = (now or datetime.now()) - self.max_age
+        dropped = bisect_left(self._keys, (cutoff,), lo=self._head) - self._head
+        if dropped > 0:
+            self._drop_head(dropped)
+        return dropped
+
+    def covers_since(self, now: datetime = None) -> Optional[datetime]:
+        """oldest point in time for which the window is known to be complete (None: since ever)"""
+        if self.max_rows is not None and len(self) >= self.max_rows:
+            return self._keys[self._head][0]
+        if self.max_age is not None:
+            return (now or datetime.now()) - self.max_age
+        return None
+
+    def range(self, since: datetime = None, until: datetime = None) -> list:
+        """items with since <= time <= until (both optional), oldest first"""
+        start = self._head if since is None else bisect_left(self._keys, (since,), lo=self._head)
+        end = len(self._keys) if until is None else bisect_right(self._keys, (until, float("inf")), lo=start)
+        return self._items[start:end]
+
+    def latest(self, count: int) -> list:
+        """the count most recent items, oldest first"""
+        if count <= 0:
+            return []
+        return self._items[max(self._head, len(self._items) - count):]
+
+    def find_by_match_criteria(self, **kwargs):
+        match_list = OurGenericList(force_item_class=self.item_class)
+        for item in self:
+            if item.match_criteria(**kwargs):
+                match_list.append(item)
+        return match_list
+
+    def pks(self):
+        return [item.pk for item in self]
+
+    def remove_pk(self, primary_key) -> None:
+        position = self._find(primary_key)
+        if position is not None:
+            self._delete(position)
+
+    def to_dict(self):
+        return { "item_class": self.item_class.__name__, "items": [item.to_dict() for item in self] }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True, default=datetime_serializer, use_decimal=True)
@@ -1,20 +1,28 @@
 import asyncio
-from app.utils.redis_config import redis_conn
+from datetime import date, datetime, timedelta
 import simplejson as json
 import logging
 import multiprocessing
 import os
-import redis.asyncio
+import time
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import aliased, sessionmaker
+from sqlalchemy import inspect
 from sqlalchemy.future import select
 from sqlalchemy.dialects.postgresql import insert
 
 # project imports
 import config
 from app.models_mem import OurGenericList
-from app.models_db import Account, Signal, WebSource
+from app.models_db import Account, Position, Signal, Trade, WebSource
+from app.services.execution_store import ExecutionBuffer
+from app.utils.profiling import start_profile_task
+from app.utils.redis_config import close_redis, get_redis
+from app.utils.transport import close_channels, get_channels
+from app.utils.partitions import DEFAULT_PARTITION, drop_expired_partitions, ensure_partitions, is_partitioned, list_partitions, prune_default_partition
 from app.utils.serializer import datetime_serializer
+from app.utils.sharding import DB_CHANNEL, shard_channel
+from app.utils.snapshot import snapshot_to_dict, write_snapshot_file
 import logging
 
 # project definitions and globals
@@ -23,17 +31,26 @@ logger = logging.getLogger("sanic.root.db")
 # ------------------------------------------------------------------------------
 
 class DBProcess:
-    def __init__(self):
-        self.redis_conn = None
-        self.redis_pubsub = None
+    def __init__(self, shard_index: int = 0, shard_count: int = 1):
+        # shard 0 owns the schema, the initial data and the broadcasts to the workers
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.channel = shard_channel(DB_CHANNEL, shard_index)
+        self.channels = None
+        self.pubsub = None
         self.engine = None
         self.AsyncSessionLocal = None
+        self.snapshot_written_at = 0.0
+        self.snapshot_dirty = True              # accounts, signals or websources written since the last snapshot file
+        self.snapshot_changes_seen = None       # counter of the other shards' writes at the last snapshot file
+        self.partitions_maintained_at = 0.0
+        self.executions = ExecutionBuffer()
 
     async def broadcast(self, db_class):
         try:
             logger.debug(f"DB Process: fetching all {db_class.get_tablename()} from database...")
             async for session in self.get_async_session():
-                item_locations = await session.execute(select(db_class))
+                item_locations = await session.execute(self.select_for_workers(db_class))
                 items_objects = item_locations.scalars().all()
                 logger.debug(f"DB Process: fetched {len(items_objects)} {db_class.get_tablename()} from database with FIRST element of type {type(items_objects[0])}")
                 items = OurGenericList(items_objects, force_item_class=db_class)
@@ -46,24 +63,32 @@ class DBProcess:
         if len(items) > 0:
             try:            
                 logger.debug(f"DB Process: publishing {len(items)} {db_class.get_tablename()} to workers_channel...")
-                await self.redis_conn.publish("workers_channel", json.dumps({
+                await self.channels.publish("workers_channel", json.dumps({
                     "operation": "INITIALIZE",
                     "item_list": items.to_json()},    # to_dict() does not work here: Input string must be text, not bytes
                     sort_keys=True, default=datetime_serializer, use_decimal=True))
             except Exception as e:
                 logger.error(f"DB Process: failed to publish {db_class.get_tablename()}: {e}")
 
+    async def build_snapshot(self):
+        """returns (snapshot_version, {tablename: OurGenericList}) with the current content of all tables"""
+        snapshot_version = time.time_ns()
+        tables = {}
+        async for session in self.get_async_session():
+            for db_class in [Account, Signal, WebSource]:
+                result = await session.execute(self.select_for_workers(db_class))
+                tables[db_class.get_tablename()] = OurGenericList(list(result.scalars().all()), force_item_class=db_class)
+        return snapshot_version, tables
+
     async def db_add_initial_data(self):
         # Add default rows to the database if table is empty
         async for session in self.get_async_session():
             for cls in [Account, Signal, WebSource]:
-                items = await session.execute(select(cls))
-                items = items.scalars().all()
-                if len(items) == 0:
+                items = await session.execute(select(cls).limit(1))
+                if items.scalars().first() is None:
                     logger.debug(f"DB Process: adding default {cls.get_tablename()} to database...")
                     if cls.__name__ in config.DATABASE['initial_data']:
-                        for item in config.DATABASE['initial_data'][cls.__name__]:
-                            await cls(**item).insert(session)
+                        await cls.bulk_upsert(session, config.DATABASE['initial_data'][cls.__name__])
 
     async def db_connect(self):
         # Connecting to database
@@ -81,31 +106,190 @@ class DBProcess:
             logger.debug("DB Process: creating tables if missing...")
             await conn.run_sync(Account.metadata.create_all)
             await conn.run_sync(Signal.metadata.create_all)
+            await conn.run_sync(Trade.metadata.create_all)
+            await conn.run_sync(Position.metadata.create_all)
             await conn.run_sync(WebSource.metadata.create_all)
 
+    async def db_wait_for_tables(self):
+        # shards > 0 must not write before shard 0 has created the tables (and the default partition)
+        tablenames = [db_class.get_tablename() for db_class in [Account, Signal, Trade, Position, WebSource]]
+        while True:
+            try:
+                async with self.engine.connect() as conn:
+                    missing = await conn.run_sync(
+                        lambda sync_conn: [name for name in tablenames if not inspect(sync_conn).has_table(name)])
+                    if len(missing) == 0 and (not await is_partitioned(conn) or DEFAULT_PARTITION in await list_partitions(conn)):
+                        return
+                logger.debug(f"DB Process {self.shard_index}: waiting for shard 0 to create the schema (missing: {missing or DEFAULT_PARTITION})")
+            except Exception as e:
+                logger.warning(f"DB Process {self.shard_index}: waiting for the database: {e}")
+            await asyncio.sleep(config.PROCESSES['schema_wait_interval'])
+
+    async def db_maintain_partitions(self):
+        # create upcoming daily partitions of signals and drop the expired ones (and expired strays of the default partition)
+        self.partitions_maintained_at = time.monotonic()
+        try:
+            async with self.engine.begin() as conn:
+                if not await is_partitioned(conn):
+                    logger.warning("DB Process: table signals is not partitioned, skipping partition maintenance (see sql/db_schema.sql)")
+                    return
+                today = date.today()
+                await ensure_partitions(conn, today, config.SIGNALS['partition_days_ahead'])
+                dropped = await drop_expired_partitions(conn, today, config.SIGNALS['retention_days'])
+                if len(dropped) > 0:
+                    logger.info(f"DB Process: dropped {len(dropped)} expired signals partitions")
+                pruned = await prune_default_partition(conn, today, config.SIGNALS['retention_days'])
+                if pruned > 0:
+                    logger.info(f"DB Process: deleted {pruned} expired signals from {DEFAULT_PARTITION}")
+        except Exception as e:
+            logger.error(f"DB Process: partition maintenance failed: {e}")
+
     async def db_set_loglevel(self):
         # Check and set the level for all handlers attached to this logger
         sqlalchemy_logger = logging.getLogger('sqlalchemy.engine.Engine')
         for handler in sqlalchemy_logger.handlers:
             handler.setLevel(logging.WARNING)
 
+    def select_for_workers(self, db_class):
+        # workers only cache a sliding window of the signals, older ones are read on demand
+        if db_class is not Signal:
+            return select(db_class)
+        cutoff = datetime.now() - timedelta(hours=config.SIGNALS['cache_max_age_hours'])
+        latest = (select(Signal)
+                  .where(Signal.received_at >= cutoff)
+                  .order_by(Signal.received_at.desc(), Signal.id.desc())
+                  .limit(config.SIGNALS['cache_max_rows'])
+                  .subquery())
+        signal_alias = aliased(Signal, latest)
+        return select(signal_alias).order_by(latest.c.received_at, latest.c.id)
+
     async def get_async_session(self):
         async with self.AsyncSessionLocal() as session:
             yield session
 
-    async def redis_setup(self):
-        logger.debug("DB process: initializing redis...")
-        redis_url = os.getenv("REDIS_URL", "redis://localhost")
-        self.redis_conn = await redis.asyncio.from_url(redis_url)
-        self.redis_pubsub = self.redis_conn.pubsub()
-        await self.redis_pubsub.subscribe("db_channel")
+    async def channels_setup(self):
+        logger.debug(f"DB process: subscribing to {self.channel} ({config.TRANSPORT['kind']} transport)...")
+        self.channels = get_channels()
+        self.pubsub = self.channels.pubsub()
+        await self.pubsub.subscribe(self.channel)
+
+    async def shutdown(self):
+        logger.debug("DB Process: shutting down...")
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        await close_channels()
+        await close_redis()
+        if self.engine is not None:
+            await self.engine.dispose()
 
     async def setup(self):
-        await self.redis_setup()
+        await self.channels_setup()
         await self.db_set_loglevel()
         await self.db_connect()
-        await self.db_create_tables()
-        await self.db_add_initial_data()
+        if self.shard_index == 0:
+            await self.db_create_tables()
+            await self.db_maintain_partitions()
+            await self.db_add_initial_data()
+        else:
+            await self.db_wait_for_tables()
+
+    async def op_upsert(self, item_list: OurGenericList):
+        operation="UPSERT"
+        db_class = item_list.item_class
+        if db_class not in [Account, Signal, WebSource]:
+            raise ValueError(f"DB Process: {operation}: received list with bad item_class {db_class}")
+        logger.debug(f"DB Process: {operation}: upserting {len(item_list)} {db_class.get_tablename()}...")
+        async for session in self.get_async_session():
+            keys = await db_class.bulk_upsert(session, item_list)
+            # read the rows back (database defaults and serial keys) and publish them as one delta
+            pk_column = inspect(db_class).primary_key[0]
+            upserted = OurGenericList(force_item_class=db_class)
+            for chunk_start in range(0, len(keys), config.DATABASE['bulk_chunk_size']):
+                result = await session.execute(select(db_class).where(
+                    pk_column.in_(keys[chunk_start:chunk_start + config.DATABASE['bulk_chunk_size']])))
+                upserted.extend(result.scalars().all())
+        await self.mark_changed()
+
+        if len(upserted) > 0:
+            logger.debug(f"DB Process: {operation}: publishing {len(upserted)} {db_class.get_tablename()} to workers...")
+            await self.channels.publish("workers_channel", json.dumps({
+                "operation": "UPSERT",
+                "item_list": upserted.to_json()},
+                sort_keys=True, default=datetime_serializer, use_decimal=True))
+        return keys
+
+    async def op_persist_executions(self, message_data: dict):
+        operation="PERSIST_EXECUTIONS"
+        if not self.executions.has_room(message_data) and not self.executions.backing_off():
+            await self.flush_executions()
+        if not self.executions.add(message_data):
+            logger.warning(f"DB Process: {operation}: buffer full, refusing batch {message_data['batch_id']} (will be resent)")
+        elif self.executions.rows >= self.executions.flush_rows:
+            await self.flush_executions()
+
+    async def flush_executions(self):
+        written, dead = await self.executions.flush(self.engine)
+        if len(written) + len(dead) == 0:
+            return
+        logger.debug(f"DB Process: wrote {len(written)} execution batches ({len(dead)} dead lettered), acknowledging...")
+        acks = {}
+        for batch_id, reply_channel, trades, positions in written + dead:
+            ack = acks.setdefault(reply_channel, {"operation": "PERSISTED", "batch_ids": [], "dead_lettered": [], "trades": 0, "positions": 0})
+            ack["batch_ids"].append(batch_id)
+        for batch_id, reply_channel, trades, positions in written:
+            acks[reply_channel]["trades"] += len(trades)
+            acks[reply_channel]["positions"] += len(positions)
+        for batch_id, reply_channel, trades, positions in dead:
+            # no use resending these, they are in the dead letter file
+            acks[reply_channel]["dead_lettered"].append(batch_id)
+        for reply_channel, ack in acks.items():
+            try:
+                await self.channels.publish(reply_channel, json.dumps(ack))
+            except Exception as e:
+                # the batches are resent and skipped as duplicates
+                logger.error(f"DB Process: failed to acknowledge {len(ack['batch_ids'])} execution batches to {reply_channel}: {e}")
+
+    async def op_snapshot(self, reply_channel: str):
+        operation="SNAPSHOT_REQUEST"
+        snapshot_version, tables = await self.build_snapshot()
+        logger.debug(f"DB Process: {operation}: sending snapshot {snapshot_version} to {reply_channel}...")
+        await self.channels.publish(reply_channel, json.dumps(
+            {"operation": "SNAPSHOT", **snapshot_to_dict(snapshot_version, tables)},
+            sort_keys=True, default=datetime_serializer, use_decimal=True))
+
+    async def mark_changed(self):
+        # shard 0 writes the snapshot file, the other shards tell it about their writes through redis
+        self.snapshot_dirty = True
+        if self.shard_index != 0:
+            try:
+                await get_redis().incr(config.SNAPSHOT['changes_key'])
+            except Exception as e:
+                logger.warning(f"DB Process {self.shard_index}: failed to count change for the snapshot file: {e}")
+
+    async def snapshot_changed(self) -> bool:
+        if self.shard_count > 1:
+            try:
+                changes = await get_redis().get(config.SNAPSHOT['changes_key'])
+            except Exception as e:
+                logger.warning(f"DB Process: failed to read the changes of the other shards, assuming some: {e}")
+                return True
+            if changes != self.snapshot_changes_seen:
+                self.snapshot_changes_seen = changes
+                self.snapshot_dirty = True
+        return self.snapshot_dirty
+
+    async def write_snapshot(self):
+        # local snapshot file for the warm start of workers (written by shard 0 only)
+        # changes while the snapshot is built mark it dirty again
+        self.snapshot_dirty = False
+        try:
+            snapshot_version, tables = await self.build_snapshot()
+            await asyncio.to_thread(write_snapshot_file, config.SNAPSHOT['path'], snapshot_version, tables)
+            logger.debug(f"DB Process: wrote snapshot {snapshot_version} to {config.SNAPSHOT['path']}")
+        except Exception as e:
+            logger.error(f"DB Process: failed to write snapshot file {config.SNAPSHOT['path']}: {e}")
+            self.snapshot_dirty = True
+        self.snapshot_written_at = time.monotonic()
 
     async def op_insert(self, signal_list: OurGenericList):
         operation="INSERT_SIGNAL"
@@ -117,9 +301,10 @@ class DBProcess:
                 await signal.insert(session)
                 await session.commit()
                 await session.refresh(signal)
+        await self.mark_changed()
 
         logger.debug(f"DB Process: {operation}: publishing {len(signal_list)} signals to workers...")
-        await self.redis_conn.publish("workers_channel", json.dumps({
+        await self.channels.publish("workers_channel", json.dumps({
             "operation": "ADD",
             "item_list": signal_list.to_json()},    # to_dict() does not work here: Input string must be text, not bytes
             sort_keys=True, default=datetime_serializer, use_decimal=True))
@@ -131,47 +316,81 @@ class DBProcess:
         # Initialization
         await self.setup()
 
-        # read database and publish all data to all workers
-        await self.broadcast(Account)
-        await self.broadcast(Signal)
-        await self.broadcast(WebSource)
+        try:
+            # read database and publish all data to all workers
+            if self.shard_index == 0:
+                await self.broadcast(Account)
+                await self.broadcast(Signal)
+                await self.broadcast(WebSource)
+                await self.write_snapshot()
 
-        while True:
-            # Check for new messages on the `db_channel` channel
-            message = await self.redis_pubsub.get_message(ignore_subscribe_messages=True)
-            if message is not None and message["type"] == "message":
-
-                # parse message data (expected to be in JSON format)
-                try:
-                    message_data = json.loads(message['data'], use_decimal=True)
-                except Exception as e:
-                    logger.error(f"DB Process: failed to parse JSON message: {e}")
-                    continue
-
-                # verify
-                if "operation" not in message_data:
-                    logger.error(f"DB Process: received message without operation: {message}")
-                    continue
-                operation = message_data["operation"]
-
-                # STOP
-                if operation == "STOP":
-                    break
-
-                # ------------------------------
-                if operation == "INSERT_SIGNAL":
+            while True:
+                if self.shard_index == 0 and time.monotonic() - self.snapshot_written_at > config.SNAPSHOT['write_interval']:
+                    if await self.snapshot_changed():
+                        await self.write_snapshot()
+                    else:
+                        self.snapshot_written_at = time.monotonic()
+                if self.shard_index == 0 and time.monotonic() - self.partitions_maintained_at > config.SIGNALS['maintenance_interval']:
+                    await self.db_maintain_partitions()
+                if self.executions.due():
+                    await self.flush_executions()
+
+                # Check for new messages on the `db_channel` channel
+                # wait up to 100ms for the next message (instead of sleeping after each one)
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if message is not None and message["type"] == "message":
+
+                    # parse message data (expected to be in JSON format)
                     try:
-                        ourlist = OurGenericList.from_json(message_data["item_list"])
-                        await self.op_insert(ourlist)
+                        message_data = json.loads(message['data'], use_decimal=True)
                     except Exception as e:
-                        logger.error(f"DB Process: ignoring message INSERT_SIGNAL due to error: {e}")
-                elif operation == "STOP":
-                    break 
+                        logger.error(f"DB Process: failed to parse JSON message: {e}")
+                        continue
+
+                    # verify
+                    if "operation" not in message_data:
+                        logger.error(f"DB Process: received message without operation: {message}")
+                        continue
+                    operation = message_data["operation"]
+
+                    # STOP
+                    if operation == "STOP":
+                        break
 
-            # Sleep for a short time to avoid blocking the event loop
-            await asyncio.sleep(0.1)
+                    # ------------------------------
+                    if operation == "INSERT_SIGNAL":
+                        try:
+                            ourlist = OurGenericList.from_json(message_data["item_list"])
+                            await self.op_insert(ourlist)
+                        except Exception as e:
+                            logger.error(f"DB Process: ignoring message INSERT_SIGNAL due to error: {e}")
+                    elif operation == "UPSERT":
+                        try:
+                            ourlist = OurGenericList.from_json(message_data["item_list"])
+                            await self.op_upsert(ourlist)
+                        except Exception as e:
+                            logger.error(f"DB Process: ignoring message UPSERT due to error: {e}")
+                    elif operation == "PERSIST_EXECUTIONS":
+                        try:
+                            await self.op_persist_executions(message_data)
+                        except Exception as e:
+                            logger.error(f"DB Process: ignoring message PERSIST_EXECUTIONS due to error: {e}")
+                    elif operation == "PROFILE":
+                        start_profile_task(self.channels, message_data, f"DB Process {self.shard_index}")
+                    elif operation == "SNAPSHOT_REQUEST":
+                        try:
+                            await self.op_snapshot(message_data["reply_channel"])
+                        except Exception as e:
+                            logger.error(f"DB Process: ignoring message SNAPSHOT_REQUEST due to error: {e}")
+                    elif operation == "STOP":
+                        break 
+        finally:
+            # after a planned stop nobody resends what is still buffered
+            if self.engine is not None:
+                await self.flush_executions()
+            await self.shutdown()
 
-def db_process():
+def db_process(shard_index: int = 0, shard_count: int = 1):
     """Run the async db process using asyncio.run."""
-    db_process_instance = DBProcess()
+    db_process_instance = DBProcess(shard_index=shard_index, shard_count=shard_count)
     asyncio.run(db_process_instance.run())
\ No newline at end of file
@@ -2,45 +2,421 @@ import simplejson as json
 import logging
 import multiprocessing
 import asyncio
-from app.utils.redis_config import redis_conn
-from app.models_db import Signal
+import ccxt.async_support as ccxt_async
+from decimal import Decimal
+import config
+from app.models_db import Position, Signal
+from app.models_mem import OurGenericList, Order
+from app.services.exchange_adapter import RateLimitedAdapter, SimulatedExchangeAdapter
+from app.services.execution_store import ExecutionRecorder
+from app.services.netting import net_signals
+from app.services.order_tracker import OrderTracker
+from app.services.paper_exchange import PaperExchange, PaperFeed, load_price_feed, replay_price_feed
+from app.services.risk import REJECT, PreTradeRisk
+from app.utils.database import AsyncSessionLocal
+from app.utils.markets_cache import MarketsCache
+from app.utils.profiling import start_profile_task
+from app.utils.rate_limiter import get_rate_limiter
+from app.utils.redis_config import close_redis
+from app.utils.transport import close_channels, get_channels
+from app.utils.serializer import datetime_serializer
+from app.utils.sharding import BROKER_CHANNEL, db_channel_for, shard_channel, shard_index
 import os
-import redis.asyncio
+from sqlalchemy import select
 
 logger = logging.getLogger("sanic.root.exch")
 
-async def exch_process_async():
+class ExchProcess:
+    # Every routing key (account, or symbol if the message names no account) gets its own
+    # queue and consumer task: orders for one key are executed in order while a slow
+    # exchange account does not hold back the orders of the others. The orders are placed
+    # with the adapter of the account (None for signals without one, simulated / paper
+    # adapters only), the routing key is not an account.
+    #
+    # With config.EXCHANGE['netting_enabled'] a consumer collects the signals of its key for
+    # the netting window and sends one net order per symbol (see app/services/netting.py).
+    #
+    # Sent orders are followed by the OrderTracker until they are final, status changes are
+    # published to the workers as UPSERTs of their `orders` list.
+    #
+    # With config.RISK['enabled'] the orders pass the pre-trade risk checks first (see
+    # app/services/risk.py), rejected ones are not sent, resized ones are sent smaller.
+    #
+    # Fills are sent to a DB process as trades and position snapshots and resent until
+    # they are acknowledged (see app/services/execution_store.py).
 
-    # Create a Redis connection
-    logger.debug("EXCH process: setting up redis and subscribing to broker_channel...")
-    redis_url = os.getenv("REDIS_URL", "redis://localhost")
-    redis_conn = await redis.asyncio.from_url(redis_url)
-    redis_conn = await redis.asyncio.from_url(redis_url)
-    redis_pubsub = redis_conn.pubsub()
-    await redis_pubsub.subscribe("broker_channel")
+    def __init__(self, shard_index: int = 0, shard_count: int = 1):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.channel = shard_channel(BROKER_CHANNEL, shard_index)
+        self.channels = None
+        self.pubsub = None
+        self.queues = {}
+        self.tasks = {}
+        self.markets_clients = {}       # exchange id -> public ccxt client refreshing the markets cache
+        self.account_clients = {}       # exchange id -> ccxt clients of the accounts (get the same markets)
+        self.markets_caches = {}
+        self.background_tasks = []
+        self.adapters = {}
+        self.paper_exchanges = []       # one per account, in order of creation
+        self.paper_ticks = None
+        self.order_tracker = OrderTracker(self.publish_orders)
+        self.risk = PreTradeRisk()
+        self.executions = ExecutionRecorder(self.channel)
 
-    while True:
-        message = await redis_pubsub.get_message(ignore_subscribe_messages=True)
-        if message is not None and message["type"] == "message":
-            logger.debug(f"EXCH Process received message: {message}")
+    async def channels_setup(self):
+        logger.debug(f"EXCH process: subscribing to {self.channel} ({config.TRANSPORT['kind']} transport)...")
+        self.channels = get_channels()
+        self.pubsub = self.channels.pubsub()
+        await self.pubsub.subscribe(self.channel)
 
-            message_data = json.loads(message['data'], use_decimal=True)
-            operation = message_data["operation"]
-            payload = message_data["payload"]
+    def get_markets_client(self, exchange_id: str):
+        # one public ccxt client per exchange keeps the shared on-disk markets cache fresh, the
+        # account clients get its markets so that orders can be placed right after startup
+        # (no load_markets on the hot path)
+        client = self.markets_clients.get(exchange_id)
+        if client is None:
+            client = getattr(ccxt_async, exchange_id)({'enableRateLimit': True})
+            markets_cache = self.markets_caches[exchange_id] = MarketsCache(exchange_id)
+            if not markets_cache.apply_to(client):
+                logger.warning(f"EXCH process: no cached markets for {exchange_id} yet, loading them in the background")
+            self.markets_clients[exchange_id] = client
+            self.account_clients[exchange_id] = []
+            self.background_tasks.append(asyncio.create_task(markets_cache.refresh_loop(client, self.account_clients[exchange_id])))
+        return client
 
-            if operation == "EXECUTE_TRADE":
-                signal = Signal.from_json(payload)
-                logger.debug(f"exch Trade Execution: {signal.__repr__()}")
+    def get_account_client(self, account: dict):
+        # authenticated client of one account, the weight limit of its API key is taken by the
+        # RateLimitedAdapter (shared by all exchange processes): ccxt throttles only without it
+        exchange_id = account['exchange_id']
+        credentials = config.CCXT['account_credentials'].get(account['name'], {})
+        if credentials.get('apiKey') is None or credentials.get('secret') is None:
+            raise ValueError(f"no API key for account {account['name']} (set {account['name'].upper()}_API_KEY and {account['name'].upper()}_SECRET)")
+        self.get_markets_client(exchange_id)
+        client = getattr(ccxt_async, exchange_id)({**credentials, 'enableRateLimit': not config.RATE_LIMITS['enabled']})
+        self.markets_caches[exchange_id].apply_to(client)
+        self.account_clients[exchange_id].append(client)
+        return client
 
-                # Simulate async exch API operation
-                await asyncio.sleep(1)
+    async def markets_setup(self):
+        # the simulated and paper adapters place no orders with ccxt, no markets to keep fresh
+        if config.EXCHANGE['adapter'] != "ccxt":
+            return
+        for exchange_id in config.CCXT['markets_cache_exchanges']:
+            try:
+                self.get_markets_client(exchange_id)
+            except Exception as e:
+                logger.error(f"EXCH process: failed to set up exchange client {exchange_id}: {e}")
 
-            elif operation == "STOP":
+    def get_adapter(self, account):
+        # ccxt client (or local stand-in with the same interface) executing the orders of an account
+        adapter = self.adapters.get(account)
+        if adapter is None:
+            if config.EXCHANGE['adapter'] == "ccxt":
+                accounts = {configured['name']: configured for configured in config.DATABASE['initial_data']['Account']}
+                if account not in accounts:
+                    raise ValueError(f"no account {account} configured for the ccxt adapter")
+                adapter = self.get_account_client(accounts[account])
+            elif config.EXCHANGE['adapter'] == "paper":
+                # separate books and balances per account
+                adapter = self.new_paper_exchange(account)
+            else:
+                adapter = SimulatedExchangeAdapter()
+            # the weight limit of an API key is shared with the other exchange processes (the local stand-ins have none)
+            if config.RATE_LIMITS['enabled'] and not isinstance(adapter, (PaperExchange, SimulatedExchangeAdapter)):
+                adapter = RateLimitedAdapter(adapter, get_rate_limiter(adapter.id, account))
+            self.adapters[account] = adapter
+        return adapter
+
+    def get_paper_ticks(self) -> list:
+        # the feed is loaded once, the real time replay starts with it and feeds every paper exchange
+        if self.paper_ticks is None:
+            self.paper_ticks = load_price_feed(config.EXCHANGE['paper_price_feed'])
+            logger.info(f"EXCH process: {len(self.paper_ticks)} ticks from {config.EXCHANGE['paper_price_feed']} ({config.EXCHANGE['paper_feed_mode']})")
+            if config.EXCHANGE['paper_feed_mode'] == "realtime":
+                if config.EXCHANGE['paper_feed_speed'] <= 0:
+                    logger.warning("EXCH process: paper_feed_speed 0 replays the feed before orders arrive (offline benchmarks only)")
+                self.background_tasks.append(asyncio.create_task(replay_price_feed(
+                    self.paper_exchanges, self.paper_ticks, config.EXCHANGE['paper_feed_speed'], loop=True)))
+        return self.paper_ticks
+
+    def new_paper_exchange(self, account) -> PaperExchange:
+        paper_exchange = PaperExchange(f"paper:{account or 'default'}")
+        if config.EXCHANGE['paper_price_feed'] is not None:
+            ticks = self.get_paper_ticks()
+            if config.EXCHANGE['paper_feed_mode'] == "stepped":
+                # each account walks through the feed with its own orders, independent of the sharding
+                paper_exchange.attach_feed(PaperFeed(ticks, loop=True), config.EXCHANGE['paper_feed_ticks_per_request'])
+        self.paper_exchanges.append(paper_exchange)
+        return paper_exchange
+
+    async def publish_orders(self, orders: list):
+        # the unfilled part of orders the exchange has given up on no longer counts as exposure
+        for order in orders:
+            if order.status in [Order.CANCELLED, Order.REJECTED] and order.exchange_order_id is not None:
+                self.risk.apply(order.account, order.symbol, order.side, -order.remaining)
+        # recorded first: the batch is resent until acknowledged, even if a publish fails
+        message = self.executions.record(orders)
+        if message is not None:
+            await self.publish_executions([message])
+        try:
+            await self.channels.publish("workers_channel", json.dumps({
+                "operation": "UPSERT",
+                "item_list": OurGenericList(list(orders), force_item_class=Order).to_json()},
+                sort_keys=True, default=datetime_serializer, use_decimal=True))
+        except Exception as e:
+            logger.error(f"EXCH process: failed to publish {len(orders)} changed orders to the workers: {e}")
+
+    async def load_positions(self):
+        # position snapshots continue from the latest persisted ones (the fills are not replayed)
+        for attempt in range(config.PERSISTENCE['load_positions_attempts']):
+            try:
+                async with AsyncSessionLocal() as session:
+                    result = await session.execute(select(Position)
+                        .distinct(Position.account, Position.symbol)
+                        .order_by(Position.account, Position.symbol, Position.updated_at.desc(), Position.id.desc()))
+                    positions = result.scalars().all()
+                self.executions.load_positions(positions)
+                # the risk limits count the positions traded by this shard (routed by account, else by symbol)
+                self.risk.load_positions([position for position in positions
+                                          if shard_index(position.account or position.symbol, self.shard_count) == self.shard_index])
+                logger.info(f"EXCH process: loaded {len(positions)} positions")
+                return
+            except Exception as e:
+                logger.warning(f"EXCH process: failed to load the positions (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(config.PROCESSES['schema_wait_interval'])
+        logger.error("EXCH process: starting without the persisted positions, position snapshots and risk exposure start from zero")
+
+    async def publish_executions(self, messages: list):
+        # the batches of this shard go to the DB shard of its channel name, the acks come back on self.channel
+        for message in messages:
+            try:
+                await self.channels.publish(db_channel_for(self.channel), json.dumps(
+                    message, default=datetime_serializer, use_decimal=True))
+            except Exception as e:
+                logger.error(f"EXCH process: failed to send execution batch {message['batch_id']} (will be resent): {e}")
+
+    async def resend_executions(self):
+        while True:
+            await asyncio.sleep(self.executions.ack_timeout / 2)
+            messages = self.executions.due_for_resend()
+            if len(messages) > 0:
+                logger.warning(f"EXCH process: resending {len(messages)} unacknowledged execution batches")
+                await self.publish_executions(messages)
+
+    async def collect_netting_window(self, queue: asyncio.Queue):
+        # everything arriving for this key within the netting window is executed together
+        collected = []
+        deadline = asyncio.get_running_loop().time() + config.EXCHANGE['netting_window_seconds']
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                collected.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
                 break
+        return collected
+
+    async def execute_signals(self, account, signals):
+        """executes the signals as one order per symbol (net quantity), returns one fill dict per signal"""
+        adapter = self.get_adapter(account)
+        if isinstance(adapter, PaperExchange) and config.EXCHANGE['paper_price_feed'] is None:
+            # without a recorded feed the signal prices are the ticks
+            for signal in signals:
+                if signal.price is not None:
+                    adapter.on_price(signal.symbol, float(signal.price))
+        net_orders = net_signals(signals)
+        to_send = [net_order for net_order in net_orders if net_order.side is not None]
+        amounts = [net_order.amount for net_order in to_send]
+        if config.RISK['enabled'] and len(to_send) > 0:
+            to_send, amounts = await self.risk_check(account, to_send)
+        tracked = [self.order_tracker.track(account, net_order.symbol, net_order.side, config.EXCHANGE['order_type'], amount,
+                                            signal_ids=[signal.id for signal, _, _ in net_order.signals]) for net_order, amount in zip(to_send, amounts)]
+        orders = [{
+            "symbol":   net_order.symbol,
+            "type":     config.EXCHANGE['order_type'],
+            "side":     net_order.side,
+            "amount":   float(order.amount),
+            "params":   {"clientOrderId": order.client_order_id}} for net_order, order in zip(to_send, tracked)]
+        logger.debug(f"EXCH process: {account}: executing {len(signals)} signals as {len(orders)} orders")
+
+        results = []
+        try:
+            if len(orders) > 1 and adapter.has.get("createOrders"):
+                results = await adapter.create_orders(orders)
+            else:
+                for order in orders:
+                    results.append(await adapter.create_order(order["symbol"], order["type"], order["side"], order["amount"], None, order["params"]))
+        except Exception as e:
+            # the orders sent before the failure are followed as usual
+            self.count_exposure(tracked[:len(results)], results)
+            await self.order_tracker.submitted(tracked[:len(results)], results)
+            await self.order_tracker.rejected(tracked[len(results):], str(e))
+            raise
+        self.count_exposure(tracked, results)
+        await self.order_tracker.submitted(tracked, results)
+
+        fills = []
+        sent_results = dict(zip([id(net_order) for net_order in to_send], results))
+        for net_order in net_orders:
+            result = sent_results.get(id(net_order))
+            if result is None:
+                fills.extend(net_order.allocate())
+            else:
+                average = result.get("average") or result.get("price")
+                fills.extend(net_order.allocate(
+                    filled=Decimal(str(result.get("filled") or 0)),
+                    average=Decimal(str(average)) if average is not None else None))
+        return fills
+
+    async def risk_check(self, account, net_orders: list):
+        """returns the net orders passing the pre-trade checks and their (possibly resized) amounts"""
+        for net_order in net_orders:
+            prices = [signal.price for signal, _, _ in net_order.signals if signal.price is not None]
+            if len(prices) > 0:
+                self.risk.update_price(net_order.symbol, prices[-1])
+        decisions = self.risk.check([(account, net_order.symbol, net_order.side, net_order.amount, None) for net_order in net_orders])
+        passed, amounts = [], []
+        for net_order, decision in zip(net_orders, decisions):
+            if decision.action == REJECT:
+                order = self.order_tracker.track(account, net_order.symbol, net_order.side, config.EXCHANGE['order_type'], net_order.amount,
+                                                 signal_ids=[signal.id for signal, _, _ in net_order.signals])
+                await self.order_tracker.rejected([order], f"risk check: {', '.join(decision.reason_codes)}")
+                continue
+            if decision.reasons != 0:
+                logger.warning(f"EXCH process: {account}: {net_order.symbol} resized from {net_order.amount} to {decision.amount}: {', '.join(decision.reason_codes)}")
+            passed.append(net_order)
+            amounts.append(decision.amount)
+        return passed, amounts
+
+    def count_exposure(self, orders: list, results: list):
+        # sent orders count in full until they are cancelled, fill prices update the recent prices
+        for order, result in zip(orders, results):
+            if result.get("status") == "rejected":
+                # refused by the exchange (e.g. one order of a batch), nothing to count
+                continue
+            self.risk.apply(order.account, order.symbol, order.side, order.amount)
+            self.risk.update_price(order.symbol, result.get("average") or result.get("price"))
+
+    async def key_consumer(self, key, account, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            if config.EXCHANGE['netting_enabled']:
+                batch.extend(await self.collect_netting_window(queue))
+            signals = [signal for signal, _ in batch]
+            try:
+                fills = {fill["signal_id"]: fill for fill in await self.execute_signals(account, signals)}
+                status = "executed"
+            except Exception as e:
+                logger.error(f"EXCH process: trade execution for {key} failed: {e}")
+                fills = {}
+                status = "failed"
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            # optional acknowledgement (e.g. for the replay harness)
+            for signal, reply_channel in batch:
+                if reply_channel is not None:
+                    try:
+                        await self.channels.publish(reply_channel, json.dumps({
+                            "operation": "TRADE_EXECUTED",
+                            "signal_id": signal.id,
+                            "status": status,
+                            "fill": fills.get(signal.id)}, use_decimal=True))
+                    except Exception as e:
+                        # a lost acknowledgement must not stop the consumer of this key
+                        logger.error(f"EXCH process: failed to acknowledge signal {signal.id} to {reply_channel}: {e}")
+
+    async def reject_signal(self, signal: Signal, reply_channel: str, reason: str):
+        logger.error(f"EXCH process: rejecting signal {signal.id} ({signal.symbol}): {reason}")
+        if reply_channel is not None:
+            try:
+                await self.channels.publish(reply_channel, json.dumps({
+                    "operation": "TRADE_EXECUTED",
+                    "signal_id": signal.id,
+                    "status": "rejected",
+                    "error": reason,
+                    "fill": None}, use_decimal=True))
+            except Exception as e:
+                logger.error(f"EXCH process: failed to acknowledge signal {signal.id} to {reply_channel}: {e}")
+
+    def dispatch(self, key, signal: Signal, reply_channel: str = None, account: str = None):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = asyncio.Queue()
+        task = self.tasks.get(key)
+        if task is None or task.done():
+            if task is not None and not task.cancelled() and task.exception() is not None:
+                logger.error(f"EXCH process: consumer of {key} died, restarting it: {task.exception()}")
+            # the queued signals are taken over by the new consumer
+            self.tasks[key] = asyncio.create_task(self.key_consumer(key, account, queue))
+        queue.put_nowait((signal, reply_channel))
+
+    async def shutdown(self):
+        tasks = [*self.tasks.values(), *self.background_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for adapter in self.adapters.values():
+            await adapter.close()
+        for client in self.markets_clients.values():
+            await client.close()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        await close_channels()
+        await close_redis()
+
+    async def run(self):
+        await self.channels_setup()
+        await self.markets_setup()
+        await self.load_positions()
+        if config.EXCHANGE['adapter'] == "paper" and config.EXCHANGE['paper_price_feed'] is not None:
+            self.get_paper_ticks()
+        self.background_tasks.append(asyncio.create_task(self.order_tracker.run(self.get_adapter)))
+        self.background_tasks.append(asyncio.create_task(self.resend_executions()))
+
+        try:
+            while True:
+                # wait up to 100ms for the next message (instead of sleeping after each one)
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if message is not None and message["type"] == "message":
+                    logger.debug(f"EXCH Process received message: {message}")
+
+                    try:
+                        message_data = json.loads(message['data'], use_decimal=True)
+                        operation = message_data["operation"]
+                    except Exception as e:
+                        logger.error(f"EXCH process: failed to parse message: {e}")
+                        continue
+
+                    if operation == "EXECUTE_TRADE":
+                        try:
+                            signal = Signal.from_json(message_data["payload"])
+                        except Exception as e:
+                            logger.error(f"EXCH process: ignoring EXECUTE_TRADE due to error: {e}")
+                            continue
+                        account = message_data.get("account") or config.EXCHANGE['default_account']
+                        if account is None and config.EXCHANGE['adapter'] == "ccxt":
+                            # real orders need an account
+                            await self.reject_signal(signal, message_data.get("reply_channel"), "no account")
+                            continue
+                        self.dispatch(account or signal.symbol, signal, message_data.get("reply_channel"), account)
+
+                    elif operation == "PERSISTED":
+                        self.executions.acknowledged(message_data["batch_ids"])
+                        if len(message_data.get("dead_lettered", [])) > 0:
+                            logger.error(f"EXCH process: execution batches not writable, see the DB process' dead letter file: {message_data['dead_lettered']}")
+
+                    elif operation == "PROFILE":
+                        start_profile_task(self.channels, message_data, f"EXCH process {self.shard_index}")
 
-        # Sleep for a short time to avoid blocking the event loop
-        await asyncio.sleep(0.1)
+                    elif operation == "STOP":
+                        break
+        finally:
+            await self.shutdown()
 
-def exch_process():
+def exch_process(shard_index: int = 0, shard_count: int = 1):
     """Run the async exch process using asyncio.run."""
-    asyncio.run(exch_process_async())
\ No newline at end of file
+    exch_process_instance = ExchProcess(shard_index=shard_index, shard_count=shard_count)
+    asyncio.run(exch_process_instance.run())
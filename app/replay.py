@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+from collections import Counter
+import csv
+from datetime import datetime
+from decimal import Decimal
+import hashlib
+import logging
+import os
+import simplejson as json
+import sys
+import time
+from types import SimpleNamespace
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# project imports
+from app.models_db import Signal
+from app.models_mem import OurGenericList, OurWindowedList
+from app.services.signal_stats import SignalStats
+from app.task_worker import apply_list_operation
+from app.utils.dedup import SignalDeduplicator
+from app.utils.redis_config import close_redis
+from app.utils.serializer import datetime_serializer
+from app.utils.sharding import broker_channel_for, db_channel_for
+from app.utils.transport import close_channels, get_channels
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.trading")
+
+# ------------------------------------------------------------------------------
+# Replays stored signals through the same path live signals take:
+#
+#   INSERT_SIGNAL -> DB process (op_insert) -> ADD on workers_channel -> worker apply
+#   (apply_list_operation on a local worker context) -> EXECUTE_TRADE -> exchange process
+#
+# Signals are sent on a simulated clock (--speed N replays N times faster than they were
+# received, --speed 0 as fast as possible). The report contains the throughput of every
+# stage and a digest of the resulting worker state, which must be identical between runs
+# of the same input (pass it to --expect-digest).
+#
+# The replayed signals are written to the database: run it against a scratch database.
+# --source db reads them from another database (--source-dsn), otherwise the next run would
+# read its own inserts too. Reading from the target database itself is only allowed with
+# --rebase and an --until in the past, which keeps the replayed copies out of the range.
+#
+#   python -m app.replay --source signals.csv --speed 0 --execute
+#   python -m app.replay --source db --source-dsn postgresql+asyncpg://.../live --since 2024-11-01T00:00:00 --speed 60
+
+FIELDS = ["strategy", "order_id", "action", "symbol", "price", "quantity", "received_at"]
+
+class SimulatedClock:
+    # maps the timestamps of the replayed signals to wall clock time
+
+    def __init__(self, start: datetime, speed: float):
+        self.start = start
+        self.speed = speed
+        self.wall_start = time.monotonic()
+
+    async def wait_until(self, timestamp: datetime):
+        if self.speed <= 0:
+            return
+        due = self.wall_start + (timestamp - self.start).total_seconds() / self.speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def signal_key(signal):
+    return (signal.strategy, signal.order_id, signal.symbol, signal.action)
+
+def load_signals_from_file(path: str):
+    # CSV with a header line or NDJSON (one signal object per line)
+    rows = []
+    with open(path, newline="") as dump_file:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(dump_file))
+        else:
+            rows = [json.loads(line, use_decimal=True) for line in dump_file if line.strip() != ""]
+    signals = []
+    for row in rows:
+        signals.append(Signal(
+            strategy=row["strategy"],
+            order_id=row.get("order_id"),
+            action=row["action"],
+            symbol=row["symbol"],
+            price=Decimal(str(row["price"])) if row.get("price") not in (None, "") else None,
+            quantity=Decimal(str(row["quantity"])) if row.get("quantity") not in (None, "") else None,
+            received_at=datetime.fromisoformat(str(row["received_at"]))))
+    return signals
+
+async def load_signals_from_db(since: datetime = None, until: datetime = None, dsn: str = None):
+    from sqlalchemy import select
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+
+    query = select(Signal)
+    if since is not None:
+        query = query.where(Signal.received_at >= since)
+    if until is not None:
+        query = query.where(Signal.received_at <= until)
+    if dsn is None:
+        from app.utils.database import AsyncSessionLocal
+        session_factory, engine = AsyncSessionLocal, None
+    else:
+        engine = create_async_engine(dsn)
+        session_factory = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+    try:
+        async with session_factory() as session:
+            result = await session.execute(query.order_by(Signal.received_at, Signal.id))
+            return [Signal(**{field: getattr(signal, field) for field in FIELDS}) for signal in result.scalars().all()]
+    finally:
+        if engine is not None:
+            await engine.dispose()
+
+def state_digest(ctx) -> str:
+    # database ids differ between runs, everything else must not
+    rows = sorted(
+        tuple(str(getattr(signal, field)) for field in FIELDS)
+        for signal in ctx.signals)
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update("\x1f".join(row).encode("utf-8"))
+        digest.update(b"\n")
+    digest.update(json.dumps(ctx.signal_stats.to_dict("all"), sort_keys=True, default=datetime_serializer, use_decimal=True).encode("utf-8"))
+    return digest.hexdigest()
+
+class ReplayHarness:
+
+    def __init__(self, signals, speed: float, batch_size: int = 1, execute: bool = False, rebase: bool = False, timeout: float = 60.0):
+        self.signals = sorted(signals, key=lambda signal: signal.received_at)
+        self.speed = speed
+        self.batch_size = batch_size
+        self.execute = execute
+        self.timeout = timeout
+        self.reply_channel = f"replay_channel.{os.getpid()}"
+        # a local worker context, fed by the same code as the Sanic workers
+        self.app = SimpleNamespace(ctx=SimpleNamespace(
+            signals=OurWindowedList(force_item_class=Signal),
+            signal_stats=SignalStats(),
+            signal_dedup=SignalDeduplicator()))
+        if rebase and len(self.signals) > 0:
+            shift = datetime.now() - self.signals[0].received_at
+            for signal in self.signals:
+                signal.received_at = signal.received_at + shift
+        self.expected_adds = Counter(signal_key(signal) for signal in self.signals)
+        self.added = 0
+        self.executions_sent = 0
+        self.executions_done = 0
+        self.timings = {}
+
+    async def publish_signals(self, channels):
+        if len(self.signals) == 0:
+            return
+        clock = SimulatedClock(self.signals[0].received_at, self.speed)
+        batch = []
+        for signal in self.signals:
+            await clock.wait_until(signal.received_at)
+            batch.append(signal)
+            if len(batch) >= self.batch_size:
+                await self.publish_batch(channels, batch)
+                batch = []
+        if len(batch) > 0:
+            await self.publish_batch(channels, batch)
+
+    async def publish_batch(self, channels, batch):
+        # one message per db shard, like the webhook does per signal
+        by_channel = {}
+        for signal in batch:
+            by_channel.setdefault(db_channel_for(signal.symbol), []).append(signal)
+        for channel, signals in by_channel.items():
+            await channels.publish(channel, json.dumps({
+                "operation": "INSERT_SIGNAL",
+                "item_list": OurGenericList(signals).to_json()},
+                sort_keys=True, default=datetime_serializer, use_decimal=True))
+
+    async def consume(self, channels, pubsub):
+        expected_count = sum(self.expected_adds.values())
+        while self.added < expected_count or (self.execute and self.executions_done < self.executions_sent):
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+            if message is None or message["type"] != "message":
+                continue
+            message_data = json.loads(message["data"], use_decimal=True)
+            operation = message_data.get("operation")
+
+            if operation == "ADD":
+                given_list = OurGenericList.from_json(message_data["item_list"])
+                if given_list.item_class is not Signal:
+                    continue
+                # live traffic may be mixed in, only count and apply our own signals
+                ours = OurGenericList(force_item_class=Signal)
+                for signal in given_list:
+                    key = signal_key(signal)
+                    if self.expected_adds[key] > 0:
+                        self.expected_adds[key] -= 1
+                        ours.append(signal)
+                if len(ours) == 0:
+                    continue
+                apply_list_operation(self.app, "ADD", ours, "Replay: ")
+                self.added += len(ours)
+                if self.added == expected_count:
+                    self.timings["applied"] = time.monotonic()
+                if self.execute:
+                    await self.send_executions(channels, ours)
+
+            elif operation == "TRADE_EXECUTED":
+                self.executions_done += 1
+                if self.executions_done == self.executions_sent and self.added == expected_count:
+                    self.timings["executed"] = time.monotonic()
+
+    async def send_executions(self, channels, signals):
+        for signal in signals:
+            if (signal.action or "").lower() not in ["buy", "sell"]:
+                continue
+            self.executions_sent += 1
+            await channels.publish(broker_channel_for(signal.symbol), json.dumps({
+                "operation": "EXECUTE_TRADE",
+                "payload": signal.to_json(),
+                "reply_channel": self.reply_channel}))
+
+    async def run(self):
+        channels = get_channels()
+        pubsub = channels.pubsub()
+        await pubsub.subscribe("workers_channel", self.reply_channel)
+        try:
+            self.timings["start"] = time.monotonic()
+            consumer = asyncio.create_task(self.consume(channels, pubsub))
+            await self.publish_signals(channels)
+            self.timings["published"] = time.monotonic()
+            try:
+                await asyncio.wait_for(consumer, self.timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Replay: timed out after {self.timeout}s ({self.added} signals applied, {self.executions_done}/{self.executions_sent} executions)")
+        finally:
+            await pubsub.aclose()
+            await close_channels()
+            await close_redis()
+        return self.report()
+
+    def report(self):
+        start = self.timings["start"]
+        def rate(count, stage):
+            if stage not in self.timings or self.timings[stage] <= start:
+                return None
+            return count / (self.timings[stage] - start)
+        return {
+            "signals":                  len(self.signals),
+            "applied":                  self.added,
+            "executions_sent":          self.executions_sent,
+            "executions_done":          self.executions_done,
+            "seconds_to_publish":       self.timings.get("published", start) - start,
+            "seconds_to_apply":         self.timings["applied"] - start if "applied" in self.timings else None,
+            "seconds_to_execute":       self.timings["executed"] - start if "executed" in self.timings else None,
+            "publish_per_second":       rate(len(self.signals), "published"),
+            "apply_per_second":         rate(self.added, "applied"),
+            "execute_per_second":       rate(self.executions_done, "executed"),
+            "state_digest":             state_digest(self.app.ctx)
+        }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay stored signals through the DB process, worker apply and exchange process.")
+    parser.add_argument("--source", required=True, help="'db' or the path of a .csv / .ndjson dump")
+    parser.add_argument("--source-dsn", default=None, help="database to read from with --source db (not the one replayed into)")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None, help="first received_at to replay (db only)")
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None, help="last received_at to replay (db only)")
+    parser.add_argument("--speed", type=float, default=0, help="N times faster than recorded, 0 = as fast as possible")
+    parser.add_argument("--batch", type=int, default=1, help="signals per INSERT_SIGNAL message")
+    parser.add_argument("--execute", action="store_true", help="send buy/sell signals on to the exchange process")
+    parser.add_argument("--rebase", action="store_true", help="shift received_at so that the replay starts now")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the pipeline after publishing")
+    parser.add_argument("--expect-digest", default=None, help="fail unless the resulting state has this digest")
+    args = parser.parse_args(argv)
+    if args.source == "db" and args.source_dsn in [None, os.getenv("DATABASE_URL")]:
+        # the replayed copies must not show up in the next run's input
+        if not args.rebase or args.until is None or args.until >= datetime.now():
+            parser.error("--source db reads the database replayed into: pass --source-dsn, or --rebase with an --until in the past")
+        args.source_dsn = None
+    elif args.source != "db" and args.source_dsn is not None:
+        parser.error("--source-dsn requires --source db")
+    return args
+
+async def replay_main(args):
+    if args.source == "db":
+        signals = await load_signals_from_db(args.since, args.until, args.source_dsn)
+    else:
+        signals = load_signals_from_file(args.source)
+    logger.info(f"Replay: replaying {len(signals)} signals at speed {args.speed or 'max'}")
+    harness = ReplayHarness(signals, speed=args.speed, batch_size=args.batch, execute=args.execute, rebase=args.rebase, timeout=args.timeout)
+    return await harness.run()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    report = asyncio.run(replay_main(args))
+    print(json.dumps(report, indent=4, default=datetime_serializer, use_decimal=True))
+    if args.expect_digest is not None and report["state_digest"] != args.expect_digest:
+        logger.error(f"Replay: state digest {report['state_digest']} differs from expected {args.expect_digest}")
+        sys.exit(1)
@@ -1,18 +1,27 @@
+import base64
+from datetime import datetime
+from functools import partial
+import hmac
 import simplejson as json
 import logging
 import os
-import redis.asyncio
 from sanic import Blueprint
-from sanic.response import json as json_sanic
-from sqlalchemy import select, insert
+from sanic.response import json as json_sanic, raw
+from sqlalchemy import and_, insert, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
+import time
+import uuid
 
 # project imports
 from app.models_db import Signal
 from app.models_mem import OurGenericList
+import config
 from app.services.trading_service import execute_buy, execute_sell, handle_stop_loss
+from app.utils.admission import get_source_name
 from app.utils.database import AsyncSessionLocal
 from app.utils.serializer import datetime_serializer
+from app.utils.profiling import run_capture
+from app.utils.sharding import BROKER_CHANNEL, DB_CHANNEL, db_channel_for, shard_channel
 
 
 logger = logging.getLogger("sanic.root.webhook")
@@ -20,36 +29,271 @@ logger = logging.getLogger("sanic.root.webhook")
 # Define a Blueprint for the routes
 api = Blueprint("api", url_prefix="/api")
 
+def datetime_arg(request, name: str):
+    """query argument as datetime (None if missing), ValueError for invalid values"""
+    if name not in request.args:
+        return None
+    value = datetime.fromisoformat(request.args.get(name))
+    if value.tzinfo is not None:
+        # received_at is stored (and compared) as naive local time
+        raise ValueError(f"{name}: timestamps with time zone are not supported, use local time without offset")
+    return value
+
 @api.get("/signals")
 async def get_signals(request):
-    item_list = request.app.ctx.signals.to_dict()['items']
-    return json_sanic(item_list, status=200)
+    # optional ?since=ISO&until=ISO, served from the worker's window if it covers `since`
+    # (without since: the window up to `until`), or ?latest=N for the N most recent signals
+    # of the window. Older signals are read from the database, at most cache_max_rows of
+    # them (use /api/signals/history for more).
+    try:
+        since = datetime_arg(request, "since")
+        until = datetime_arg(request, "until")
+        latest = int(request.args.get("latest")) if "latest" in request.args else None
+    except ValueError as e:
+        return json_sanic({"error": f"invalid argument: {e}"}, status=400)
+
+    signals = request.app.ctx.signals
+    signals.evict()
+    covers_since = signals.covers_since()
+    if latest is not None:
+        item_list = [signal.to_dict() for signal in signals.latest(latest)]
+    elif since is None or covers_since is None or since >= covers_since:
+        item_list = [signal.to_dict() for signal in signals.range(since, until)]
+    else:
+        query = select(Signal).where(Signal.received_at >= since)
+        if until is not None:
+            query = query.where(Signal.received_at <= until)
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(query.order_by(Signal.received_at, Signal.id).limit(config.SIGNALS['cache_max_rows']))
+            item_list = [signal.to_dict() for signal in result.scalars().all()]
+    return json_sanic(item_list, status=200, dumps=partial(json.dumps, default=datetime_serializer, use_decimal=True))
+
+@api.get("/signals/history")
+async def get_signal_history(request):
+    # streams the signals from the database as NDJSON, ordered by (received_at, id):
+    #   ?since=ISO&until=ISO        received_at range (both optional)
+    #   ?after=ISO,ID               continue after this row (received_at and id of the last line)
+    #   ?limit=N                    at most N rows
+    #   ?symbol=S&strategy=S        filters
+    # Pages of history_page_size rows are read with keyset pagination (short queries, no
+    # OFFSET), each page through a server-side cursor, and sent as one chunk.
+    # all arguments are checked before the stream is opened, later errors would truncate a 200
+    try:
+        since = datetime_arg(request, "since")
+        until = datetime_arg(request, "until")
+        after = None
+        if "after" in request.args:
+            if "," not in request.args.get("after"):
+                raise ValueError("after: expected ISO,ID")
+            after_received_at, after_id = request.args.get("after").rsplit(",", 1)
+            after = (datetime.fromisoformat(after_received_at), int(after_id))
+            if after[0].tzinfo is not None:
+                raise ValueError("after: timestamps with time zone are not supported, use local time without offset")
+        limit = int(request.args.get("limit")) if "limit" in request.args else None
+        if limit is not None and limit < 0:
+            raise ValueError("limit: must not be negative")
+    except ValueError as e:
+        return json_sanic({"error": f"invalid argument: {e}"}, status=400)
+
+    page_size = config.SIGNALS['history_page_size']
+    columns = Signal.__table__.columns
+    base_query = select(*columns)
+    if since is not None:
+        base_query = base_query.where(Signal.received_at >= since)
+    if until is not None:
+        base_query = base_query.where(Signal.received_at <= until)
+    for field in ["symbol", "strategy"]:
+        if field in request.args:
+            base_query = base_query.where(getattr(Signal, field) == request.args.get(field))
+    dumps = partial(json.dumps, default=datetime_serializer, use_decimal=True)
+
+    response = await request.respond(content_type="application/x-ndjson")
+    sent = 0
+    while limit is None or sent < limit:
+        query = base_query
+        if after is not None:
+            # the plain received_at bound lets postgres skip the older partitions
+            query = query.where(Signal.received_at >= after[0], or_(
+                Signal.received_at > after[0], and_(Signal.received_at == after[0], Signal.id > after[1])))
+        rows_wanted = page_size if limit is None else min(page_size, limit - sent)
+        query = query.order_by(Signal.received_at, Signal.id).limit(rows_wanted)
+        page_rows = 0
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(query, execution_options={"yield_per": page_size})
+            async for rows in result.partitions():
+                await response.send("".join(dumps(dict(row._mapping)) + "\n" for row in rows))
+                page_rows += len(rows)
+                after = (rows[-1].received_at, rows[-1].id)
+        sent += page_rows
+        if page_rows < rows_wanted:
+            break
+    await response.eof()
+
+@api.get("/signals/stats")
+async def get_signal_stats(request):
+    # ?window=all|1h|24h, without window all variants are returned
+    signal_stats = request.app.ctx.signal_stats
+    window = request.args.get("window")
+    try:
+        if window is None:
+            stats = {name: signal_stats.to_dict(name) for name in ["all", *signal_stats.windowed]}
+        else:
+            stats = signal_stats.to_dict(window)
+    except ValueError as e:
+        return json_sanic({"error": str(e)}, status=400)
+    return json_sanic(stats, status=200, dumps=partial(json.dumps, default=datetime_serializer, use_decimal=True))
+
+@api.get("/orders")
+async def get_orders(request):
+    # optional ?status=new|partially_filled|filled|cancelled|rejected&account=NAME
+    criteria = {key: request.args.get(key) for key in ["status", "account"] if key in request.args}
+    orders = request.app.ctx.orders.find_by_match_criteria(**criteria) if len(criteria) > 0 else request.app.ctx.orders
+    return json_sanic([order.to_dict() for order in orders], status=200,
+                      dumps=partial(json.dumps, default=datetime_serializer, use_decimal=True))
+
+@api.get("/metrics/webhook")
+async def get_webhook_metrics(request):
+    return json_sanic({
+        "admission":    request.app.ctx.admission.to_dict(),
+        "dedup":        request.app.ctx.signal_dedup.counters}, status=200)
+
+def is_admin(request) -> bool:
+    token = config.ADMIN['token']
+    given = request.headers.get("authorization", "")
+    return token is not None and hmac.compare_digest(given.encode(), f"Bearer {token}".encode())
+
+@api.get("/admin/profile")
+async def get_profile(request):
+    # ?target=worker|db|exch&mode=cprofile|tracemalloc&seconds=N (&pid=WORKER_PID, &shard=N)
+    # returns the capture as a download (pstats file or text report)
+    if not is_admin(request):
+        return json_sanic({"error": "Forbidden"}, status=403)
+    target = request.args.get("target", "worker")
+    mode = request.args.get("mode", "cprofile")
+    try:
+        seconds = min(float(request.args.get("seconds", 10)), config.ADMIN['profile_max_seconds'])
+        shard = int(request.args.get("shard", 0))
+        pid = int(request.args.get("pid", os.getpid()))
+    except ValueError as e:
+        return json_sanic({"error": f"invalid argument: {e}"}, status=400)
+
+    if target == "worker" and pid == os.getpid():
+        try:
+            filename, data = await run_capture(mode, seconds)
+        except (RuntimeError, ValueError) as e:
+            return json_sanic({"error": str(e)}, status=409)
+    else:
+        if target == "worker":
+            channel = f"worker_channel.{pid}"
+        elif target == "db":
+            channel = shard_channel(DB_CHANNEL, shard)
+        elif target == "exch":
+            channel = shard_channel(BROKER_CHANNEL, shard)
+        else:
+            return json_sanic({"error": f"unknown target {target} (supported: worker, db, exch)"}, status=400)
+
+        # ask the process over the bus and wait for its answer on a private channel
+        reply_channel = f"profile_reply.{uuid.uuid4().hex}"
+        pubsub = request.app.ctx.channels.pubsub()
+        await pubsub.subscribe(reply_channel)
+        try:
+            receivers = await request.app.ctx.channels.publish(channel, json.dumps({
+                "operation": "PROFILE", "mode": mode, "seconds": seconds, "reply_channel": reply_channel}))
+            if receivers == 0:
+                return json_sanic({"error": f"no process listening on {channel}"}, status=404)
+            deadline = time.monotonic() + seconds + 30
+            result = None
+            while result is None and time.monotonic() < deadline:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    result = json.loads(message["data"])
+        finally:
+            await pubsub.unsubscribe(reply_channel)
+            await pubsub.aclose()
+        if result is None:
+            return json_sanic({"error": f"no profile received from {channel}"}, status=504)
+        if "error" in result:
+            return json_sanic({"error": result["error"]}, status=409)
+        filename, data = result["filename"], base64.b64decode(result["data"])
+
+    content_type = "text/plain" if filename.endswith(".txt") else "application/octet-stream"
+    return raw(data, content_type=content_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@api.get("/health")
+async def get_health(request):
+    # process health as reported by the supervisor in the main process
+    redis_conn = request.app.ctx.redis_conn
+    if redis_conn is None:
+        return json_sanic({"error": "not connected to redis yet"}, status=503)
+    health = await redis_conn.hgetall(config.PROCESSES['health_key'])
+    processes = {name.decode(): json.loads(value) for name, value in health.items()}
+    status = 200 if all(child["alive"] for child in processes.values()) else 503
+    return json_sanic({"processes": processes}, status=status)
 
 def setup_routes(app):
 
     logger.debug("Setting up routes")
 
+    @app.middleware("request")
+    async def readiness_gate(request):
+        # do not serve traffic before the worker has loaded its tables
+        if not request.app.ctx.tables_ready and request.path != "/api/health":
+            return json_sanic({"error": "Service Unavailable (worker tables not loaded yet)"}, status=503, headers={"Retry-After": "1"})
+
     @app.post("/webhook")
     async def tradingview_webhook(request):
+        # shed load before doing any work once this worker has too many requests in flight
+        admitted, retry_after = app.ctx.admission.try_admit()
+        if not admitted:
+            return json_sanic({"status": "error", "message": "Service Unavailable (overloaded)"}, status=503, headers={"Retry-After": str(retry_after)})
+        try:
+            return await process_webhook(request)
+        finally:
+            app.ctx.admission.release()
+
+    async def process_webhook(request):
         try:
             data = request.json
             logger.info("Received data: %s", data)
 
-            signal = Signal(
-                strategy=data["strategy"],
-                order_id=data["orderId"],
-                symbol=data["symbol"],
-                action=data["action"],
-                price=data["price"],
-                quantity=data["quantity"]
-            )
-            ourlist=OurGenericList([signal])
+            token = request.headers.get("X-Webhook-Token") or (data.get("token") if isinstance(data, dict) else None)
+            source_name = get_source_name(app.ctx.websources, data, request.remote_addr or request.ip, token)
+            allowed, retry_after = app.ctx.admission.check_rate(source_name)
+            if not allowed:
+                logger.warning(f"Rate limit exceeded for source {source_name}")
+                return json_sanic({"status": "error", "message": f"Too Many Requests (source {source_name})"}, status=429, headers={"Retry-After": str(retry_after)})
+
+            # validated before the (strategy, orderId) pair is claimed, a corrected retry must get through
+            try:
+                signal = Signal(
+                    strategy=data["strategy"],
+                    order_id=data["orderId"],
+                    symbol=data["symbol"],
+                    action=data["action"],
+                    price=data["price"],
+                    quantity=data["quantity"]
+                )
+            except (KeyError, TypeError) as e:
+                logger.warning(f"Invalid signal from {source_name}: missing {e}")
+                return json_sanic({"status": "error", "message": f"Invalid signal: missing {e}"}, status=400)
+
+            # TradingView retries alerts: answer repeated (strategy, orderId) pairs without any write
+            if await app.ctx.signal_dedup.is_duplicate(signal.strategy, signal.order_id, app.ctx.redis_conn):
+                logger.info(f"Ignoring duplicate signal {signal.strategy}/{signal.order_id}")
+                return json_sanic({"status": "duplicate", "message": f"Signal already received: {signal.order_id}"}, status=200)
 
             # Send the signal to the DB process
-            await app.ctx.redis_conn.publish("db_channel", json.dumps({
-                "operation": "INSERT_SIGNAL",
-                "item_list": ourlist.to_json()},    # to_dict() does not work here: Input string must be text, not bytes
-                sort_keys=True, default=datetime_serializer, use_decimal=True))
+            try:
+                ourlist=OurGenericList([signal])
+                # concurrent requests share pipelined round trips to redis
+                await app.ctx.publisher.publish(db_channel_for(signal.symbol), json.dumps({
+                    "operation": "INSERT_SIGNAL",
+                    "item_list": ourlist.to_json()},    # to_dict() does not work here: Input string must be text, not bytes
+                    sort_keys=True, default=datetime_serializer, use_decimal=True))
+            except Exception:
+                # let the retry of this alert through
+                await app.ctx.signal_dedup.forget(signal.strategy, signal.order_id, app.ctx.redis_conn)
+                raise
             
             # Example: Send a trade execution to the exch process
             # if signal.action.lower() in ["buy", "sell"]:
@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import logging
+import time
+
+# project imports
+import config
+from app.utils.rate_limiter import PRIORITY_CANCEL, PRIORITY_ORDER, PRIORITY_QUERY, endpoint_weight
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+# ------------------------------------------------------------------------------
+# The exchange process talks to exchanges through objects with the (async) ccxt
+# interface: has, create_order(), create_orders(), ... so that ccxt clients and local
+# stand-ins are interchangeable. The stand-ins return ccxt order structures.
+
+class SimulatedExchangeAdapter:
+    # fills every order completely after a fixed latency (the former asyncio.sleep(1)), or
+    # with config.EXCHANGE['simulated_fill_seconds'] > 0 leaves it open and fills it gradually
+    # over that time (the fills show up in fetch_open_orders / fetch_my_trades)
+
+    has = {"createOrder": True, "createOrders": True, "cancelOrder": True, "fetchOrder": True,
+           "fetchOpenOrders": True, "fetchMyTrades": True}
+
+    def __init__(self, exchange_id: str = "simulated", latency: float = None, fill_seconds: float = None):
+        self.id = exchange_id
+        self.latency = config.EXCHANGE['simulated_latency'] if latency is None else latency
+        self.fill_seconds = config.EXCHANGE['simulated_fill_seconds'] if fill_seconds is None else fill_seconds
+        self._order_ids = itertools.count(1)
+        self._trade_ids = itertools.count(1)
+        self.orders = {}        # exchange order id -> ccxt order structure
+        self.trades = []        # ccxt trade structures, oldest first
+
+    def _add_trade(self, order, amount):
+        self.trades.append({
+            "id":               str(next(self._trade_ids)),
+            "order":            order["id"],
+            "timestamp":        int(time.time() * 1000),
+            "symbol":           order["symbol"],
+            "side":             order["side"],
+            "amount":           amount,
+            "price":            order["price"],
+            "cost":             amount * order["price"] if order["price"] is not None else None
+        })
+
+    def _fill(self, order, filled):
+        if filled > order["filled"]:
+            self._add_trade(order, filled - order["filled"])
+            order["filled"] = filled
+            order["remaining"] = order["amount"] - filled
+            order["average"] = order["price"]
+        if order["remaining"] <= 0:
+            order["status"] = "closed"
+
+    def _advance(self):
+        # progress of the gradually filled orders
+        now = time.time() * 1000
+        for order in self.orders.values():
+            if order["status"] == "open":
+                progress = min((now - order["timestamp"]) / (self.fill_seconds * 1000), 1.0)
+                self._fill(order, order["amount"] * progress if progress < 1.0 else order["amount"])
+
+    def _new_order(self, symbol, type, side, amount, price=None, params=None):
+        params = params or {}
+        order = {
+            "id":               str(next(self._order_ids)),
+            "clientOrderId":    params.get("clientOrderId"),
+            "timestamp":        int(time.time() * 1000),
+            "symbol":           symbol,
+            "type":             type,
+            "side":             side,
+            "amount":           amount,
+            "price":            price,
+            "average":          None,
+            "filled":           0.0,
+            "remaining":        amount,
+            "status":           "open"
+        }
+        self.orders[order["id"]] = order
+        if self.fill_seconds <= 0:
+            self._fill(order, amount)
+        return dict(order)
+
+    async def create_order(self, symbol, type, side, amount, price=None, params=None):
+        await asyncio.sleep(self.latency)
+        return self._new_order(symbol, type, side, amount, price, params)
+
+    async def create_orders(self, orders: list, params=None):
+        # one round trip for all orders, like the batch endpoints of the exchanges
+        await asyncio.sleep(self.latency)
+        return [self._new_order(order["symbol"], order["type"], order["side"], order["amount"],
+                                order.get("price"), order.get("params")) for order in orders]
+
+    async def cancel_order(self, id, symbol=None, params=None):
+        self._advance()
+        order = self.orders[id]
+        if order["status"] == "open":
+            order["status"] = "canceled"
+        return dict(order)
+
+    async def fetch_order(self, id, symbol=None, params=None):
+        self._advance()
+        return dict(self.orders[id])
+
+    async def fetch_open_orders(self, symbol=None, since=None, limit=None, params=None):
+        self._advance()
+        return [dict(order) for order in self.orders.values()
+                if order["status"] == "open" and (symbol is None or order["symbol"] == symbol)]
+
+    async def fetch_my_trades(self, symbol=None, since=None, limit=None, params=None):
+        self._advance()
+        trades = [dict(trade) for trade in self.trades
+                  if (since is None or trade["timestamp"] >= since) and (symbol is None or trade["symbol"] == symbol)]
+        return trades[:limit] if limit is not None else trades
+
+    async def close(self):
+        pass
+
+class RateLimitedAdapter:
+    # takes the request weight of every call from the limiter of the API key (shared by all
+    # exchange processes, see app/utils/rate_limiter.py) before passing it on, cancels first
+
+    def __init__(self, adapter, limiter):
+        self.adapter = adapter
+        self.limiter = limiter
+
+    @property
+    def id(self):
+        return self.adapter.id
+
+    @property
+    def has(self):
+        return self.adapter.has
+
+    async def _call(self, endpoint: str, priority: int, *args, **kwargs):
+        await self.limiter.acquire(endpoint_weight(endpoint), priority)
+        return await getattr(self.adapter, endpoint)(*args, **kwargs)
+
+    async def create_order(self, *args, **kwargs):
+        return await self._call("create_order", PRIORITY_ORDER, *args, **kwargs)
+
+    async def create_orders(self, *args, **kwargs):
+        return await self._call("create_orders", PRIORITY_ORDER, *args, **kwargs)
+
+    async def cancel_order(self, *args, **kwargs):
+        return await self._call("cancel_order", PRIORITY_CANCEL, *args, **kwargs)
+
+    async def fetch_order(self, *args, **kwargs):
+        return await self._call("fetch_order", PRIORITY_QUERY, *args, **kwargs)
+
+    async def fetch_open_orders(self, *args, **kwargs):
+        return await self._call("fetch_open_orders", PRIORITY_QUERY, *args, **kwargs)
+
+    async def fetch_my_trades(self, *args, **kwargs):
+        return await self._call("fetch_my_trades", PRIORITY_QUERY, *args, **kwargs)
+
+    async def close(self):
+        await self.adapter.close()
@@ -0,0 +1,293 @@
+import asyncio
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+import itertools
+import logging
+import os
+import simplejson as json
+import time
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+# project imports
+import config
+from app.models_db import Position, Trade
+from app.utils.serializer import datetime_serializer
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.db")
+
+ZERO = Decimal(0)
+TRADE_COLUMNS = ["trade_key", "account", "symbol", "action", "price", "quantity", "client_order_id", "exchange_order_id", "executed_at"]
+POSITION_COLUMNS = ["account", "symbol", "quantity", "average_price", "stop_loss", "updated_at"]
+FINAL_ORDERS_KEPT = 10000
+
+# ------------------------------------------------------------------------------
+# Persistence of executed trades and position snapshots.
+#
+# The exchange process turns the fill increases of its orders into trade rows and position
+# snapshots (ExecutionRecorder) and sends them as numbered batches (PERSIST_EXECUTIONS) to
+# a DB process. There they are buffered (ExecutionBuffer) and written with one COPY per
+# table once flush_rows rows are waiting or flush_interval has passed. The DB process
+# acknowledges the written batches (PERSISTED) and the exchange process resends the ones
+# not acknowledged within ack_timeout, so trades are written at least once and the unique
+# trade_key drops the duplicates.
+#
+# The buffer is bounded (max_buffer_rows): a full buffer is flushed right away, batches
+# that still don't fit are refused (and resent later). If COPY fails (e.g. another driver
+# than asyncpg) the rows are written with batched INSERTs instead. If that fails too, the
+# batches are written one by one: a batch failing while others succeed is appended to the
+# dead letter file (NDJSON) and acknowledged, so that it can't block the others. If all of
+# them fail the database is the problem: they stay buffered and the flushes back off (from
+# flush_interval, doubling up to max_retry_interval) until a write succeeds again.
+
+def parse_timestamp(value):
+    # datetimes arrive as ISO strings from JSON, the columns are TIMESTAMP without time zone
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+class ExecutionRecorder:
+
+    def __init__(self, reply_channel: str, ack_timeout: float = None, max_unacked: int = None):
+        self.reply_channel = reply_channel      # channel of the exchange process receiving the acks
+        self.ack_timeout = config.PERSISTENCE['ack_timeout'] if ack_timeout is None else ack_timeout
+        self.max_unacked = config.PERSISTENCE['max_unacked_batches'] if max_unacked is None else max_unacked
+        self.fills = {}                         # client order id -> (filled, cost) already recorded
+        self.final_fills = {}                   # the same for the latest FINAL_ORDERS_KEPT final orders
+        self.positions = {}                     # (account, symbol) -> (signed quantity, average price)
+        self.unacked = {}                       # batch id -> (time.monotonic() sent, message), oldest first
+        self._batch_ids = itertools.count(1)
+
+    def load_positions(self, positions: list):
+        """continues from the latest persisted position (Position rows) per account and symbol"""
+        for position in positions:
+            self.positions[(position.account, position.symbol)] = (
+                Decimal(position.quantity or 0), Decimal(position.average_price) if position.average_price is not None else None)
+
+    def apply_position(self, account: str, symbol: str, side: str, quantity: Decimal, price: Decimal):
+        position, average = self.positions.get((account, symbol), (ZERO, None))
+        signed = quantity if side == "buy" else -quantity
+        updated = position + signed
+        if position == ZERO or (position > ZERO) == (signed > ZERO):
+            # opened or increased: volume weighted entry price
+            if price is not None:
+                average = price if average is None else (abs(position) * average + quantity * price) / abs(updated)
+        elif updated == ZERO:
+            average = None
+        elif (updated > ZERO) != (position > ZERO):
+            # flipped, the rest is a new position at the trade price
+            average = price
+        self.positions[(account, symbol)] = (updated, average)
+
+    def record(self, orders: list):
+        """turns the fill increases of the changed orders into a batch message, None if nothing was filled"""
+        trades, changed = [], {}
+        for order in orders:
+            recorded, cost = self.fills.get(order.client_order_id) or self.final_fills.get(order.client_order_id, (ZERO, ZERO))
+            if order.filled > recorded:
+                quantity = order.filled - recorded
+                average = order.average if order.average is not None else order.price
+                price = None
+                if average is not None:
+                    price = (order.filled * average - cost) / quantity
+                    cost = order.filled * average
+                trades.append({
+                    # cumulative fills are reported again and again, the key makes them unique
+                    "trade_key":            f"{order.client_order_id}:{order.filled}",
+                    "account":              order.account,
+                    "symbol":               order.symbol,
+                    "action":               order.side,
+                    "price":                price,
+                    "quantity":             quantity,
+                    "client_order_id":      order.client_order_id,
+                    "exchange_order_id":    order.exchange_order_id,
+                    "executed_at":          order.updated_at})
+                self.apply_position(order.account, order.symbol, order.side, quantity, price)
+                changed[(order.account, order.symbol)] = order.updated_at
+                self.fills[order.client_order_id] = (order.filled, cost)
+            if order.is_final and order.client_order_id in self.fills:
+                # a final order published again must not count twice
+                self.final_fills[order.client_order_id] = self.fills.pop(order.client_order_id)
+                if len(self.final_fills) > FINAL_ORDERS_KEPT:
+                    del self.final_fills[next(iter(self.final_fills))]
+        if len(trades) == 0:
+            return None
+
+        positions = [{
+            "account":          account,
+            "symbol":           symbol,
+            "quantity":         self.positions[(account, symbol)][0],
+            "average_price":    self.positions[(account, symbol)][1],
+            "stop_loss":        None,
+            "updated_at":       updated_at} for (account, symbol), updated_at in changed.items()]
+        message = {
+            "operation":        "PERSIST_EXECUTIONS",
+            "batch_id":         f"{os.getpid()}-{next(self._batch_ids)}",
+            "reply_channel":    self.reply_channel,
+            "trades":           trades,
+            "positions":        positions}
+        self.unacked[message["batch_id"]] = (time.monotonic(), message)
+        while len(self.unacked) > self.max_unacked:
+            batch_id = next(iter(self.unacked))
+            logger.error(f"ExecutionRecorder: dropping unacknowledged batch {batch_id} ({len(self.unacked[batch_id][1]['trades'])} trades), database not reachable?")
+            del self.unacked[batch_id]
+        return message
+
+    def acknowledged(self, batch_ids: list):
+        for batch_id in batch_ids:
+            self.unacked.pop(batch_id, None)
+
+    def due_for_resend(self) -> list:
+        """messages not acknowledged within ack_timeout (their timer restarts)"""
+        now = time.monotonic()
+        due = [(batch_id, message) for batch_id, (sent_at, message) in self.unacked.items() if now - sent_at >= self.ack_timeout]
+        for batch_id, message in due:
+            self.unacked[batch_id] = (now, message)
+        return [message for _, message in due]
+
+class ExecutionBuffer:
+
+    def __init__(self, flush_rows: int = None, flush_interval: float = None, max_rows: int = None):
+        self.flush_rows = flush_rows or config.PERSISTENCE['flush_rows']
+        self.flush_interval = config.PERSISTENCE['flush_interval'] if flush_interval is None else flush_interval
+        self.max_rows = max_rows or config.PERSISTENCE['max_buffer_rows']
+        self.max_retry_interval = config.PERSISTENCE['max_retry_interval']
+        self.dead_letter_path = config.PERSISTENCE['dead_letter_path']
+        self.batches = deque()                  # (batch id, reply channel, trade records, position records)
+        self.batch_ids = set()
+        self.rows = 0
+        self.flushed_at = time.monotonic()
+        self.retry_interval = None              # while nothing can be written: seconds until the next flush
+        self.retry_at = 0.0
+        self.counters = {"batches": 0, "trades": 0, "positions": 0, "copies": 0, "fallbacks": 0, "refused": 0, "failed": 0, "dead_lettered": 0}
+
+    def has_room(self, message: dict) -> bool:
+        return self.rows + len(message["trades"]) + len(message["positions"]) <= self.max_rows
+
+    def add(self, message: dict) -> bool:
+        """buffers a PERSIST_EXECUTIONS message, False if it doesn't fit (the sender resends it)"""
+        if message["batch_id"] in self.batch_ids:
+            # resent while waiting here, the flush acknowledges it
+            return True
+        if not self.has_room(message):
+            self.counters["refused"] += 1
+            return False
+        trades = [tuple(parse_timestamp(row.get(column)) if column == "executed_at" else row.get(column)
+                        for column in TRADE_COLUMNS) for row in message["trades"]]
+        positions = [tuple(parse_timestamp(row.get(column)) if column == "updated_at" else row.get(column)
+                           for column in POSITION_COLUMNS) for row in message["positions"]]
+        self.batches.append((message["batch_id"], message["reply_channel"], trades, positions))
+        self.batch_ids.add(message["batch_id"])
+        self.rows += len(trades) + len(positions)
+        return True
+
+    def backing_off(self) -> bool:
+        return time.monotonic() < self.retry_at
+
+    def due(self) -> bool:
+        if len(self.batches) == 0 or self.backing_off():
+            return False
+        return self.rows >= self.flush_rows or time.monotonic() - self.flushed_at >= self.flush_interval
+
+    async def copy_rows(self, engine, trades: list, positions: list):
+        # COPY into a staging table, duplicates (redelivered batches) are skipped on the way to trades
+        async with engine.connect() as conn:
+            driver_connection = (await conn.get_raw_connection()).driver_connection
+            async with driver_connection.transaction():
+                if len(trades) > 0:
+                    await driver_connection.execute(
+                        f"CREATE TEMP TABLE IF NOT EXISTS trades_staging ON COMMIT DELETE ROWS AS "
+                        f"SELECT {', '.join(TRADE_COLUMNS)} FROM trades WITH NO DATA")
+                    await driver_connection.copy_records_to_table("trades_staging", records=trades, columns=TRADE_COLUMNS)
+                    await driver_connection.execute(
+                        f"INSERT INTO trades ({', '.join(TRADE_COLUMNS)}) SELECT {', '.join(TRADE_COLUMNS)} "
+                        f"FROM trades_staging ON CONFLICT (trade_key) DO NOTHING")
+                if len(positions) > 0:
+                    await driver_connection.copy_records_to_table("positions", records=positions, columns=POSITION_COLUMNS)
+
+    async def insert_rows(self, engine, trades: list, positions: list):
+        chunk_size = config.DATABASE['bulk_chunk_size']
+        async with engine.begin() as conn:
+            for chunk_start in range(0, len(trades), chunk_size):
+                rows = [dict(zip(TRADE_COLUMNS, record)) for record in trades[chunk_start:chunk_start + chunk_size]]
+                await conn.execute(pg_insert(Trade.__table__).values(rows).on_conflict_do_nothing(index_elements=["trade_key"]))
+            for chunk_start in range(0, len(positions), chunk_size):
+                rows = [dict(zip(POSITION_COLUMNS, record)) for record in positions[chunk_start:chunk_start + chunk_size]]
+                await conn.execute(pg_insert(Position.__table__).values(rows))
+
+    async def write(self, engine, batches: list) -> bool:
+        """writes the batches in one transaction (COPY, or batched INSERTs if that fails)"""
+        trades = [record for batch in batches for record in batch[2]]
+        positions = [record for batch in batches for record in batch[3]]
+        try:
+            await self.copy_rows(engine, trades, positions)
+            self.counters["copies"] += 1
+            return True
+        except Exception as e:
+            logger.warning(f"ExecutionBuffer: COPY of {len(trades)} trades and {len(positions)} positions failed, inserting in batches: {e}")
+        try:
+            await self.insert_rows(engine, trades, positions)
+            self.counters["fallbacks"] += 1
+            return True
+        except Exception as e:
+            logger.error(f"ExecutionBuffer: writing {len(trades)} trades and {len(positions)} positions failed: {e}")
+            return False
+
+    def write_dead_letters(self, batches: list):
+        with open(self.dead_letter_path, "a", encoding="utf-8") as dead_letter_file:
+            for batch_id, reply_channel, trades, positions in batches:
+                dead_letter_file.write(json.dumps({
+                    "batch_id":         batch_id,
+                    "reply_channel":    reply_channel,
+                    "trades":           [dict(zip(TRADE_COLUMNS, record)) for record in trades],
+                    "positions":        [dict(zip(POSITION_COLUMNS, record)) for record in positions]},
+                    default=datetime_serializer, use_decimal=True) + "\n")
+
+    async def flush(self, engine):
+        """writes the buffered batches, returns (written batches, dead lettered batches) as (batch id, reply channel, trades, positions)"""
+        self.flushed_at = time.monotonic()
+        batches = list(self.batches)
+        if len(batches) == 0:
+            return [], []
+        if await self.write(engine, batches):
+            written, failed = batches, []
+        elif len(batches) == 1:
+            written, failed = [], batches
+        else:
+            # one bad row must not block the others: the batches one by one
+            written, failed = [], []
+            for batch in batches:
+                (written if await self.write(engine, [batch]) else failed).append(batch)
+
+        # failing while others succeed is the batch's fault, not the database's
+        dead = failed if len(written) > 0 else []
+        if len(written) > 0:
+            self.retry_interval, self.retry_at = None, 0.0
+        elif len(failed) > 0:
+            self.retry_interval = min(self.retry_interval * 2 if self.retry_interval is not None else max(self.flush_interval, 0.1), self.max_retry_interval)
+            self.retry_at = time.monotonic() + self.retry_interval
+            logger.warning(f"ExecutionBuffer: nothing written, keeping {len(failed)} batches and retrying in {self.retry_interval}s")
+        if len(dead) > 0:
+            try:
+                await asyncio.to_thread(self.write_dead_letters, dead)
+                logger.error(f"ExecutionBuffer: moved {len(dead)} unwritable batches to {self.dead_letter_path}: {[batch[0] for batch in dead]}")
+                self.counters["dead_lettered"] += len(dead)
+            except Exception as e:
+                logger.error(f"ExecutionBuffer: failed to write dead letters to {self.dead_letter_path}: {e}")
+                dead = []
+        if len(failed) > len(dead):
+            # kept for the next flush, the buffer bound makes the senders retry meanwhile
+            self.counters["failed"] += 1
+
+        done = {batch[0] for batch in written + dead}
+        self.batches = deque(batch for batch in self.batches if batch[0] not in done)
+        for batch in written + dead:
+            self.batch_ids.discard(batch[0])
+            self.rows -= len(batch[2]) + len(batch[3])
+        self.counters["batches"] += len(written)
+        self.counters["trades"] += sum(len(batch[2]) for batch in written)
+        self.counters["positions"] += sum(len(batch[3]) for batch in written)
+        return written, dead
@@ -0,0 +1,82 @@
+from decimal import Decimal
+import logging
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+ZERO = Decimal(0)
+
+# ------------------------------------------------------------------------------
+# Netting of pending signals: all buy/sell signals of one account and symbol collected
+# within the netting window become a single order for the net quantity. Opposing
+# quantities are crossed internally and never reach the exchange.
+#
+# Fills of the net order are mapped back to the originating signals: signals on the
+# side of the net order share its fill pro rata (after the crossed part), signals on
+# the other side are filled completely by the crossing. Crossed quantities are priced
+# at the average price of the net order (or at the signal price if nothing was sent).
+
+class NetOrder:
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.signals = []
+        self.buy_quantity = ZERO
+        self.sell_quantity = ZERO
+
+    def add(self, signal, side: str, quantity: Decimal):
+        self.signals.append((signal, side, quantity))
+        if side == "buy":
+            self.buy_quantity += quantity
+        else:
+            self.sell_quantity += quantity
+
+    @property
+    def net_quantity(self) -> Decimal:
+        return self.buy_quantity - self.sell_quantity
+
+    @property
+    def side(self):
+        if self.net_quantity > ZERO:
+            return "buy"
+        if self.net_quantity < ZERO:
+            return "sell"
+        return None
+
+    @property
+    def amount(self) -> Decimal:
+        return abs(self.net_quantity)
+
+    def allocate(self, filled: Decimal = ZERO, average: Decimal = None):
+        """returns one fill dict per originating signal (in the order they were added)"""
+        crossed = min(self.buy_quantity, self.sell_quantity)
+        side_total = {"buy": self.buy_quantity, "sell": self.sell_quantity}
+        fills = []
+        for signal, side, quantity in self.signals:
+            share = quantity / side_total[side] if side_total[side] > ZERO else ZERO
+            crossed_part = crossed * share
+            external_part = filled * share if side == self.side else ZERO
+            price = average if average is not None else signal.price
+            fills.append({
+                "signal_id":    signal.id,
+                "symbol":       self.symbol,
+                "side":         side,
+                "quantity":     quantity,
+                "crossed":      crossed_part,
+                "filled":       crossed_part + external_part,
+                "average":      price
+            })
+        return fills
+
+def net_signals(signals) -> list:
+    """groups buy/sell signals by symbol into NetOrders (in order of first appearance)"""
+    net_orders = {}
+    for signal in signals:
+        side = (signal.action or "").lower()
+        if side not in ["buy", "sell"]:
+            logger.error(f"net_signals(): cannot net signal {signal.id} with action {signal.action}")
+            continue
+        net_order = net_orders.get(signal.symbol)
+        if net_order is None:
+            net_order = net_orders[signal.symbol] = NetOrder(signal.symbol)
+        net_order.add(signal, side, Decimal(signal.quantity or 0))
+    return list(net_orders.values())
@@ -0,0 +1,205 @@
+import asyncio
+from ccxt.base.errors import ArgumentsRequired
+from decimal import Decimal
+import itertools
+import logging
+import os
+import time
+
+# project imports
+import config
+from app.models_mem import Order
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+ZERO = Decimal(0)
+
+# ------------------------------------------------------------------------------
+# Order lifecycle tracking in the exchange process. Orders are registered before they are
+# sent and updated from the create_order() results. Afterwards every account with open
+# orders is reconciled with two bulk requests (fetch_open_orders, fetch_my_trades since the
+# last reconciliation) instead of polling each order:
+#   - orders in the open orders list take status and fill from there
+#   - orders no longer open are filled if their trades add up, otherwise (cancelled,
+#     rejected, trades not visible yet) they are fetched one by one
+#
+# The interval of an account starts at reconcile_min_interval after a submission or a
+# change and doubles up to reconcile_max_interval while nothing changes. Accounts without
+# open orders are not polled at all. Changed orders are handed to `publish` as one delta.
+
+def status_from_ccxt(ccxt_order: dict) -> str:
+    status = ccxt_order.get("status")
+    if status == "closed":
+        return Order.FILLED
+    if status in ["canceled", "cancelled", "expired"]:
+        return Order.CANCELLED
+    if status == "rejected":
+        return Order.REJECTED
+    return Order.PARTIALLY_FILLED if (ccxt_order.get("filled") or 0) > 0 else Order.NEW
+
+class OrderTracker:
+
+    def __init__(self, publish, min_interval: float = None, max_interval: float = None):
+        self.publish = publish                  # async callable receiving a list of changed orders
+        self.min_interval = config.EXCHANGE['reconcile_min_interval'] if min_interval is None else min_interval
+        self.max_interval = config.EXCHANGE['reconcile_max_interval'] if max_interval is None else max_interval
+        self.orders = {}                        # client order id -> Order (open orders only)
+        self.by_exchange_id = {}                # (account, exchange order id) -> Order
+        self.intervals = {}                     # account -> current reconciliation interval
+        self.due = {}                           # account -> time.monotonic() of the next reconciliation
+        self.trade_cursor = {}                  # account -> (timestamp ms, trade ids at that timestamp)
+        self.trade_fills = {}                   # (account, exchange order id) -> (amount, cost) from trades
+        self._client_order_ids = itertools.count(1)
+        self._wakeup = asyncio.Event()
+
+    def new_client_order_id(self) -> str:
+        # unique across processes and restarts, short enough for the exchanges (<= 36 chars)
+        return f"tl-{os.getpid()}-{int(time.time() * 1000)}-{next(self._client_order_ids)}"
+
+    def open_orders(self, account: str = None) -> list:
+        return [order for order in self.orders.values() if account is None or order.account == account]
+
+    def track(self, account: str, symbol: str, side: str, type: str, amount, price=None, signal_ids: list = None) -> Order:
+        """registers an order before it is sent (pass order.client_order_id as clientOrderId)"""
+        order = Order(client_order_id=self.new_client_order_id(), account=account, symbol=symbol, side=side,
+                      type=type, amount=amount, price=price, signal_ids=signal_ids)
+        self.orders[order.client_order_id] = order
+        return order
+
+    def apply_ccxt_order(self, order: Order, ccxt_order: dict) -> bool:
+        exchange_order_id = ccxt_order.get("id")
+        if exchange_order_id is not None:
+            self.by_exchange_id[(order.account, exchange_order_id)] = order
+        try:
+            return order.transition(status_from_ccxt(ccxt_order), filled=ccxt_order.get("filled"),
+                                    average=ccxt_order.get("average"), exchange_order_id=exchange_order_id)
+        except ValueError as e:
+            logger.warning(f"OrderTracker: ignoring exchange update: {e}")
+            return False
+
+    def forget_final(self, orders: list):
+        # final orders are published once more and then only live in the workers' lists
+        for order in orders:
+            if order.is_final:
+                self.orders.pop(order.client_order_id, None)
+                self.by_exchange_id.pop((order.account, order.exchange_order_id), None)
+                self.trade_fills.pop((order.account, order.exchange_order_id), None)
+
+    def schedule(self, account: str, changed: bool):
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals.get(account, self.min_interval) * 2, self.max_interval)
+        self.intervals[account] = interval
+        self.due[account] = time.monotonic() + interval
+
+    async def submitted(self, orders: list, ccxt_orders: list):
+        """applies the results of create_order(s) to the tracked orders"""
+        if len(orders) == 0:
+            return
+        for order, ccxt_order in zip(orders, ccxt_orders):
+            self.apply_ccxt_order(order, ccxt_order)
+            self.schedule(order.account, changed=True)
+        self._wakeup.set()
+        await self.publish(orders)
+        self.forget_final(orders)
+
+    async def rejected(self, orders: list, reason: str):
+        if len(orders) == 0:
+            return
+        logger.error(f"OrderTracker: {len(orders)} orders rejected: {reason}")
+        for order in orders:
+            order.transition(Order.REJECTED)
+        await self.publish(orders)
+        self.forget_final(orders)
+
+    async def fetch_per_account(self, fetch, symbols, **kwargs) -> list:
+        # one request for the account, one per symbol for exchanges requiring the symbol
+        try:
+            return await fetch(None, **kwargs)
+        except ArgumentsRequired:
+            results = []
+            for symbol in symbols:
+                results.extend(await fetch(symbol, **kwargs))
+            return results
+
+    def add_trades(self, account: str, trades: list):
+        since, seen = self.trade_cursor[account]
+        for trade in sorted(trades, key=lambda trade: trade["timestamp"]):
+            if trade["timestamp"] < since or (trade["timestamp"] == since and trade["id"] in seen):
+                continue
+            if trade["timestamp"] > since:
+                since, seen = trade["timestamp"], set()
+            seen.add(trade["id"])
+            # trades of orders placed elsewhere (or already final) are not ours to count
+            key = (account, trade.get("order"))
+            if key not in self.by_exchange_id:
+                continue
+            amount, cost = self.trade_fills.get(key, (ZERO, ZERO))
+            trade_cost = Decimal(str(trade["cost"])) if trade.get("cost") is not None else ZERO
+            self.trade_fills[key] = (amount + Decimal(str(trade["amount"])), cost + trade_cost)
+        self.trade_cursor[account] = (since, seen)
+
+    async def reconcile(self, account: str, adapter) -> list:
+        """updates the open orders of the account from the exchange, returns the changed ones"""
+        # exactly this account (None is the account of signals without one, not "all")
+        open_tracked = [order for order in self.orders.values() if order.account == account and order.exchange_order_id is not None]
+        if len(open_tracked) == 0:
+            return []
+        symbols = sorted({order.symbol for order in open_tracked})
+        if account not in self.trade_cursor:
+            self.trade_cursor[account] = (int(min(order.created_at for order in open_tracked).timestamp() * 1000), set())
+
+        open_orders = await self.fetch_per_account(adapter.fetch_open_orders, symbols)
+        self.add_trades(account, await self.fetch_per_account(adapter.fetch_my_trades, symbols,
+                                                              since=self.trade_cursor[account][0]))
+
+        changed = []
+        open_by_id = {ccxt_order["id"]: ccxt_order for ccxt_order in open_orders}
+        for order in open_tracked:
+            ccxt_order = open_by_id.get(order.exchange_order_id)
+            if ccxt_order is not None:
+                if self.apply_ccxt_order(order, ccxt_order):
+                    changed.append(order)
+                continue
+            # not open any more
+            amount, cost = self.trade_fills.get((account, order.exchange_order_id), (ZERO, ZERO))
+            if amount >= order.amount:
+                was_changed = order.transition(Order.FILLED, filled=min(amount, order.amount), average=cost / amount if cost > ZERO else None)
+            elif adapter.has.get("fetchOrder"):
+                was_changed = self.apply_ccxt_order(order, await adapter.fetch_order(order.exchange_order_id, order.symbol))
+            else:
+                was_changed = order.transition(Order.CANCELLED, filled=amount)
+            if was_changed:
+                changed.append(order)
+        return changed
+
+    async def reconcile_account(self, account: str, adapter):
+        try:
+            changed = await self.reconcile(account, adapter)
+        except Exception as e:
+            logger.error(f"OrderTracker: reconciliation of {account} failed: {e}")
+            changed = []
+        self.schedule(account, changed=len(changed) > 0)
+        if len(changed) > 0:
+            logger.debug(f"OrderTracker: {account}: {len(changed)} orders changed")
+            await self.publish(changed)
+            self.forget_final(changed)
+
+    async def run(self, get_adapter):
+        """reconciles the accounts with open orders when they are due, get_adapter(account) returns the client"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            accounts = {order.account for order in self.orders.values() if order.exchange_order_id is not None}
+            due_accounts = [account for account in accounts if self.due.get(account, now) <= now]
+            await asyncio.gather(*[self.reconcile_account(account, get_adapter(account)) for account in due_accounts])
+
+            accounts = {order.account for order in self.orders.values() if order.exchange_order_id is not None}
+            next_due = min([self.due[account] for account in accounts if account in self.due], default=None)
+            try:
+                timeout = None if next_due is None else max(next_due - time.monotonic(), 0)
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
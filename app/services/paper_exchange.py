@@ -0,0 +1,391 @@
+import asyncio
+from ccxt.base.errors import InsufficientFunds, OrderNotFound
+import csv
+import heapq
+import itertools
+import logging
+import simplejson as json
+import time
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+# ------------------------------------------------------------------------------
+# Paper trading backend with the (async) ccxt interface of the exchange adapters.
+#
+# Every symbol has a limit order book with price-time priority. All its orders belong to
+# the account of the PaperExchange, so they never trade with each other: an incoming order
+# crossing resting orders of the other side cancels them (self-trade prevention, "expire
+# maker") and trades against the price feed: at most `tick_liquidity` per tick (None:
+# unlimited) at the tick price. What cannot be filled stays open and fills on the next
+# ticks (partial fills):
+#   - market orders fill at the next ticks in time priority
+#   - limit orders rest in the book and fill once a tick reaches their price
+#   - stop orders (type stop / stop_market with params stopPrice or triggerPrice) wait for a
+#     tick at or beyond the stop price and become market orders (stop_limit: limit orders)
+#
+# Orders are checked against the free balance (total minus what open orders reserve) like
+# on a spot venue, every account gets its own PaperExchange. create_orders() returns a
+# rejected order structure for the orders failing the check, like the batch endpoints.
+#
+# Nothing is random: the same orders and ticks always produce the same fills. The ticks
+# come from on_price(), from a feed stepped by the order flow (attach_feed: some ticks
+# before every order batch and open orders poll) or from replay_price_feed() in real time.
+
+def load_price_feed(path: str) -> list:
+    """reads ticks (timestamp ms, symbol, price, volume or None) from a .csv or .ndjson file, ordered by time"""
+    ticks = []
+    with open(path, "r", encoding="utf-8") as feed_file:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(feed_file)
+        else:
+            rows = (json.loads(line) for line in feed_file if line.strip() != "")
+        for row in rows:
+            volume = row.get("volume")
+            ticks.append((int(row["timestamp"]), row["symbol"], float(row["price"]),
+                          float(volume) if volume not in [None, ""] else None))
+    ticks.sort(key=lambda tick: tick[0])
+    return ticks
+
+async def replay_price_feed(exchanges: list, ticks: list, speed: float = 0, loop: bool = False):
+    """feeds the ticks to the exchanges (the list may grow meanwhile), `speed` times faster than recorded
+
+    speed 0 replays as fast as possible, i.e. the feed is over before live orders arrive:
+    only meaningful for offline benchmarks. With `loop` (speed > 0 only) the feed starts
+    over at its end.
+    """
+    if len(ticks) == 0:
+        return
+    while True:
+        started_at = time.monotonic()
+        for timestamp, symbol, price, volume in ticks:
+            if speed > 0:
+                delay = (timestamp - ticks[0][0]) / 1000 / speed - (time.monotonic() - started_at)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # let the other tasks (order submission, reconciliation) in between the ticks
+                await asyncio.sleep(0)
+            for exchange in list(exchanges):
+                exchange.on_price(symbol, price, volume)
+        if not loop or speed <= 0:
+            break
+    logger.info(f"PaperExchange: price feed replay done ({len(ticks)} ticks)")
+
+class PaperFeed:
+    # cursor into the ticks of a price feed, starting over at the end (loop)
+
+    def __init__(self, ticks: list, loop: bool = True):
+        self.ticks = ticks
+        self.loop = loop
+        self.position = 0
+
+    def next_ticks(self, count: int) -> list:
+        result = []
+        while len(result) < count and len(self.ticks) > 0:
+            if self.position >= len(self.ticks):
+                if not self.loop:
+                    break
+                self.position = 0
+            result.append(self.ticks[self.position])
+            self.position += 1
+        return result
+
+class PaperOrderBook:
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.bids = []          # heap of (-price, sequence, order)
+        self.asks = []          # heap of (price, sequence, order)
+        self.pending = []       # market orders waiting for liquidity, oldest first
+        self.stops = []         # stop orders waiting for their trigger, oldest first
+        self.feed_price = None  # last tick of the price feed
+        self.last_price = None  # last tick or trade
+
+    def best(self, side: str):
+        """best resting order on `side` (cancelled / filled ones are dropped on the way)"""
+        heap = self.bids if side == "buy" else self.asks
+        while len(heap) > 0 and heap[0][2]["status"] != "open":
+            heapq.heappop(heap)
+        return heap[0][2] if len(heap) > 0 else None
+
+    def rest(self, order: dict, sequence: int):
+        if order["side"] == "buy":
+            heapq.heappush(self.bids, (-order["price"], sequence, order))
+        else:
+            heapq.heappush(self.asks, (order["price"], sequence, order))
+
+class PaperExchange:
+
+    has = {"createOrder": True, "createOrders": True, "cancelOrder": True, "fetchOrder": True,
+           "fetchOpenOrders": True, "fetchMyTrades": True, "fetchTicker": True, "fetchBalance": True}
+
+    def __init__(self, exchange_id: str = "paper", tick_liquidity: float = None, balances: dict = None, clock=None):
+        self.id = exchange_id
+        self.tick_liquidity = config.EXCHANGE['paper_tick_liquidity'] if tick_liquidity is None else tick_liquidity
+        self.balances = dict(config.EXCHANGE['paper_balances'] if balances is None else balances)
+        self.clock = clock or time.time
+        self.books = {}
+        self.orders = {}                # order id -> ccxt order structure
+        self.open_orders = {}           # the same for the open ones (reserving balance)
+        self.feed = None                # PaperFeed stepped by the order flow (attach_feed)
+        self.ticks_per_request = 1
+        self.trades = []                # ccxt trade structures, oldest first
+        self._order_ids = itertools.count(1)
+        self._trade_ids = itertools.count(1)
+        self._sequence = itertools.count()
+        self._liquidity = {}            # symbol -> amount left at the current tick
+
+    def book(self, symbol: str) -> PaperOrderBook:
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books[symbol] = PaperOrderBook(symbol)
+        return book
+
+    def now(self) -> int:
+        return int(self.clock() * 1000)
+
+    def attach_feed(self, feed: PaperFeed, ticks_per_request: int = 1):
+        """steps `feed` by ticks_per_request ticks before every order batch and open orders poll"""
+        self.feed = feed
+        self.ticks_per_request = ticks_per_request
+
+    def step_feed(self):
+        if self.feed is not None:
+            for _, symbol, price, volume in self.feed.next_ticks(self.ticks_per_request):
+                self.on_price(symbol, price, volume)
+
+    # --- matching -------------------------------------------------------------
+
+    def _trade(self, order: dict, amount: float, price: float, taker: bool):
+        base, _, quote = order["symbol"].partition("/")
+        sign = 1 if order["side"] == "buy" else -1
+        self.balances[base] = self.balances.get(base, 0.0) + sign * amount
+        self.balances[quote] = self.balances.get(quote, 0.0) - sign * amount * price
+        self.trades.append({
+            "id":               str(next(self._trade_ids)),
+            "order":            order["id"],
+            "timestamp":        self.now(),
+            "symbol":           order["symbol"],
+            "side":             order["side"],
+            "amount":           amount,
+            "price":            price,
+            "cost":             amount * price,
+            "takerOrMaker":     "taker" if taker else "maker"
+        })
+        order["cost"] += amount * price
+        order["filled"] += amount
+        order["remaining"] = order["amount"] - order["filled"]
+        order["average"] = order["cost"] / order["filled"]
+        order["lastTradeTimestamp"] = self.now()
+        if order["remaining"] <= 1e-12:
+            order["remaining"] = 0.0
+            order["status"] = "closed"
+            self.open_orders.pop(order["id"], None)
+
+    def _crosses(self, order: dict, price: float) -> bool:
+        if order["price"] is None:
+            return True
+        return price <= order["price"] if order["side"] == "buy" else price >= order["price"]
+
+    def _prevent_self_trade(self, book: PaperOrderBook, order: dict):
+        # the resting orders of the other side are the account's own: cancelled instead of matched
+        other_side = "sell" if order["side"] == "buy" else "buy"
+        while True:
+            resting = book.best(other_side)
+            if resting is None or not self._crosses(order, resting["price"]):
+                break
+            logger.debug(f"PaperExchange {self.id}: order {order['id']} would trade with own order {resting['id']}, cancelling that one")
+            resting["status"] = "canceled"
+            self.open_orders.pop(resting["id"], None)
+
+    def _match_feed(self, book: PaperOrderBook, order: dict):
+        # against the liquidity of the price feed at the last tick
+        if order["status"] != "open" or book.feed_price is None or not self._crosses(order, book.feed_price):
+            return
+        available = self._liquidity[book.symbol]
+        amount = order["remaining"] if available is None else min(order["remaining"], available)
+        if amount <= 0:
+            return
+        if available is not None:
+            self._liquidity[book.symbol] = available - amount
+        self._trade(order, amount, book.feed_price, taker=order["price"] is None)
+
+    def _execute(self, book: PaperOrderBook, order: dict):
+        self._prevent_self_trade(book, order)
+        self._match_feed(book, order)
+        if order["status"] == "open":
+            if order["price"] is None:
+                book.pending.append(order)
+            else:
+                book.rest(order, next(self._sequence))
+
+    def _triggered(self, order: dict, price: float) -> bool:
+        return price >= order["stopPrice"] if order["side"] == "buy" else price <= order["stopPrice"]
+
+    def on_price(self, symbol: str, price: float, volume: float = None):
+        """a tick of the price feed: triggers stops, then fills waiting market and crossing limit orders"""
+        book = self.book(symbol)
+        book.feed_price = book.last_price = price
+        self._liquidity[symbol] = volume if volume is not None else self.tick_liquidity
+
+        stops, book.stops, triggered = book.stops, [], []
+        for order in stops:
+            if order["status"] == "open":
+                (triggered if self._triggered(order, price) else book.stops).append(order)
+        for order in triggered:
+            order["triggerTimestamp"] = self.now()
+            self._execute(book, order)
+
+        pending, book.pending = book.pending, []
+        for order in pending:
+            self._match_feed(book, order)
+            if order["status"] == "open":
+                book.pending.append(order)
+
+        for side in ["buy", "sell"]:
+            while True:
+                resting = book.best(side)
+                if resting is None or not self._crosses(resting, price) or self._liquidity[symbol] == 0:
+                    break
+                self._match_feed(book, resting)
+                if resting["status"] == "open":
+                    break
+
+    # --- balances -------------------------------------------------------------
+
+    def reference_price(self, order: dict):
+        # what a buy order reserves per unit: its limit price, else the latest price
+        if order["price"] is not None:
+            return order["price"]
+        book = self.book(order["symbol"])
+        return book.feed_price if book.feed_price is not None else book.last_price
+
+    def used_balances(self) -> dict:
+        used = {}
+        for order in self.open_orders.values():
+            base, _, quote = order["symbol"].partition("/")
+            if order["side"] == "sell":
+                used[base] = used.get(base, 0.0) + order["remaining"]
+            else:
+                used[quote] = used.get(quote, 0.0) + order["remaining"] * (self.reference_price(order) or 0.0)
+        return used
+
+    def check_funds(self, order: dict):
+        base, _, quote = order["symbol"].partition("/")
+        if order["side"] == "sell":
+            currency, needed = base, order["amount"]
+        else:
+            price = self.reference_price(order)
+            if price is None:
+                # nothing known to value a market order by, the fills will tell
+                return
+            currency, needed = quote, order["amount"] * price
+        free = self.balances.get(currency, 0.0) - self.used_balances().get(currency, 0.0)
+        if needed > free + 1e-9:
+            raise InsufficientFunds(f"PaperExchange {self.id}: {order['side']} {order['amount']} {order['symbol']} "
+                                    f"needs {needed} {currency}, free {free}")
+
+    # --- ccxt interface -------------------------------------------------------
+
+    def _new_order(self, symbol, type, side, amount, price=None, params=None):
+        params = params or {}
+        if side not in ["buy", "sell"] or amount is None or amount <= 0:
+            raise ValueError(f"PaperExchange: invalid order {side} {amount} {symbol}")
+        stop_price = params.get("stopPrice", params.get("triggerPrice"))
+        if type in ["stop", "stop_market", "stop_limit"] and stop_price is None:
+            raise ValueError(f"PaperExchange: {type} order requires params stopPrice")
+        if type in ["limit", "stop_limit"] and price is None:
+            raise ValueError(f"PaperExchange: {type} order requires a price")
+        order = {
+            "id":                   str(next(self._order_ids)),
+            "clientOrderId":        params.get("clientOrderId"),
+            "timestamp":            self.now(),
+            "lastTradeTimestamp":   None,
+            "symbol":               symbol,
+            "type":                 type,
+            "side":                 side,
+            "amount":               float(amount),
+            # market and stop (market) orders take whatever the book / feed offers
+            "price":                float(price) if type in ["limit", "stop_limit"] else None,
+            "stopPrice":            float(stop_price) if stop_price is not None else None,
+            "average":              None,
+            "cost":                 0.0,
+            "filled":               0.0,
+            "remaining":            float(amount),
+            "status":               "open"
+        }
+        self.check_funds(order)
+        self.orders[order["id"]] = order
+        self.open_orders[order["id"]] = order
+        book = self.book(symbol)
+        if order["stopPrice"] is not None and (book.last_price is None or not self._triggered(order, book.last_price)):
+            book.stops.append(order)
+        else:
+            self._execute(book, order)
+        return dict(order)
+
+    def _get_order(self, id) -> dict:
+        order = self.orders.get(id)
+        if order is None:
+            raise OrderNotFound(f"PaperExchange {self.id}: order {id} not found")
+        return order
+
+    async def create_order(self, symbol, type, side, amount, price=None, params=None):
+        self.step_feed()
+        return self._new_order(symbol, type, side, amount, price, params)
+
+    def _rejected_order(self, symbol, type, side, amount, price, params, reason: str) -> dict:
+        return {"id": None, "clientOrderId": (params or {}).get("clientOrderId"), "timestamp": self.now(),
+                "symbol": symbol, "type": type, "side": side, "amount": float(amount), "price": price,
+                "average": None, "cost": 0.0, "filled": 0.0, "remaining": 0.0, "status": "rejected",
+                "info": {"error": reason}}
+
+    async def create_orders(self, orders: list, params=None):
+        # one result per order: the ones placed before a failing one stay in the book
+        self.step_feed()
+        results = []
+        for order in orders:
+            arguments = (order["symbol"], order["type"], order["side"], order["amount"], order.get("price"), order.get("params"))
+            try:
+                results.append(self._new_order(*arguments))
+            except (InsufficientFunds, ValueError) as e:
+                results.append(self._rejected_order(*arguments, str(e)))
+        return results
+
+    async def cancel_order(self, id, symbol=None, params=None):
+        order = self._get_order(id)
+        if order["status"] == "open":
+            order["status"] = "canceled"
+            self.open_orders.pop(id, None)
+        return dict(order)
+
+    async def fetch_order(self, id, symbol=None, params=None):
+        return dict(self._get_order(id))
+
+    async def fetch_open_orders(self, symbol=None, since=None, limit=None, params=None):
+        # the order tracker's polls move a stepped feed on while orders are waiting for fills
+        self.step_feed()
+        return [dict(order) for order in self.open_orders.values() if symbol is None or order["symbol"] == symbol]
+
+    async def fetch_my_trades(self, symbol=None, since=None, limit=None, params=None):
+        trades = [dict(trade) for trade in self.trades
+                  if (since is None or trade["timestamp"] >= since) and (symbol is None or trade["symbol"] == symbol)]
+        return trades[:limit] if limit is not None else trades
+
+    async def fetch_ticker(self, symbol, params=None):
+        book = self.book(symbol)
+        bid, ask = book.best("buy"), book.best("sell")
+        return {"symbol": symbol, "timestamp": self.now(), "last": book.last_price,
+                "bid": bid["price"] if bid is not None else None, "ask": ask["price"] if ask is not None else None}
+
+    async def fetch_balance(self, params=None):
+        used = self.used_balances()
+        return {"total": dict(self.balances), "used": used,
+                "free": {currency: total - used.get(currency, 0.0) for currency, total in self.balances.items()}}
+
+    async def close(self):
+        pass
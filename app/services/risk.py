@@ -0,0 +1,263 @@
+from decimal import Decimal
+import logging
+import math
+import numpy as np
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+REASON_NO_PRICE = 1
+REASON_PRICE_DEVIATION = 2
+REASON_MAX_ORDER_SIZE = 4
+REASON_SYMBOL_LIMIT = 8
+REASON_ACCOUNT_LIMIT = 16
+REASON_PORTFOLIO_LIMIT = 32
+REASON_NAMES = {
+    REASON_NO_PRICE:            "NO_PRICE",
+    REASON_PRICE_DEVIATION:     "PRICE_DEVIATION",
+    REASON_MAX_ORDER_SIZE:      "MAX_ORDER_SIZE",
+    REASON_SYMBOL_LIMIT:        "SYMBOL_LIMIT",
+    REASON_ACCOUNT_LIMIT:       "ACCOUNT_LIMIT",
+    REASON_PORTFOLIO_LIMIT:     "PORTFOLIO_LIMIT"
+}
+REJECTING_REASONS = REASON_NO_PRICE | REASON_PRICE_DEVIATION
+
+ACCEPT = "accept"
+RESIZE = "resize"
+REJECT = "reject"
+
+# ------------------------------------------------------------------------------
+# Pre-trade risk checks of the exchange process. Positions (signed quantities) live in an
+# accounts x symbols array, recent prices and limits in arrays per symbol / account, so a
+# batch of candidate orders is checked in one vectorized pass:
+#   - max order size: notional at the order price (or the recent price) per symbol
+#   - limit orders priced too far from the recent price are rejected
+#   - gross notional per account and symbol, per account and across the portfolio
+#
+# Reducing a position is always allowed, only the increasing part of an order counts
+# against the limits. Earlier orders of the same batch count at their checked size (before
+# resizing by the later limits, i.e. conservatively). Orders exceeding a limit are resized
+# to the headroom, or rejected if less than min_resize_ratio of them would be left.
+#
+# Sent orders count as exposure right away, the remainder of cancelled orders is released.
+# The gross notional per account and of the portfolio is kept up to date by apply() and
+# update_price(), a check costs the same whatever the number of accounts and symbols.
+#
+# The exchange process seeds the positions with the persisted ones on startup (the open
+# orders of before the restart are not known any more). Every exchange process checks its
+# own orders only: with several exch_shards the account limits hold as long as the signals
+# of an account carry it (they are routed by account), the portfolio limit is per shard.
+
+class RiskDecision:
+    def __init__(self, action: str, amount: Decimal, reasons: int):
+        self.action = action
+        self.amount = amount
+        self.reasons = reasons
+
+    @property
+    def reason_codes(self) -> list:
+        return [name for flag, name in REASON_NAMES.items() if self.reasons & flag]
+
+    def __repr__(self):
+        return f"<RiskDecision({self.action}, amount={self.amount}, reasons={self.reason_codes})>"
+
+def exclusive_group_sums(keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """per element: sum of the values of the earlier elements with the same key"""
+    count = len(keys)
+    if count == 0:
+        return np.zeros(0)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_values = values[order]
+    cumulative = np.cumsum(sorted_values)
+    starts = np.ones(count, dtype=bool)
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(count), 0))
+    sums = np.empty(count)
+    sums[order] = cumulative - sorted_values - (cumulative[group_start] - sorted_values[group_start])
+    return sums
+
+class PreTradeRisk:
+
+    def __init__(self, limits: dict = None, capacity_accounts: int = 4, capacity_symbols: int = 64):
+        self.limits = limits or config.RISK
+        self.accounts = {}                      # account -> row
+        self.symbols = {}                       # symbol -> column
+        self.positions = np.zeros((capacity_accounts, capacity_symbols))
+        self.prices = np.full(capacity_symbols, np.nan)
+        self.account_gross = np.zeros(capacity_accounts)   # sum of |position| * price per account (positions with a price)
+        self.portfolio_gross = 0.0
+        self.max_order_notional = np.full(capacity_symbols, float(self.limits['max_order_notional']))
+        self.max_symbol_notional = np.full(capacity_symbols, float(self.limits['max_symbol_notional']))
+        self.max_account_notional = np.full(capacity_accounts, float(self.limits['max_account_notional']))
+
+    def _grow_symbols(self):
+        capacity = self.positions.shape[1]
+        self.positions = np.hstack([self.positions, np.zeros((self.positions.shape[0], capacity))])
+        self.prices = np.concatenate([self.prices, np.full(capacity, np.nan)])
+        self.max_order_notional = np.concatenate([self.max_order_notional, np.full(capacity, float(self.limits['max_order_notional']))])
+        self.max_symbol_notional = np.concatenate([self.max_symbol_notional, np.full(capacity, float(self.limits['max_symbol_notional']))])
+
+    def _grow_accounts(self):
+        capacity = self.positions.shape[0]
+        self.positions = np.vstack([self.positions, np.zeros((capacity, self.positions.shape[1]))])
+        self.account_gross = np.concatenate([self.account_gross, np.zeros(capacity)])
+        self.max_account_notional = np.concatenate([self.max_account_notional, np.full(capacity, float(self.limits['max_account_notional']))])
+
+    def symbol_index(self, symbol: str) -> int:
+        index = self.symbols.get(symbol)
+        if index is None:
+            index = self.symbols[symbol] = len(self.symbols)
+            if index >= self.positions.shape[1]:
+                self._grow_symbols()
+            overrides = self.limits['symbol_limits'].get(symbol, {})
+            self.max_order_notional[index] = overrides.get('max_order_notional', self.limits['max_order_notional'])
+            self.max_symbol_notional[index] = overrides.get('max_symbol_notional', self.limits['max_symbol_notional'])
+        return index
+
+    def account_index(self, account: str) -> int:
+        index = self.accounts.get(account)
+        if index is None:
+            index = self.accounts[account] = len(self.accounts)
+            if index >= self.positions.shape[0]:
+                self._grow_accounts()
+            self.max_account_notional[index] = self.limits['account_limits'].get(account, self.limits['max_account_notional'])
+        return index
+
+    def update_price(self, symbol: str, price):
+        if price is not None and price > 0:
+            # the index first, adding a symbol may replace the arrays
+            index = self.symbol_index(symbol)
+            old_price = self.prices[index]
+            change = float(price) - (0.0 if np.isnan(old_price) else old_price)
+            self.prices[index] = float(price)
+            if change != 0.0:
+                # revalues the positions in this symbol (one column, not the whole matrix)
+                account_change = np.abs(self.positions[:len(self.accounts), index]) * change
+                self.account_gross[:len(self.accounts)] += account_change
+                self.portfolio_gross += float(account_change.sum())
+
+    def apply(self, account: str, symbol: str, side: str, amount):
+        """adds an order (or removes its unfilled remainder with a negative amount) to the positions"""
+        sign = 1.0 if side == "buy" else -1.0
+        account_index, symbol_index = self.account_index(account), self.symbol_index(symbol)
+        before = self.positions[account_index, symbol_index]
+        after = before + sign * float(amount)
+        self.positions[account_index, symbol_index] = after
+        price = self.prices[symbol_index]
+        if not np.isnan(price):
+            change = (abs(after) - abs(before)) * price
+            self.account_gross[account_index] += change
+            self.portfolio_gross += change
+
+    def load_positions(self, positions: list):
+        """seeds the positions with persisted ones (Position rows), their average price stands in for missing prices"""
+        for position in positions:
+            if position.quantity is None or position.quantity == 0:
+                continue
+            if position.average_price is not None and np.isnan(self.prices[self.symbol_index(position.symbol)]):
+                self.update_price(position.symbol, position.average_price)
+            self.apply(position.account, position.symbol, "buy", position.quantity)
+
+    def position(self, account: str, symbol: str) -> float:
+        if account not in self.accounts or symbol not in self.symbols:
+            return 0.0
+        return float(self.positions[self.accounts[account], self.symbols[symbol]])
+
+    def check(self, orders: list) -> list:
+        """orders: (account, symbol, side, amount, price or None), returns one RiskDecision per order"""
+        count = len(orders)
+        if count == 0:
+            return []
+        if count == 1:
+            # without netting every batch is a single order: plain floats beat the array setup
+            return [self.check_one(*orders[0])]
+        accounts = np.fromiter((self.account_index(order[0]) for order in orders), dtype=np.intp, count=count)
+        symbols = np.fromiter((self.symbol_index(order[1]) for order in orders), dtype=np.intp, count=count)
+        signs = np.fromiter((1.0 if order[2] == "buy" else -1.0 for order in orders), dtype=float, count=count)
+        amounts = np.fromiter((float(order[3]) for order in orders), dtype=float, count=count)
+        limit_prices = np.fromiter((np.nan if order[4] is None else float(order[4]) for order in orders), dtype=float, count=count)
+        reasons = np.zeros(count, dtype=np.int64)
+
+        recent_prices = self.prices[symbols]
+        prices = np.where(np.isnan(limit_prices), recent_prices, limit_prices)
+        no_price = np.isnan(prices) | (prices <= 0)
+        reasons[no_price] |= REASON_NO_PRICE
+        prices = np.where(no_price, 1.0, prices)
+        with np.errstate(invalid="ignore"):
+            deviating = np.abs(limit_prices / recent_prices - 1.0) > self.limits['max_price_deviation']
+        reasons[deviating] |= REASON_PRICE_DEVIATION
+
+        # max order size
+        max_amounts = self.max_order_notional[symbols] / prices
+        too_big = amounts > max_amounts
+        reasons[too_big] |= REASON_MAX_ORDER_SIZE
+        checked = np.minimum(amounts, max_amounts)
+
+        # positions before each order, including the earlier orders of the batch
+        cells = accounts * self.positions.shape[1] + symbols
+        before = self.positions[accounts, symbols] + exclusive_group_sums(cells, signs * checked)
+        reducing = np.where(np.sign(before) == -signs, np.minimum(checked, np.abs(before)), 0.0)
+        increase = (checked - reducing) * prices
+
+        # gross notional at the recent prices (positions without price do not count)
+        account_gross = self.account_gross[accounts] + exclusive_group_sums(accounts, increase - reducing * prices)
+        portfolio_gross = self.portfolio_gross + (np.cumsum(increase - reducing * prices) - (increase - reducing * prices))
+
+        headrooms = np.vstack([
+            self.max_symbol_notional[symbols] - (np.abs(before) - reducing) * prices,
+            self.max_account_notional[accounts] - (account_gross - reducing * prices),
+            np.full(count, float(self.limits['max_portfolio_notional'])) - (portfolio_gross - reducing * prices)])
+        exceeded = headrooms < increase
+        reasons[exceeded[0]] |= REASON_SYMBOL_LIMIT
+        reasons[exceeded[1]] |= REASON_ACCOUNT_LIMIT
+        reasons[exceeded[2]] |= REASON_PORTFOLIO_LIMIT
+        allowed = reducing + np.clip(np.minimum(increase, headrooms.min(axis=0)), 0.0, None) / prices
+
+        rejected = ((reasons & REJECTING_REASONS) != 0) | (allowed < amounts * self.limits['min_resize_ratio']) | (allowed <= 0)
+        return [self.decision(bool(rejected[index]), int(reasons[index]), float(allowed[index]), orders[index][3]) for index in range(count)]
+
+    def check_one(self, account: str, symbol: str, side: str, amount, limit_price=None) -> RiskDecision:
+        """check() of a single order, the same rules on scalars"""
+        account_index, symbol_index = self.account_index(account), self.symbol_index(symbol)
+        sign = 1.0 if side == "buy" else -1.0
+        checked = float(amount)
+        reasons = 0
+
+        recent_price = float(self.prices[symbol_index])
+        price = recent_price if limit_price is None else float(limit_price)
+        if math.isnan(price) or price <= 0:
+            reasons |= REASON_NO_PRICE
+            price = 1.0
+        if limit_price is not None and not math.isnan(recent_price) and abs(float(limit_price) / recent_price - 1.0) > self.limits['max_price_deviation']:
+            reasons |= REASON_PRICE_DEVIATION
+
+        max_amount = float(self.max_order_notional[symbol_index]) / price
+        if checked > max_amount:
+            reasons |= REASON_MAX_ORDER_SIZE
+            checked = max_amount
+
+        before = float(self.positions[account_index, symbol_index])
+        reducing = min(checked, abs(before)) if before * sign < 0 else 0.0
+        increase = (checked - reducing) * price
+        headrooms = [
+            (REASON_SYMBOL_LIMIT, float(self.max_symbol_notional[symbol_index]) - (abs(before) - reducing) * price),
+            (REASON_ACCOUNT_LIMIT, float(self.max_account_notional[account_index]) - (float(self.account_gross[account_index]) - reducing * price)),
+            (REASON_PORTFOLIO_LIMIT, float(self.limits['max_portfolio_notional']) - (self.portfolio_gross - reducing * price))]
+        for reason, headroom in headrooms:
+            if headroom < increase:
+                reasons |= reason
+        allowed = reducing + max(min(increase, *(headroom for _, headroom in headrooms)), 0.0) / price
+
+        rejected = (reasons & REJECTING_REASONS) != 0 or allowed < float(amount) * self.limits['min_resize_ratio'] or allowed <= 0
+        return self.decision(rejected, reasons, allowed, amount)
+
+    def decision(self, rejected: bool, reasons: int, allowed: float, amount) -> RiskDecision:
+        if rejected:
+            return RiskDecision(REJECT, Decimal(0), reasons)
+        if reasons != 0:
+            return RiskDecision(RESIZE, Decimal(repr(allowed)), reasons)
+        return RiskDecision(ACCEPT, Decimal(str(amount)), 0)
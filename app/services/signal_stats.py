@@ -0,0 +1,181 @@
+from bisect import insort
+from collections import deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+import logging
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.trading")
+
+# ------------------------------------------------------------------------------
+# Signal statistics maintained incrementally by the workers while they apply ADD /
+# INITIALIZE / SNAPSHOT messages, so that reading them never scans app.ctx.signals.
+#
+# "all" covers every signal the worker has applied since its tables were last loaded
+# (i.e. the sliding window of the initial load plus everything added since), the
+# windowed variants cover the signals received within the last 1h / 24h.
+
+ZERO = Decimal(0)
+
+def _as_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+class SignalAggregate:
+    __slots__ = ("count", "buy_count", "sell_count", "buy_quantity", "sell_quantity", "quantity", "notional", "last_seen")
+
+    def __init__(self):
+        self.count = 0
+        self.buy_count = 0
+        self.sell_count = 0
+        self.buy_quantity = ZERO
+        self.sell_quantity = ZERO
+        self.quantity = ZERO
+        self.notional = ZERO
+        self.last_seen = None
+
+    def add(self, action: str, price, quantity, received_at):
+        price = price or ZERO
+        quantity = quantity or ZERO
+        self.count += 1
+        if action == "buy":
+            self.buy_count += 1
+            self.buy_quantity += quantity
+        elif action == "sell":
+            self.sell_count += 1
+            self.sell_quantity += quantity
+        self.quantity += quantity
+        self.notional += price * quantity
+        if received_at is not None and (self.last_seen is None or received_at > self.last_seen):
+            self.last_seen = received_at
+
+    def merge(self, other, sign: int = 1):
+        # sign=-1 removes an expired bucket again. last_seen needs no correction: if any
+        # signal of this key is left, it is in a newer bucket than the expired one
+        self.count += sign * other.count
+        self.buy_count += sign * other.buy_count
+        self.sell_count += sign * other.sell_count
+        self.buy_quantity += sign * other.buy_quantity
+        self.sell_quantity += sign * other.sell_quantity
+        self.quantity += sign * other.quantity
+        self.notional += sign * other.notional
+        if sign > 0 and other.last_seen is not None and (self.last_seen is None or other.last_seen > self.last_seen):
+            self.last_seen = other.last_seen
+        if self.count <= 0:
+            self.last_seen = None
+
+    def to_dict(self):
+        return {
+            "count":            self.count,
+            "buy_count":        self.buy_count,
+            "sell_count":       self.sell_count,
+            "buy_quantity":     self.buy_quantity,
+            "sell_quantity":    self.sell_quantity,
+            "notional":         self.notional,
+            "vwap":             self.notional / self.quantity if self.quantity != ZERO else None,
+            "last_seen":        self.last_seen
+        }
+
+class SignalStatsGroup:
+    # one aggregate in total plus one per strategy, symbol and action
+    dimensions = ("strategy", "symbol", "action")
+
+    def __init__(self):
+        self.total = SignalAggregate()
+        self.by_dimension = {dimension: {} for dimension in self.dimensions}
+
+    def add(self, signal, action: str, received_at):
+        self.total.add(action, signal.price, signal.quantity, received_at)
+        for dimension in self.dimensions:
+            key = action if dimension == "action" else getattr(signal, dimension)
+            aggregate = self.by_dimension[dimension].get(key)
+            if aggregate is None:
+                aggregate = self.by_dimension[dimension][key] = SignalAggregate()
+            aggregate.add(action, signal.price, signal.quantity, received_at)
+
+    def merge(self, other, sign: int = 1):
+        self.total.merge(other.total, sign)
+        for dimension in self.dimensions:
+            aggregates = self.by_dimension[dimension]
+            for key, other_aggregate in other.by_dimension[dimension].items():
+                aggregate = aggregates.get(key)
+                if aggregate is None:
+                    aggregate = aggregates[key] = SignalAggregate()
+                aggregate.merge(other_aggregate, sign)
+                if aggregate.count <= 0:
+                    del aggregates[key]
+
+    def to_dict(self):
+        result = {"total": self.total.to_dict()}
+        for dimension in self.dimensions:
+            result[f"by_{dimension}"] = {key: aggregate.to_dict() for key, aggregate in self.by_dimension[dimension].items()}
+        return result
+
+class WindowedSignalStats:
+    # running totals over [now - window, now], made of fixed size time buckets: adding a
+    # signal touches one bucket and the running totals, expiring subtracts whole buckets
+
+    def __init__(self, window: timedelta, bucket: timedelta):
+        self.window = window
+        self.bucket_seconds = int(bucket.total_seconds())
+        self.buckets = {}               # bucket start (epoch seconds) -> SignalStatsGroup
+        self.bucket_starts = deque()    # sorted
+        self.running = SignalStatsGroup()
+
+    def bucket_start(self, received_at: datetime) -> int:
+        timestamp = int(received_at.timestamp())
+        return timestamp - timestamp % self.bucket_seconds
+
+    def add(self, signal, action: str, received_at: datetime, now: datetime):
+        if received_at is None or received_at < now - self.window:
+            return
+        start = self.bucket_start(received_at)
+        group = self.buckets.get(start)
+        if group is None:
+            group = self.buckets[start] = SignalStatsGroup()
+            if len(self.bucket_starts) == 0 or start > self.bucket_starts[-1]:
+                self.bucket_starts.append(start)
+                # a new newest bucket: time to drop the expired ones, even if nobody reads the stats
+                self.expire(now)
+            else:
+                # late arrival for an older bucket (rare)
+                insort(self.bucket_starts, start)
+        group.add(signal, action, received_at)
+        self.running.add(signal, action, received_at)
+
+    def expire(self, now: datetime):
+        oldest_kept = self.bucket_start(now - self.window)
+        while len(self.bucket_starts) > 0 and self.bucket_starts[0] < oldest_kept:
+            self.running.merge(self.buckets.pop(self.bucket_starts.popleft()), sign=-1)
+
+class SignalStats:
+    windows = {
+        "1h":   (timedelta(hours=1), timedelta(minutes=1)),
+        "24h":  (timedelta(hours=24), timedelta(minutes=15)),
+    }
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.all = SignalStatsGroup()
+        self.windowed = {name: WindowedSignalStats(window, bucket) for name, (window, bucket) in self.windows.items()}
+
+    def add(self, signals, now: datetime = None):
+        now = now or datetime.now()
+        for signal in signals:
+            action = (signal.action or "").lower()
+            received_at = _as_datetime(signal.received_at)
+            self.all.add(signal, action, received_at)
+            for windowed_stats in self.windowed.values():
+                windowed_stats.add(signal, action, received_at, now)
+
+    def to_dict(self, window: str = None, now: datetime = None):
+        if window is None or window == "all":
+            return self.all.to_dict()
+        if window not in self.windowed:
+            raise ValueError(f"unknown window {window} (supported: all, {', '.join(self.windowed)})")
+        windowed_stats = self.windowed[window]
+        windowed_stats.expire(now or datetime.now())
+        return windowed_stats.running.to_dict()
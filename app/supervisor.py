@@ -0,0 +1,136 @@
+from datetime import datetime
+import logging
+from multiprocessing import Process
+import simplejson as json
+import threading
+import time
+
+# project imports
+import config
+from app.utils.serializer import datetime_serializer
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root")
+
+# ------------------------------------------------------------------------------
+
+class SupervisedChild:
+    def __init__(self, name, target, args=()):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.restarts = 0
+        self.backoff = config.PROCESSES['restart_backoff_initial']
+        self.next_start_at = 0.0        # monotonic time of the next (re)start attempt
+        self.started_at = None          # monotonic time of the last start
+        self.started_at_wall = None
+        self.last_exitcode = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.process = Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.started_at_wall = datetime.now()
+
+    def to_dict(self):
+        return {
+            "name":         self.name,
+            "pid":          self.process.pid if self.process is not None else None,
+            "alive":        self.is_alive(),
+            "restarts":     self.restarts,
+            "last_exitcode": self.last_exitcode,
+            "started_at":   self.started_at_wall,
+            "backoff":      self.backoff
+        }
+
+class ProcessSupervisor:
+    # Starts the background processes (DB writers, exchange executors), restarts crashed
+    # children with exponential backoff and reports their health to redis (hash
+    # config.PROCESSES['health_key'], one JSON field per child) so that workers can serve it.
+    #
+    # The supervisor runs in a thread of the main process: the main process loop is not
+    # running anymore once Sanic has started its workers.
+
+    def __init__(self, redis_conn=None):
+        self.children = []
+        self.redis_conn = redis_conn
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, name, target, args=()):
+        self.children.append(SupervisedChild(name, target, args))
+
+    def start(self):
+        for child in self.children:
+            logger.debug(f"SUPERVISOR: starting {child.name}")
+            child.start()
+        self._thread = threading.Thread(target=self._run, name="supervisor", daemon=True)
+        self._thread.start()
+
+    def check(self):
+        now = time.monotonic()
+        for child in self.children:
+            if child.is_alive():
+                # reset backoff once a child has been running long enough
+                if child.started_at is not None and now - child.started_at > config.PROCESSES['restart_backoff_reset_after']:
+                    child.backoff = config.PROCESSES['restart_backoff_initial']
+                continue
+
+            # child died since the last check: schedule a restart
+            if child.started_at is not None:
+                child.last_exitcode = child.process.exitcode
+                child.started_at = None
+                child.next_start_at = now + child.backoff
+                logger.error(f"SUPERVISOR: {child.name} exited with code {child.last_exitcode}, restarting in {child.backoff:.1f}s")
+                child.backoff = min(child.backoff * 2, config.PROCESSES['restart_backoff_max'])
+
+            if now >= child.next_start_at and not self._stop_event.is_set():
+                child.restarts += 1
+                logger.warning(f"SUPERVISOR: restarting {child.name} (restart #{child.restarts})")
+                try:
+                    child.start()
+                except Exception as e:
+                    logger.error(f"SUPERVISOR: failed to restart {child.name}: {e}")
+                    child.next_start_at = now + child.backoff
+
+    def health(self):
+        return {child.name: child.to_dict() for child in self.children}
+
+    def report_health(self):
+        if self.redis_conn is None:
+            return
+        try:
+            self.redis_conn.hset(config.PROCESSES['health_key'], mapping={
+                name: json.dumps(child_health, default=datetime_serializer)
+                for name, child_health in self.health().items()})
+        except Exception as e:
+            logger.warning(f"SUPERVISOR: failed to report health: {e}")
+
+    def _run(self):
+        while not self._stop_event.wait(config.PROCESSES['supervisor_interval']):
+            self.check()
+            self.report_health()
+
+    def stop(self, timeout=5.0):
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        for child in self.children:
+            if child.is_alive():
+                logger.warning(f"SUPERVISOR: stopping {child.name}")
+                child.process.terminate()
+        for child in self.children:
+            if child.process is None:
+                continue
+            child.process.join(timeout)
+            if child.process.is_alive():
+                logger.error(f"SUPERVISOR: killing {child.name} (did not stop within {timeout}s)")
+                child.process.kill()
+                child.process.join()
+        self.report_health()
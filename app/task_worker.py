@@ -1,31 +1,146 @@
 
 import asyncio
+from datetime import datetime, timedelta
 import logging
 import os
-import redis.asyncio
 import simplejson as json
+import time
 
 
 # project imports
+import config
 from app.models_db import Account, Signal, WebSource
-from models_mem import OurGenericList
+from models_mem import OurGenericList, Order
+from app.utils.profiling import start_profile_task
+from app.utils.transport import get_channels
+from app.utils.sharding import DB_CHANNEL, shard_channel
+from app.utils.snapshot import snapshot_from_dict
 
 # project definitions and globals
 logger = logging.getLogger("sanic.root.webhook")
 
 
+def apply_snapshot(app, snapshot_version, tables, logprefix=""):
+    # replace all tables, a worker is ready to serve traffic once this has been done once
+    if app.ctx.snapshot_version is not None and snapshot_version < app.ctx.snapshot_version:
+        logger.debug(f"{logprefix}ignoring snapshot {snapshot_version} (have {app.ctx.snapshot_version})")
+        return
+    for tablename, given_list in tables.items():
+        if not hasattr(app.ctx, tablename):
+            logger.error(f"{logprefix}snapshot contains unknown table {tablename}")
+            continue
+        getattr(app.ctx, tablename).clear()
+        getattr(app.ctx, tablename).extend(given_list)
+        if tablename == Signal.get_tablename():
+            app.ctx.signal_stats.reset()
+            app.ctx.signal_stats.add(getattr(app.ctx, tablename))
+    app.ctx.snapshot_version = snapshot_version
+    app.ctx.tables_ready = True
+    logger.debug(f"{logprefix}loaded snapshot {snapshot_version}: " + ", ".join(f"{len(given_list)} {tablename}" for tablename, given_list in tables.items()))
+
+def upsert_items(target_list, given_list):
+    """replace items with the same primary key, append the others (returns the appended items)"""
+    appended = []
+    if hasattr(target_list, "upsert"):
+        # sorted lists move items on every write, they look each primary key up themselves
+        for item in given_list:
+            if target_list.upsert(item):
+                appended.append(item)
+        return appended
+    # plain lists only grow at the end, the positions stay valid while writing
+    positions = {item.pk: index for index, item in enumerate(target_list)}
+    for item in given_list:
+        if item.pk in positions:
+            target_list[positions[item.pk]] = item
+        else:
+            positions[item.pk] = len(target_list)
+            target_list.append(item)
+            appended.append(item)
+    return appended
+
+def prune_final_orders(orders, now: datetime = None) -> int:
+    """drops the orders final for longer than the retention period, returns their number"""
+    cutoff = (now or datetime.now()) - timedelta(seconds=config.EXCHANGE['final_order_retention'])
+    kept = [order for order in orders if not (order.is_final and order.updated_at < cutoff)]
+    dropped = len(orders) - len(kept)
+    if dropped > 0:
+        orders[:] = kept
+    return dropped
+
+def apply_list_operation(app, operation, given_list, logprefix=""):
+    # apply an ADD / DELETE / INITIALIZE / MODIFY / UPSERT message to the table lists in app.ctx
+    tablename = given_list.item_class.get_tablename()
+    old_item_count = len(getattr(app.ctx, tablename))
+
+    if operation in [ "DELETE", "MODIFY" ]:
+        #FIXME: implement missing operations
+        logger.error(f"{logprefix}operation not implemented")
+
+    elif operation == "ADD":
+        target_list = getattr(app.ctx, tablename)
+        appended = given_list
+        try:
+            if hasattr(target_list, "upsert"):
+                # with several DB shards an insert may already be in the snapshot taken before its ADD
+                appended = upsert_items(target_list, given_list)
+                target_list.evict()
+            else:
+                target_list.extend(given_list)
+        except Exception as e:
+            logger.error(f"{logprefix}failed to extend list app.ctx.{tablename}: {e}")
+        if len(given_list) > 0:
+            logger.debug(f"{logprefix}added {len(appended)} of {len(given_list)} {tablename} (total count: {len(target_list)})")
+        # signals accepted by other workers must be rejected here too
+        if tablename == Signal.get_tablename():
+            app.ctx.signal_stats.add(appended)
+            for signal in given_list:
+                app.ctx.signal_dedup.remember(signal.strategy, signal.order_id)
+
+    elif operation == "UPSERT":
+        try:
+            appended = upsert_items(getattr(app.ctx, tablename), given_list)
+        except Exception as e:
+            logger.error(f"{logprefix}failed to upsert into list app.ctx.{tablename}: {e}")
+            return
+        if tablename == Signal.get_tablename():
+            getattr(app.ctx, tablename).evict()
+            app.ctx.signal_stats.add(appended)
+        elif tablename == Order.get_tablename():
+            # the exchange process forgets final orders, the workers keep them for a while only
+            prune_final_orders(getattr(app.ctx, tablename))
+        logger.debug(f"{logprefix}upserted {len(given_list)} {tablename} ({len(appended)} new, total count: {len(getattr(app.ctx, tablename))})")
+
+    elif operation == "INITIALIZE":
+        getattr(app.ctx, tablename).clear()
+        getattr(app.ctx, tablename).extend(given_list)
+        if tablename == Signal.get_tablename():
+            app.ctx.signal_stats.reset()
+            app.ctx.signal_stats.add(getattr(app.ctx, tablename))
+        if len(given_list) > 0 or old_item_count > 0:
+            logger.debug(f"{logprefix}added {len(given_list)} {tablename} (dropped {old_item_count})")
+
 async def worker_background_task_to_process_messages(app):
 
     logprefix_base = f"WorkerBG[{os.getpid()}]: "
     logprefix = logprefix_base
 
-    # Create a Redis connection
-    logger.debug(f"{logprefix}setting up redis and subscribing to workers_channel...")
-    redis_url = os.getenv("REDIS_URL", "redis://localhost")
-    redis_conn = await redis.asyncio.from_url(redis_url)
-    app.ctx.redis_conn = redis_conn # workers must only publish (and not receive) messages
-    redis_pubsub = redis_conn.pubsub()
-    await redis_pubsub.subscribe("workers_channel")
+    # subscribe to the channels (redis or local transport)
+    logger.debug(f"{logprefix}subscribing to workers_channel ({config.TRANSPORT['kind']} transport)...")
+    channels = get_channels()
+    pubsub = channels.pubsub()
+    reply_channel = f"worker_channel.{os.getpid()}"
+    await pubsub.subscribe("workers_channel", reply_channel)
+
+    # ask the DB process (shard 0) for the current state, repeated until it answers
+    snapshot_requested_at = None
+    pending_adds = []           # ADD messages received while the snapshot request is outstanding
+
+    async def request_snapshot():
+        logger.debug(f"{logprefix_base}requesting snapshot on {reply_channel}")
+        await channels.publish(shard_channel(DB_CHANNEL, 0), json.dumps({
+            "operation": "SNAPSHOT_REQUEST",
+            "reply_channel": reply_channel}))
+        return time.monotonic()
 
 
     def get_list_from_message_data(message_data, logprefix=""):
@@ -64,8 +179,13 @@ async def worker_background_task_to_process_messages(app):
 
     logger.debug(f"{logprefix}READY to receive messages")
     try:
+        snapshot_requested_at = await request_snapshot()
         while True:
-            message = await redis_pubsub.get_message(ignore_subscribe_messages=True)
+            if snapshot_requested_at is not None and time.monotonic() - snapshot_requested_at > config.SNAPSHOT['request_timeout']:
+                snapshot_requested_at = await request_snapshot()
+
+            # wait up to 100ms for the next message (instead of sleeping after each one)
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
             if message is not None and message["type"] == "message":
 
                 # extract message data
@@ -81,49 +201,47 @@ async def worker_background_task_to_process_messages(app):
                 if operation == "STOP":
                     break
 
-                if operation in [ "ADD", "DELETE", "INITIALIZE", "MODIFY" ]:
+                if operation == "PROFILE":
+                    start_profile_task(channels, message_data, logprefix_base)
+
+                elif operation == "SNAPSHOT":
+                    try:
+                        snapshot_version, tables = snapshot_from_dict(message_data)
+                    except Exception as e:
+                        logger.error(f"{logprefix}failed to read snapshot: {e}")
+                        continue
+                    apply_snapshot(app, snapshot_version, tables, logprefix)
+                    # the snapshot may have been read before these were inserted
+                    for given_list in pending_adds:
+                        tablename = given_list.item_class.get_tablename()
+                        present_pks = set(getattr(app.ctx, tablename).pks())
+                        missing_items = [item for item in given_list if item.pk not in present_pks]
+                        getattr(app.ctx, tablename).extend(missing_items)
+                        if tablename == Signal.get_tablename():
+                            app.ctx.signal_stats.add(missing_items)
+                    pending_adds = []
+                    snapshot_requested_at = None
+
+                elif operation in [ "ADD", "DELETE", "INITIALIZE", "MODIFY", "UPSERT" ]:
                     given_list = get_list_from_message_data(message_data=message_data, logprefix=logprefix)
                     if given_list is None:
                         continue
 
                     # logger.debug(f"{logprefix}received {len(given_list)} items: {given_list.to_json()}")
 
-                    tablename = given_list[0].__class__.get_tablename()
-                    old_item_count = len(getattr(app.ctx, tablename))
-
-                    if operation in [ "DELETE", "MODIFY" ]:
-                        #FIXME: implement missing operations
-                        logger.error(f"{logprefix}operation not implemented")
-
-                    elif operation == "ADD":
-                        try:
-                            getattr(app.ctx, tablename).extend(given_list)
-                        except Exception as e:
-                            logger.error(f"{logprefix}failed to extend list app.ctx.{tablename}: {e}")
-                        if len(given_list) > 0:
-                            logger.debug(f"{logprefix}added {len(given_list)} {tablename} (total count: {len(getattr(app.ctx, tablename))})")
-
-                    elif operation == "INITIALIZE":
-                        getattr(app.ctx, tablename).clear()
-                        getattr(app.ctx, tablename).extend(given_list)
-                        if len(given_list) > 0 or old_item_count > 0:
-                            logger.debug(f"{logprefix}added {len(given_list)} {tablename} (dropped {old_item_count})")
+                    if operation == "ADD" and snapshot_requested_at is not None:
+                        pending_adds.append(given_list)
+                    apply_list_operation(app, operation, given_list, logprefix)
 
                 elif operation == "STOP":
                     break 
 
                 else:
                     logger.error(f"{logprefix}ignoring message")
-
-            # Sleep for a short time to avoid blocking the event loop
-            await asyncio.sleep(0.1)
     except asyncio.CancelledError:
         logger.debug(f"{logprefix}CANCELLED")
     finally:
         logger.debug(f"{logprefix}CLEANUP")
 
-    # redis_pubsub.close()
-    # await redis_pubsub.wait_closed()
-    redis_conn.close()
-    await redis_conn.wait_closed()
-    app.ctx.redis_conn = None
+    # the connections themselves are closed by the worker's shutdown listener
+    await pubsub.aclose()
@@ -0,0 +1,102 @@
+import hmac
+import logging
+import math
+import re
+import time
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.webhook")
+
+# ------------------------------------------------------------------------------
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate                # tokens per second
+        self.burst = burst              # bucket size
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def try_take(self, tokens: float = 1.0):
+        """returns (taken, seconds until enough tokens are available)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True, 0.0
+        return False, (tokens - self.tokens) / self.rate if self.rate > 0 else float(config.WEBHOOK['retry_after_seconds'])
+
+class AdmissionController:
+    # Per worker admission control for /webhook:
+    #   - at most max_in_flight requests are processed concurrently, the next ones are
+    #     answered right away with 503 + Retry-After instead of queueing up behind a slow
+    #     redis / DB process
+    #   - a token bucket per WebSource.source_name (see get_source_name()) answers bursts
+    #     with 429 + Retry-After
+    # All decisions are counted, see to_dict().
+
+    def __init__(self, max_in_flight: int = None, rate_limits: dict = None):
+        self.max_in_flight = max_in_flight or config.WEBHOOK['max_in_flight']
+        self.rate_limits = rate_limits or config.WEBHOOK['rate_limits']
+        self.in_flight = 0
+        self.max_in_flight_seen = 0
+        self.buckets = {}
+        self.counters = {"admitted": 0, "shed_overload": 0, "shed_rate_limited": 0}
+        self.rate_limited_by_source = {}
+
+    def try_admit(self):
+        """returns (admitted, retry_after_seconds), an admitted request must be release()d"""
+        if self.in_flight >= self.max_in_flight:
+            self.counters["shed_overload"] += 1
+            return False, config.WEBHOOK['retry_after_seconds']
+        self.in_flight += 1
+        self.max_in_flight_seen = max(self.max_in_flight_seen, self.in_flight)
+        self.counters["admitted"] += 1
+        return True, 0
+
+    def release(self):
+        self.in_flight -= 1
+
+    def check_rate(self, source_name: str):
+        """returns (allowed, retry_after_seconds) for one request of the given source"""
+        bucket = self.buckets.get(source_name)
+        if bucket is None:
+            limits = self.rate_limits.get(source_name, self.rate_limits['default'])
+            bucket = self.buckets[source_name] = TokenBucket(limits['rate'], limits['burst'])
+        allowed, retry_after = bucket.try_take()
+        if not allowed:
+            self.counters["shed_rate_limited"] += 1
+            self.rate_limited_by_source[source_name] = self.rate_limited_by_source.get(source_name, 0) + 1
+            return False, max(1, math.ceil(retry_after))
+        return True, 0
+
+    def to_dict(self):
+        return {
+            **self.counters,
+            "in_flight":                self.in_flight,
+            "max_in_flight":            self.max_in_flight,
+            "max_in_flight_seen":       self.max_in_flight_seen,
+            "rate_limited_by_source":   dict(self.rate_limited_by_source)
+        }
+
+def get_source_name(websources, data: dict, remote_ip: str, token: str = None) -> str:
+    # the quota belongs to the authenticated source: the one whose secret (password_seed)
+    # came with the request, else the first one allowing the ip. The unauthenticated
+    # "source" field of the payload only counts if neither identifies a source, and then
+    # in a bucket of its own (a client must not spend or dodge the quota of another source)
+    if token:
+        for websource in websources:
+            if websource.password_seed is not None and hmac.compare_digest(token.encode(), websource.password_seed.encode()):
+                return websource.source_name
+    for websource in websources:
+        if websource.ok_ips is not None and re.match(websource.ok_ips, remote_ip or ""):
+            return websource.source_name
+    if isinstance(data, dict) and data.get("source"):
+        # only known names, unknown ones must not get a fresh bucket each
+        for websource in websources:
+            if websource.source_name == data["source"]:
+                return f"{websource.source_name} (unverified)"
+    return "unknown"
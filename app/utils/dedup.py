@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import logging
+import time
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.webhook")
+
+# ------------------------------------------------------------------------------
+
+class SignalDeduplicator:
+    # Remembers (strategy, order_id) pairs seen by this worker for a limited time.
+    #
+    # The local set is bounded (oldest entries are dropped first) and is checked first,
+    # so a retried alert hitting the same worker is answered without any I/O. The first
+    # time a pair is seen locally it is claimed in redis with SET NX EX, which closes the
+    # race between workers (and between app instances sharing the same redis).
+
+    def __init__(self, window_seconds=None, max_entries=None, redis_prefix=None):
+        self.window_seconds = window_seconds or config.WEBHOOK['dedup_window_seconds']
+        self.max_entries = max_entries or config.WEBHOOK['dedup_max_entries']
+        self.redis_prefix = redis_prefix or config.WEBHOOK['dedup_redis_prefix']
+        self._seen = OrderedDict()      # key -> expiry (monotonic), ordered by insertion
+        self.counters = {"accepted": 0, "duplicate_local": 0, "duplicate_redis": 0, "redis_errors": 0}
+
+    def _evict(self, now):
+        while self._seen:
+            key, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    @staticmethod
+    def make_key(strategy, order_id):
+        return f"{strategy}\x1f{order_id}"
+
+    def remember(self, strategy, order_id):
+        """mark a pair as seen without checking (e.g. signals added by other workers)"""
+        if order_id is None:
+            return
+        now = time.monotonic()
+        key = self.make_key(strategy, order_id)
+        self._seen[key] = now + self.window_seconds
+        self._seen.move_to_end(key)
+        self._evict(now)
+
+    async def forget(self, strategy, order_id, redis_conn=None):
+        """release a pair again (e.g. the signal could not be handed over to the db process)"""
+        self._seen.pop(self.make_key(strategy, order_id), None)
+        if redis_conn is not None:
+            try:
+                await redis_conn.delete(f"{self.redis_prefix}{self.make_key(strategy, order_id)}")
+            except Exception as e:
+                logger.warning(f"{self.__class__.__name__}: failed to release {strategy}/{order_id} in redis: {e}")
+
+    def seen_locally(self, strategy, order_id) -> bool:
+        now = time.monotonic()
+        self._evict(now)
+        expires_at = self._seen.get(self.make_key(strategy, order_id))
+        return expires_at is not None and expires_at > now
+
+    async def is_duplicate(self, strategy, order_id, redis_conn=None) -> bool:
+        # signals without an order id cannot be deduplicated
+        if order_id is None or order_id == "":
+            self.counters["accepted"] += 1
+            return False
+
+        if self.seen_locally(strategy, order_id):
+            self.counters["duplicate_local"] += 1
+            return True
+
+        if redis_conn is not None:
+            redis_key = f"{self.redis_prefix}{self.make_key(strategy, order_id)}"
+            try:
+                claimed = await redis_conn.set(redis_key, 1, nx=True, ex=int(self.window_seconds))
+            except Exception as e:
+                # fail open: losing dedup is better than losing signals
+                logger.warning(f"{self.__class__.__name__}: redis check failed for {strategy}/{order_id}: {e}")
+                self.counters["redis_errors"] += 1
+                claimed = True
+            if not claimed:
+                self.remember(strategy, order_id)
+                self.counters["duplicate_redis"] += 1
+                return True
+
+        self.remember(strategy, order_id)
+        self.counters["accepted"] += 1
+        return False
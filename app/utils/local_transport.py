@@ -0,0 +1,238 @@
+import asyncio
+from collections import deque
+import logging
+import os
+import struct
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root")
+
+# ------------------------------------------------------------------------------
+# Single host transport for the channels (workers_channel, db_channel.N, broker_channel.N,
+# reply channels): a hub process relays frames between unix domain socket connections.
+# Clients offer the subset of the redis client interface the processes use:
+#
+#   client.publish(channel, data) -> number of receivers
+#   client.publish_many([(channel, data), ...]) -> receiver counts (one write, like a pipeline)
+#   client.pubsub() -> subscribe(*channels), unsubscribe(*channels), get_message(timeout=...), aclose()
+#
+# Like redis pub/sub, messages are not stored: subscribers that are not connected (or
+# whose buffer exceeds max_subscriber_buffer) miss them. Subscriptions are restored after
+# the hub has been restarted.
+#
+# Frame: op (1 byte), channel length (2 bytes), data length (4 bytes), channel, data
+
+FRAME_HEADER = struct.Struct("!BHI")
+OP_SUBSCRIBE = 1
+OP_UNSUBSCRIBE = 2
+OP_PUBLISH = 3
+OP_MESSAGE = 4
+OP_PUBLISH_ACK = 5
+
+def encode_frame(op: int, channel, data=b"") -> bytes:
+    channel = channel.encode("utf-8") if isinstance(channel, str) else channel
+    data = data.encode("utf-8") if isinstance(data, str) else data
+    return FRAME_HEADER.pack(op, len(channel), len(data)) + channel + data
+
+async def read_frame(reader: asyncio.StreamReader):
+    op, channel_length, data_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    payload = await reader.readexactly(channel_length + data_length)
+    return op, payload[:channel_length], payload[channel_length:]
+
+class LocalHub:
+
+    def __init__(self, path: str = None, max_subscriber_buffer: int = None):
+        self.path = path or config.TRANSPORT['socket_path']
+        self.max_subscriber_buffer = max_subscriber_buffer or config.TRANSPORT['max_subscriber_buffer']
+        self.subscribers = {}           # channel (bytes) -> set of StreamWriters
+
+    def drop_subscriber(self, writer, channels):
+        for channel in channels:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(writer)
+                if len(subscribers) == 0:
+                    del self.subscribers[channel]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels = set()
+        try:
+            while True:
+                op, channel, data = await read_frame(reader)
+                if op == OP_PUBLISH:
+                    frame = encode_frame(OP_MESSAGE, channel, data)
+                    receivers = 0
+                    for subscriber in list(self.subscribers.get(channel, ())):
+                        if subscriber.transport.get_write_buffer_size() > self.max_subscriber_buffer:
+                            # a stuck subscriber must not make the hub run out of memory
+                            logger.error(f"LocalHub: dropping subscriber of {channel.decode()} (output buffer full)")
+                            subscriber.close()
+                            continue
+                        subscriber.write(frame)
+                        receivers += 1
+                    writer.write(encode_frame(OP_PUBLISH_ACK, b"", struct.pack("!I", receivers)))
+                    await writer.drain()
+                elif op == OP_SUBSCRIBE:
+                    self.subscribers.setdefault(channel, set()).add(writer)
+                    channels.add(channel)
+                elif op == OP_UNSUBSCRIBE:
+                    self.drop_subscriber(writer, [channel])
+                    channels.discard(channel)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.drop_subscriber(writer, channels)
+            writer.close()
+
+    async def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_connection, path=self.path)
+        logger.info(f"LocalHub: listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+def local_hub_process():
+    """Run the local transport hub (started by the supervisor if config.TRANSPORT['kind'] is 'local')."""
+    asyncio.run(LocalHub().run())
+
+# ------------------------------------------------------------------------------
+
+class LocalPubSub:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.channels = set()
+        self.messages = asyncio.Queue()
+        self._writer = None
+        self._reader_task = None
+        self._connected = asyncio.Event()
+
+    async def _connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        for channel in self.channels:
+            self._writer.write(encode_frame(OP_SUBSCRIBE, channel))
+        await self._writer.drain()
+        self._connected.set()
+        return reader
+
+    async def _read_messages(self):
+        # (re)connects until closed, a cancelled get_message() must not lose half a frame
+        delay = 0.01
+        while True:
+            try:
+                reader = await self._connect()
+                delay = 0.01
+                while True:
+                    op, channel, data = await read_frame(reader)
+                    if op == OP_MESSAGE:
+                        self.messages.put_nowait({"type": "message", "pattern": None, "channel": channel, "data": data})
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self._connected.clear()
+                logger.warning(f"LocalPubSub: connection to {self.path} lost, reconnecting in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, config.TRANSPORT['reconnect_delay_max'])
+
+    async def subscribe(self, *channels):
+        new_channels = [channel for channel in channels if channel not in self.channels]
+        self.channels.update(new_channels)
+        if self._reader_task is None:
+            self._reader_task = asyncio.create_task(self._read_messages())
+            # subscriptions of the first connection are sent by _connect()
+            await self._connected.wait()
+            return
+        if self._connected.is_set():
+            for channel in new_channels:
+                self._writer.write(encode_frame(OP_SUBSCRIBE, channel))
+            await self._writer.drain()
+
+    async def unsubscribe(self, *channels):
+        for channel in channels:
+            self.channels.discard(channel)
+            if self._connected.is_set():
+                self._writer.write(encode_frame(OP_UNSUBSCRIBE, channel))
+        if self._connected.is_set():
+            await self._writer.drain()
+
+    async def get_message(self, ignore_subscribe_messages: bool = True, timeout: float = 0.0):
+        # subscribe confirmations are not delivered, ignore_subscribe_messages is always true
+        try:
+            if timeout is None:
+                return await self.messages.get()
+            if timeout <= 0:
+                return self.messages.get_nowait()
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+
+    async def aclose(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._connected.clear()
+
+class LocalClient:
+
+    def __init__(self, path: str = None):
+        self.path = path or config.TRANSPORT['socket_path']
+        self._writer = None
+        self._acks = deque()            # futures of the publishes waiting for the hub's ack
+        self._ack_task = None
+        self._connect_lock = asyncio.Lock()
+
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self._writer is None:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                self._ack_task = asyncio.create_task(self._read_acks(reader))
+
+    async def _read_acks(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                op, _, data = await read_frame(reader)
+                if op == OP_PUBLISH_ACK and len(self._acks) > 0:
+                    future = self._acks.popleft()
+                    if not future.done():
+                        future.set_result(struct.unpack("!I", data)[0])
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # the publishes in flight fail like on a lost redis connection, the next one reconnects
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            while len(self._acks) > 0:
+                future = self._acks.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(f"connection to {self.path} lost: {e}"))
+
+    async def publish_many(self, messages) -> list:
+        await self._ensure_connected()
+        futures = []
+        for channel, data in messages:
+            future = asyncio.get_running_loop().create_future()
+            self._acks.append(future)
+            futures.append(future)
+            self._writer.write(encode_frame(OP_PUBLISH, channel, data))
+        await self._writer.drain()
+        return list(await asyncio.gather(*futures))
+
+    async def publish(self, channel, data) -> int:
+        return (await self.publish_many([(channel, data)]))[0]
+
+    def pubsub(self) -> LocalPubSub:
+        return LocalPubSub(self.path)
+
+    async def aclose(self):
+        if self._ack_task is not None:
+            self._ack_task.cancel()
+            await asyncio.gather(self._ack_task, return_exceptions=True)
+            self._ack_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
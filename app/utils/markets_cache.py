@@ -0,0 +1,133 @@
+import asyncio
+import ccxt
+import fcntl
+import logging
+import os
+import simplejson as json
+import tempfile
+import time
+
+# project imports
+import config
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+# bump whenever the layout of the cache files changes, old files are ignored then
+MARKETS_CACHE_FORMAT_VERSION = 1
+
+# ------------------------------------------------------------------------------
+
+class MarketsCache:
+    # On-disk cache of the ccxt markets and currencies of one exchange, shared by all
+    # processes on the host:
+    #   - files are written atomically (temp file + rename), readers never see partial data
+    #   - a lock file makes sure only one process refreshes an exchange at a time
+    #   - the file is parsed on first use, and again only after it has been replaced
+    #   - refresh_loop() applies every new version of the file to the clients of the
+    #     exchange, whichever process wrote it
+    # A stale cache (ttl expired or written by another ccxt version) is still used to start
+    # trading right away, refresh_loop() replaces it in the background.
+
+    def __init__(self, exchange_id: str, cache_dir: str = None, ttl: float = None):
+        self.exchange_id = exchange_id
+        self.cache_dir = cache_dir or config.CCXT['markets_cache_dir']
+        self.ttl = ttl or config.CCXT['markets_cache_ttl']
+        self.path = os.path.join(self.cache_dir, f"{exchange_id}.markets.v{MARKETS_CACHE_FORMAT_VERSION}.json")
+        self._data = None
+        self._mtime = None
+        self._applied_mtime = None              # version of the file set on the client
+
+    def load(self):
+        """returns the cached data (dict with markets and currencies) or None"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        if self._data is not None and mtime == self._mtime:
+            return self._data
+        try:
+            with open(self.path, "rb") as cache_file:
+                data = json.loads(cache_file.read())
+        except Exception as e:
+            logger.warning(f"{self.__class__.__name__}: ignoring unreadable cache {self.path}: {e}")
+            return None
+        if data.get("format") != MARKETS_CACHE_FORMAT_VERSION or data.get("exchange_id") != self.exchange_id:
+            return None
+        self._data, self._mtime = data, mtime
+        return data
+
+    def is_stale(self) -> bool:
+        data = self.load()
+        return (data is None
+                or data.get("ccxt_version") != ccxt.__version__
+                or time.time() - data.get("fetched_at", 0) > self.ttl)
+
+    def store(self, markets: dict, currencies: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        json_str = json.dumps({
+            "format":       MARKETS_CACHE_FORMAT_VERSION,
+            "exchange_id":  self.exchange_id,
+            "ccxt_version": ccxt.__version__,
+            "fetched_at":   time.time(),
+            "markets":      markets,
+            "currencies":   currencies
+        }, separators=(",", ":"))
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{self.exchange_id}-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(json_str)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def apply_to(self, exchange) -> bool:
+        """set the cached markets on a ccxt exchange instance, returns False if there are none"""
+        data = self.load()
+        if data is None:
+            return False
+        exchange.set_markets(data["markets"], data["currencies"])
+        return True
+
+    def apply_if_changed(self, exchanges: list) -> bool:
+        """applies the cache file to the clients if it changed since it was last applied"""
+        if self.load() is None or self._mtime == self._applied_mtime:
+            return False
+        logger.debug(f"{self.__class__.__name__}: applying new markets of {self.exchange_id} to {len(exchanges)} clients")
+        for exchange in exchanges:
+            self.apply_to(exchange)
+        self._applied_mtime = self._mtime
+        return True
+
+    async def refresh(self, exchange) -> bool:
+        # another process refreshing the same exchange will write the file for us
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                if not self.is_stale():
+                    return False
+                logger.debug(f"{self.__class__.__name__}: loading markets of {self.exchange_id}...")
+                markets = await exchange.load_markets(reload=True)
+                await asyncio.to_thread(self.store, markets, exchange.currencies)
+                logger.debug(f"{self.__class__.__name__}: cached {len(markets)} markets of {self.exchange_id}")
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def refresh_loop(self, exchange, clients: list = None):
+        """refreshes the cache with `exchange`, new versions go to it and to `clients` (the list may grow)"""
+        while True:
+            try:
+                await self.refresh(exchange)
+                # also if another process refreshed the file (or it was fresh already)
+                self.apply_if_changed([exchange, *(clients or [])])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{self.__class__.__name__}: failed to refresh markets of {self.exchange_id}: {e}")
+            await asyncio.sleep(min(self.ttl, config.CCXT['markets_cache_check_interval']))
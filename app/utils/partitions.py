@@ -0,0 +1,93 @@
+from datetime import date, datetime, timedelta
+import logging
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.db")
+
+# ------------------------------------------------------------------------------
+# Daily range partitions of the signals table: signals_pYYYYMMDD holds [day, day + 1).
+# Rows outside of all partitions end up in signals_default. Dropping a whole partition
+# is a cheap catalog operation compared to DELETE ... WHERE received_at < ...
+#
+# signals_default only holds strays (replays without --rebase, back-dated signals): they
+# are moved into a day's partition when it is created (PostgreSQL refuses to create it
+# while the default partition has rows of that day) and pruned by the same retention.
+
+PARENT_TABLE = "signals"
+PARTITION_PREFIX = f"{PARENT_TABLE}_p"
+DEFAULT_PARTITION = f"{PARENT_TABLE}_default"
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day.strftime('%Y%m%d')}"
+
+def partition_day(name: str):
+    """returns the day of a partition name or None for other tables (e.g. the default partition)"""
+    if not name.startswith(PARTITION_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    result = await conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = :name"),
+        {"name": PARENT_TABLE})
+    return result.first() is not None
+
+async def list_partitions(conn: AsyncConnection):
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :name"),
+        {"name": PARENT_TABLE})
+    return [row[0] for row in result]
+
+async def ensure_partitions(conn: AsyncConnection, today: date, days_ahead: int):
+    existing = set(await list_partitions(conn))
+    if DEFAULT_PARTITION not in existing:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        name = partition_name(day)
+        if name in existing:
+            continue
+        logger.debug(f"ensure_partitions(): creating partition {name}")
+        bounds = {"start": day, "end": day + timedelta(days=1)}
+        strays = await conn.execute(text(
+            f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE received_at >= :start AND received_at < :end LIMIT 1"), bounds)
+        moving = strays.first() is not None
+        if moving:
+            # parked in a temporary table while the partition is created (same transaction)
+            await conn.execute(text(
+                f"CREATE TEMP TABLE signals_moving ON COMMIT DROP AS "
+                f"SELECT * FROM {DEFAULT_PARTITION} WHERE received_at >= :start AND received_at < :end"), bounds)
+            await conn.execute(text(
+                f"DELETE FROM {DEFAULT_PARTITION} WHERE received_at >= :start AND received_at < :end"), bounds)
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT_TABLE} "
+            f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"))
+        if moving:
+            result = await conn.execute(text(f"INSERT INTO {PARENT_TABLE} SELECT * FROM signals_moving"))
+            await conn.execute(text("DROP TABLE signals_moving"))
+            logger.info(f"ensure_partitions(): moved {result.rowcount} signals from {DEFAULT_PARTITION} to {name}")
+
+async def drop_expired_partitions(conn: AsyncConnection, today: date, retention_days: int):
+    """drops all daily partitions ending before today - retention_days, returns their names"""
+    cutoff = today - timedelta(days=retention_days)
+    dropped = []
+    for name in await list_partitions(conn):
+        day = partition_day(name)
+        if day is not None and day + timedelta(days=1) <= cutoff:
+            logger.info(f"drop_expired_partitions(): dropping partition {name}")
+            await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            dropped.append(name)
+    return dropped
+
+async def prune_default_partition(conn: AsyncConnection, today: date, retention_days: int) -> int:
+    """deletes the rows of the default partition received before today - retention_days, returns their number"""
+    cutoff = today - timedelta(days=retention_days)
+    result = await conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE received_at < :cutoff"), {"cutoff": cutoff})
+    return result.rowcount
@@ -0,0 +1,98 @@
+import asyncio
+import base64
+import cProfile
+import logging
+import marshal
+import os
+import simplejson as json
+import sys
+import time
+import tracemalloc
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root")
+
+APP_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# only one capture per process at a time (profilers and tracemalloc are process wide)
+_capture_lock = asyncio.Lock()
+_profile_tasks = set()
+
+# ------------------------------------------------------------------------------
+# On-demand profiling of a running process. Captures run while the event loop keeps
+# doing its normal work and return a file:
+#   - cprofile:     a pstats file (python -m pstats FILE, snakeviz FILE, ...)
+#   - tracemalloc:  a text report of the memory allocated / freed during the capture,
+#                   grouped by module (models_mem, process_db, sqlalchemy, ...)
+
+def module_of(filename: str) -> str:
+    filename = os.path.abspath(filename)
+    if filename.startswith(APP_DIR + os.sep):
+        return os.path.splitext(os.path.relpath(filename, APP_DIR))[0].replace(os.sep, ".")
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(os.path.abspath(path) + os.sep):
+            return os.path.relpath(filename, os.path.abspath(path)).split(os.sep)[0].removesuffix(".py")
+    return filename
+
+async def capture_cprofile(seconds: float) -> bytes:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+async def capture_tracemalloc(seconds: float) -> bytes:
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+    by_module = {}
+    for stat in after.compare_to(before, "filename"):
+        module = module_of(stat.traceback[0].filename)
+        size_diff, count_diff, size = by_module.get(module, (0, 0, 0))
+        by_module[module] = (size_diff + stat.size_diff, count_diff + stat.count_diff, size + stat.size)
+
+    lines = [f"tracemalloc diff over {seconds}s, pid {os.getpid()}", "",
+             f"{'size diff':>14} {'count diff':>12} {'size':>14}  module"]
+    for module, (size_diff, count_diff, size) in sorted(by_module.items(), key=lambda item: abs(item[1][0]), reverse=True):
+        lines.append(f"{size_diff:>+14,} {count_diff:>+12,} {size:>14,}  {module}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+async def run_capture(mode: str, seconds: float):
+    """returns (filename, data) of a capture of this process"""
+    if _capture_lock.locked():
+        raise RuntimeError("another profile capture is running in this process")
+    async with _capture_lock:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        if mode == "cprofile":
+            return f"profile-{os.getpid()}-{stamp}.prof", await capture_cprofile(seconds)
+        if mode == "tracemalloc":
+            return f"tracemalloc-{os.getpid()}-{stamp}.txt", await capture_tracemalloc(seconds)
+        raise ValueError(f"unknown profile mode {mode} (supported: cprofile, tracemalloc)")
+
+async def handle_profile_request(channels, message_data: dict, process_name: str):
+    # PROFILE message: {"operation": "PROFILE", "mode": ..., "seconds": ..., "reply_channel": ...}
+    result = {"operation": "PROFILE_RESULT", "process": process_name, "pid": os.getpid()}
+    try:
+        filename, data = await run_capture(message_data["mode"], float(message_data["seconds"]))
+        result.update({"filename": filename, "data": base64.b64encode(data).decode("ascii")})
+    except Exception as e:
+        logger.error(f"{process_name}: profile capture failed: {e}")
+        result["error"] = str(e)
+    await channels.publish(message_data["reply_channel"], json.dumps(result))
+
+def start_profile_task(channels, message_data: dict, process_name: str):
+    # the capture runs next to the message loop, which it is supposed to observe
+    task = asyncio.create_task(handle_profile_request(channels, message_data, process_name))
+    _profile_tasks.add(task)
+    task.add_done_callback(_profile_tasks.discard)
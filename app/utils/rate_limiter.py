@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+# project imports
+import config
+from app.utils.admission import TokenBucket
+from app.utils.redis_config import get_redis
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.exch")
+
+PRIORITY_CANCEL = 0         # waiting cancels are served before everything else
+PRIORITY_ORDER = 1
+PRIORITY_QUERY = 2
+
+# ------------------------------------------------------------------------------
+# Request weight limit shared by all processes (and hosts) using the same exchange API key.
+#
+# The bucket lives in redis and is updated atomically by TAKE_SCRIPT. Each process takes
+# up to `prefetch` tokens per round trip and spends them locally, so most acquire() calls
+# don't touch redis at all. Waiters are served by priority (cancels first), then in order.
+# If redis fails the limiter falls back to a local bucket with the full rate (no
+# coordination) instead of blocking trading.
+
+# KEYS[1] bucket hash; ARGV: rate (tokens/s), burst, needed, wanted
+# returns {granted, wait_ms} with granted in [needed, wanted] or 0 (then wait_ms > 0)
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local needed = tonumber(ARGV[3])
+local wanted = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate / 1000)
+local granted = 0
+local wait_ms = 0
+if tokens >= needed then
+    granted = math.min(wanted, math.floor(tokens))
+    if granted < needed then
+        granted = needed
+    end
+    tokens = tokens - granted
+else
+    wait_ms = math.ceil((needed - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {tostring(granted), wait_ms}
+"""
+
+def endpoint_weight(endpoint: str) -> float:
+    weights = config.RATE_LIMITS['weights']
+    return weights.get(endpoint, weights['default'])
+
+class SharedRateLimiter:
+
+    def __init__(self, key: str, rate: float, burst: float, prefetch: float = None):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.prefetch = config.RATE_LIMITS['prefetch'] if prefetch is None else prefetch
+        self.local_tokens = 0.0
+        self.waiters = []                   # heap of (priority, sequence, weight, future)
+        self._sequence = itertools.count()
+        self._refill_task = None
+        self._script = None
+        self._fallback = None               # local TokenBucket while redis is unavailable
+        self.counters = {"acquired": 0, "waited": 0, "round_trips": 0, "fallback": 0}
+
+    async def take_remote(self, needed: float, wanted: float):
+        """returns (granted tokens, seconds to wait if nothing was granted)"""
+        try:
+            if self._script is None:
+                self._script = get_redis().register_script(TAKE_SCRIPT)
+            granted, wait_ms = await self._script(keys=[self.key], args=[self.rate, self.burst, needed, wanted])
+            self.counters["round_trips"] += 1
+            self._fallback = None
+            return float(granted), int(wait_ms) / 1000
+        except Exception as e:
+            if self._fallback is None:
+                logger.warning(f"SharedRateLimiter {self.key}: redis unavailable, limiting locally: {e}")
+                self._fallback = TokenBucket(self.rate, self.burst)
+            self.counters["fallback"] += 1
+            taken, wait = self._fallback.try_take(needed)
+            return (needed if taken else 0.0), wait
+
+    async def acquire(self, weight: float = 1.0, priority: int = PRIORITY_ORDER):
+        """waits until `weight` tokens have been taken from the shared bucket"""
+        if weight > self.burst:
+            raise ValueError(f"SharedRateLimiter {self.key}: weight {weight} exceeds burst {self.burst}")
+        self.counters["acquired"] += 1
+        if len(self.waiters) == 0 and self.local_tokens >= weight:
+            self.local_tokens -= weight
+            return
+        self.counters["waited"] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._sequence), weight, future))
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # tokens handed to a cancelled caller go back to the local pool
+            if future.done() and not future.cancelled():
+                self.local_tokens += weight
+            raise
+
+    async def _refill(self):
+        while len(self.waiters) > 0:
+            _, _, weight, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.local_tokens >= weight:
+                heapq.heappop(self.waiters)
+                self.local_tokens -= weight
+                future.set_result(None)
+                continue
+            needed = weight - self.local_tokens
+            granted, wait = await self.take_remote(needed, max(needed, self.prefetch))
+            self.local_tokens += granted
+            if granted == 0:
+                await asyncio.sleep(wait)
+
+    def to_dict(self):
+        return {"key": self.key, "rate": self.rate, "burst": self.burst, "local_tokens": self.local_tokens,
+                "waiting": len(self.waiters), **self.counters}
+
+# one limiter per API key in this process
+_limiters = {}
+
+def get_rate_limiter(exchange_id: str, account: str) -> SharedRateLimiter:
+    key = f"{config.RATE_LIMITS['redis_prefix']}:{exchange_id}:{account}"
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limits = config.RATE_LIMITS['exchanges'].get(exchange_id, config.RATE_LIMITS['default'])
+        limiter = _limiters[key] = SharedRateLimiter(key, limits['rate'], limits['burst'])
+    return limiter
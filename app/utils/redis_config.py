@@ -1,9 +1,87 @@
+import asyncio
 import logging
-import os
 import redis
+import redis.asyncio
+
+# project imports
+import config
 
 logger = logging.getLogger("sanic.root.db")
 
-REDIS_URL = os.getenv("REDIS_URL")
-logger.debug(f"REDIS_URL: {REDIS_URL}")
-redis_conn = redis.Redis.from_url(REDIS_URL)
+# ------------------------------------------------------------------------------
+# One redis connection pool per process, created on first use (i.e. after the fork of
+# the worker / background process) and configured by config.REDIS (REDIS_URL).
+#
+#   get_redis()         async client of this process (publish, pubsub, keys)
+#   publish_batch()     publishes many messages in one round trip
+#   BatchPublisher      coalesces concurrent publishes into pipelined round trips
+#   close_redis()       closes the pool at shutdown
+#   get_sync_redis()    blocking client for threads without event loop (supervisor)
+
+_async_pool = None
+_async_client = None
+_sync_client = None
+
+def get_redis() -> redis.asyncio.Redis:
+    global _async_pool, _async_client
+    if _async_client is None:
+        logger.debug(f"get_redis(): creating connection pool for {config.REDIS['url']}")
+        # a full pool makes callers wait (up to pool_timeout) instead of failing right away:
+        # WEBHOOK['max_in_flight'] requests may need a connection (dedup) at the same time
+        _async_pool = redis.asyncio.BlockingConnectionPool.from_url(
+            config.REDIS['url'], max_connections=config.REDIS['max_connections'], timeout=config.REDIS['pool_timeout'])
+        _async_client = redis.asyncio.Redis(connection_pool=_async_pool)
+    return _async_client
+
+def get_sync_redis() -> redis.Redis:
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(config.REDIS['url'])
+    return _sync_client
+
+async def publish_batch(messages) -> list:
+    """publishes (channel, data) pairs in one round trip, returns the receiver counts"""
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for channel, data in messages:
+            pipe.publish(channel, data)
+        return await pipe.execute()
+
+class BatchPublisher:
+    # publish() calls issued while a round trip is in flight are queued and sent together
+    # with the next pipeline, so under load many requests share one round trip while a
+    # single publish is sent right away
+
+    def __init__(self, max_batch: int = None, send=None):
+        self.max_batch = max_batch or config.REDIS['max_publish_batch']
+        self.send = send or publish_batch       # async callable publishing a list of (channel, data)
+        self._pending = []
+        self._flusher = None
+
+    async def publish(self, channel: str, data) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((channel, data, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        while len(self._pending) > 0:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                receivers = await self.send([(channel, data) for channel, data, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), count in zip(batch, receivers):
+                if not future.done():
+                    future.set_result(count)
+
+async def close_redis():
+    global _async_pool, _async_client
+    if _async_client is not None:
+        logger.debug("close_redis(): closing connection pool")
+        await _async_client.aclose()
+        await _async_pool.disconnect()
+    _async_pool, _async_client = None, None
@@ -0,0 +1,27 @@
+import zlib
+
+# project imports
+import config
+
+# ------------------------------------------------------------------------------
+# Work for the DB and exchange processes is partitioned by a stable hash of a key
+# (symbol for the DB writers, account for the exchange executors). All messages with
+# the same key end up on the same channel and are processed in order by one process.
+
+DB_CHANNEL = "db_channel"
+BROKER_CHANNEL = "broker_channel"
+
+def shard_index(key, shard_count: int) -> int:
+    # crc32 instead of hash(): it must be identical in every process (PYTHONHASHSEED)
+    if shard_count <= 1 or key is None:
+        return 0
+    return zlib.crc32(str(key).encode("utf-8")) % shard_count
+
+def shard_channel(base_channel: str, index: int) -> str:
+    return f"{base_channel}.{index}"
+
+def db_channel_for(symbol) -> str:
+    return shard_channel(DB_CHANNEL, shard_index(symbol, config.PROCESSES['db_shards']))
+
+def broker_channel_for(account_or_symbol) -> str:
+    return shard_channel(BROKER_CHANNEL, shard_index(account_or_symbol, config.PROCESSES['exch_shards']))
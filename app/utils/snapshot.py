@@ -0,0 +1,63 @@
+import logging
+import os
+import simplejson as json
+import tempfile
+
+# project imports
+from app.models_mem import OurGenericList
+from app.utils.serializer import datetime_serializer
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root.db")
+
+# bump whenever the layout of the snapshot changes, old files are ignored then
+SNAPSHOT_FORMAT_VERSION = 1
+
+# ------------------------------------------------------------------------------
+# A snapshot is the complete worker state:
+#
+#   { "format": SNAPSHOT_FORMAT_VERSION,
+#     "snapshot_version": <int, increasing>,
+#     "tables": { tablename: OurGenericList.to_json(), ... } }
+#
+# The same layout is used for the SNAPSHOT message sent to the workers and for the
+# snapshot file the workers read for a warm start.
+
+def snapshot_to_dict(snapshot_version: int, tables: dict) -> dict:
+    return {
+        "format": SNAPSHOT_FORMAT_VERSION,
+        "snapshot_version": snapshot_version,
+        "tables": {tablename: item_list.to_json() for tablename, item_list in tables.items()}
+    }
+
+def snapshot_from_dict(snapshot_dict: dict):
+    """returns (snapshot_version, {tablename: OurGenericList})"""
+    if snapshot_dict.get("format") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"unsupported snapshot format {snapshot_dict.get('format')} (expected {SNAPSHOT_FORMAT_VERSION})")
+    tables = {tablename: OurGenericList.from_json(item_list_json)
+              for tablename, item_list_json in snapshot_dict["tables"].items()}
+    return snapshot_dict["snapshot_version"], tables
+
+def write_snapshot_file(path: str, snapshot_version: int, tables: dict):
+    # write to a temporary file first so that readers never see a partial snapshot
+    json_str = json.dumps(snapshot_to_dict(snapshot_version, tables), default=datetime_serializer, use_decimal=True)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(json_str)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def read_snapshot_file(path: str):
+    """returns (snapshot_version, {tablename: OurGenericList}) or (None, {}) if there is no usable file"""
+    if not os.path.exists(path):
+        return None, {}
+    try:
+        with open(path) as snapshot_file:
+            return snapshot_from_dict(json.load(snapshot_file, use_decimal=True))
+    except Exception as e:
+        logger.warning(f"read_snapshot_file(): ignoring snapshot file {path}: {e}")
+        return None, {}
@@ -0,0 +1,51 @@
+import logging
+
+# project imports
+import config
+from app.utils.local_transport import LocalClient
+from app.utils.redis_config import BatchPublisher, get_redis, publish_batch as redis_publish_batch
+
+# project definitions and globals
+logger = logging.getLogger("sanic.root")
+
+# ------------------------------------------------------------------------------
+# The channels between the workers, the DB and the exchange processes go through the
+# transport selected by config.TRANSPORT['kind']:
+#   - 'redis':  redis pub/sub (required when the processes run on several hosts)
+#   - 'local':  unix domain sockets through the hub process (app/utils/local_transport.py)
+# Everything else (dedup keys, health hash, rate limits) stays in redis.
+#
+#   get_channels()      client with publish() / pubsub() for the channels of this process
+#   get_publisher()     coalesces concurrent publishes (see BatchPublisher)
+#   close_channels()    closes the local connections at shutdown
+
+_local_client = None
+_publisher = None
+
+def is_local() -> bool:
+    return config.TRANSPORT['kind'] == "local"
+
+def get_channels():
+    global _local_client
+    if not is_local():
+        return get_redis()
+    if _local_client is None:
+        _local_client = LocalClient()
+    return _local_client
+
+async def publish_batch(messages) -> list:
+    if is_local():
+        return await get_channels().publish_many(messages)
+    return await redis_publish_batch(messages)
+
+def get_publisher() -> BatchPublisher:
+    global _publisher
+    if _publisher is None:
+        _publisher = BatchPublisher(send=publish_batch)
+    return _publisher
+
+async def close_channels():
+    global _local_client, _publisher
+    if _local_client is not None:
+        await _local_client.aclose()
+    _local_client, _publisher = None, None
@@ -15,10 +15,14 @@ CCXT = {
     'retry_delay':              2,
     'timeout_connection':       10,         # FIXME: this is not being used
     'timeout_data':             2,
-    'max_rows_to_fetch':        500
+    'max_rows_to_fetch':        500,
+    'markets_cache_dir':        os.getenv("TRADELINK_MARKETS_CACHE_DIR", "/tmp/tradelink_markets"),
+    'markets_cache_ttl':        6 * 3600,   # seconds until cached markets are refreshed in the background
+    'markets_cache_check_interval': 300
 }
 
 DATABASE = {
+    'bulk_chunk_size':          500,        # rows per INSERT ... ON CONFLICT statement of bulk_upsert()
     'db_name':                  'test',
     'password_seed':            None,
     'uri_template':             None,
@@ -46,6 +50,137 @@ DATABASE['initial_data'] = {
     ]
 }
 
+# exchanges whose markets are cached (and refreshed) by the exchange processes from startup on
+CCXT['markets_cache_exchanges'] = sorted({account['exchange_id'] for account in DATABASE['initial_data']['Account']})
+
+# API keys of the accounts for the ccxt adapter, from the environment: <NAME>_API_KEY, <NAME>_SECRET
+# and (some exchanges) <NAME>_PASSWORD, e.g. BIXSUB1_API_KEY
+CCXT['account_credentials'] = {
+    account['name']: {option: value for option, value in [
+        ('apiKey',      os.getenv(f"{account['name'].upper()}_API_KEY")),
+        ('secret',      os.getenv(f"{account['name'].upper()}_SECRET")),
+        ('password',    os.getenv(f"{account['name'].upper()}_PASSWORD"))] if value is not None}
+    for account in DATABASE['initial_data']['Account']}
+
+REDIS = {
+    'url':                      os.getenv("REDIS_URL", "redis://localhost"),
+    'max_connections':          50,         # per process, requests beyond wait for a free connection
+    'pool_timeout':             5,          # seconds to wait for a free connection before failing
+    'max_publish_batch':        100         # messages per pipelined publish round trip
+}
+
+TRANSPORT = {
+    'kind':                     os.getenv("TRADELINK_TRANSPORT", "redis"),     # 'redis' (multi host) or 'local' (single host)
+    'socket_path':              os.getenv("TRADELINK_HUB_SOCKET", "/tmp/tradelink_hub.sock"),
+    'max_subscriber_buffer':    16 * 1024 * 1024,   # bytes queued for a slow subscriber before it is dropped
+    'reconnect_delay_max':      2.0
+}
+
+WEBHOOK = {
+    'dedup_window_seconds':     900,        # how long a (strategy, order_id) pair is remembered
+    'dedup_max_entries':        20000,      # per worker, oldest entries are dropped first
+    'dedup_redis_prefix':       'tradelink:dedup:',
+    'max_in_flight':            200,        # per worker, more concurrent requests get 503
+    'retry_after_seconds':      1,
+    'rate_limits': {                        # token buckets per WebSource.source_name, more requests get 429
+        'default':              {'rate': 20, 'burst': 40}
+    }
+}
+
+PROCESSES = {
+    'db_shards':                    1,          # number of DB writer processes (partitioned by symbol)
+    'exch_shards':                  1,          # number of exchange executor processes (partitioned by account)
+    'supervisor_interval':          1.0,        # seconds between liveness checks
+    'restart_backoff_initial':      1.0,        # seconds before the first restart of a crashed child
+    'restart_backoff_max':          60.0,
+    'restart_backoff_reset_after':  60.0,       # a child running this long is considered healthy again
+    'schema_wait_interval':         1.0,        # seconds between checks of DB shards > 0 waiting for shard 0's schema
+    'health_key':                   'tradelink:process_health'
+}
+
+SNAPSHOT = {
+    'path':                     os.getenv("TRADELINK_SNAPSHOT_PATH", "/tmp/tradelink_snapshot.json"),
+    'write_interval':           30,         # seconds between snapshot file updates (only if data changed)
+    'changes_key':              'tradelink:snapshot_changes',   # counter of the writes of the DB shards > 0
+    'request_timeout':          5           # seconds a worker waits before repeating its snapshot request
+}
+
+SIGNALS = {
+    'partition_days_ahead':     3,          # daily partitions of table signals created in advance
+    'retention_days':           90,         # partitions (and signals_default rows) older than this are dropped
+    'maintenance_interval':     3600,       # seconds between partition maintenance runs
+    'cache_max_rows':           10000,      # sliding window of the workers (and of the broadcasts)
+    'cache_max_age_hours':      24,
+    'history_page_size':        1000        # rows per keyset page (and per chunk) of /api/signals/history
+}
+
+EXCHANGE = {
+    'adapter':                  'simulated',    # 'simulated', 'paper' (matching engine) or 'ccxt' (one client per configured account, see CCXT['account_credentials'])
+    'simulated_latency':        1.0,        # seconds per (batch) order of the simulated adapter
+    'order_type':               'market',
+    'default_account':          None,       # account of signals naming none (None: no account, the ccxt adapter rejects them)
+    'netting_enabled':          False,      # net the signals per account and symbol before execution
+    'netting_window_seconds':   2.0,
+    'simulated_fill_seconds':   0.0,        # > 0: simulated orders stay open and fill gradually over this time
+    'paper_price_feed':         os.getenv("TRADELINK_PAPER_FEED"),    # .csv / .ndjson ticks, None: signal prices are the ticks
+    'paper_feed_mode':          'stepped',  # 'stepped': the order flow moves the feed, 'realtime': replayed (in a loop) at paper_feed_speed
+    'paper_feed_ticks_per_request': 1,      # stepped: ticks before every order batch and open orders poll of an account
+    'paper_feed_speed':         1.0,        # realtime: N times faster than recorded (0 = as fast as possible, offline benchmarks only)
+    'paper_tick_liquidity':     None,       # amount per tick and symbol the feed fills, None = unlimited
+    'paper_balances':           {'USDT': 100000.0},
+    'final_order_retention':    3600,       # seconds the workers keep filled / cancelled / rejected orders
+    'reconcile_min_interval':   1.0,        # order status reconciliation per account (bulk fetches), the
+    'reconcile_max_interval':   30.0        # interval doubles up to the max while nothing changes
+}
+
+PERSISTENCE = {
+    'flush_rows':               1000,       # buffered trades + position snapshots written with one COPY each
+    'flush_interval':           1.0,        # seconds, at the latest
+    'max_buffer_rows':          50000,      # full buffers are flushed at once, batches still not fitting are refused
+    'ack_timeout':              10.0,       # seconds until the exchange process resends an unacknowledged batch
+    'load_positions_attempts':  3,          # the exchange process continues the latest persisted positions
+    'max_retry_interval':       30.0,       # seconds, flushes back off up to this while nothing can be written
+    'dead_letter_path':         os.getenv("TRADELINK_EXECUTIONS_DEAD_LETTER", "/tmp/tradelink_executions_dead_letter.ndjson"),
+    'max_unacked_batches':      10000       # the oldest unacknowledged batches are dropped beyond this
+}
+
+RISK = {
+    'enabled':                  True,       # pre-trade checks in the exchange process (app/services/risk.py)
+    'max_order_notional':       100000,     # per order, at the order price or the most recent price
+    'max_symbol_notional':      250000,     # gross per account and symbol
+    'max_account_notional':     1000000,    # gross per account (per exchange shard for signals routed by symbol)
+    'max_portfolio_notional':   5000000,    # gross across all accounts of an exchange shard (see PROCESSES['exch_shards'])
+    'max_price_deviation':      0.1,        # limit price vs. most recent price
+    'min_resize_ratio':         0.1,        # orders resized below this fraction of their amount are rejected
+    'symbol_limits':            {},         # symbol -> {'max_order_notional': ..., 'max_symbol_notional': ...}
+    'account_limits':           {}          # account name -> max_account_notional
+}
+
+RATE_LIMITS = {
+    'enabled':                  True,
+    'redis_prefix':             'tradelink:ratelimit',
+    'prefetch':                 5,          # tokens taken from the shared bucket per redis round trip
+    'default':                  {'rate': 10, 'burst': 50},      # request weight per second and bucket size per API key
+    'exchanges': {
+        'binance':              {'rate': 20, 'burst': 1200},
+        'kraken':               {'rate': 1, 'burst': 15}
+    },
+    'weights': {                                                # request weight per ccxt method
+        'default':              1,
+        'create_order':         1,
+        'create_orders':        5,
+        'cancel_order':         1,
+        'fetch_order':          2,
+        'fetch_open_orders':    3,
+        'fetch_my_trades':      10
+    }
+}
+
+ADMIN = {
+    'token':                    os.getenv("TRADELINK_ADMIN_TOKEN"),     # admin endpoints are disabled without it
+    'profile_max_seconds':      120
+}
+
 #-----------------------------------------------------------------------------------------------------------------------
 # DEVELOPMENT
 #-----------------------------------------------------------------------------------------------------------------------
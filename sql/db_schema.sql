@@ -1,25 +1,37 @@
+-- signals are partitioned by day, partitions signals_pYYYYMMDD are created ahead and
+-- dropped after the retention period by the DB process (see app/utils/partitions.py)
 CREATE TABLE signals (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     strategy VARCHAR(255),
     order_id VARCHAR(255),
     action VARCHAR(50),
     symbol VARCHAR(50),
     price NUMERIC,
     quantity NUMERIC,
-    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, received_at)
+) PARTITION BY RANGE (received_at);
+
+CREATE TABLE signals_default PARTITION OF signals DEFAULT;
 
+-- trades and position snapshots are appended in bulk (COPY) by the DB process,
+-- trade_key makes redelivered batches idempotent (see app/services/execution_store.py)
 CREATE TABLE trades (
     id SERIAL PRIMARY KEY,
+    trade_key VARCHAR(100) UNIQUE,
+    account VARCHAR(255),
     symbol VARCHAR(50),
     action VARCHAR(50),
     price NUMERIC,
     quantity NUMERIC,
+    client_order_id VARCHAR(64),
+    exchange_order_id VARCHAR(255),
     executed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE positions (
     id SERIAL PRIMARY KEY,
+    account VARCHAR(255),
     symbol VARCHAR(50),
     quantity NUMERIC,
     average_price NUMERIC,